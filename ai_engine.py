@@ -2,58 +2,21 @@ import uuid
 import json
 from datetime import datetime, timezone
 
-def analyze_and_create_report(vitals, patient_id):
+import numpy as np
+
+import metrics
+from rule_engine import get_engine
+
+def build_risk_bundle(patient_id, status_type, description, risk_id=None, timestamp=None):
     """
-    輸入 vitals 字典包含: hr, spo2, hrv, stress, sleep, sys_bp ...
-    輸出: FHIR Bundle, 狀態類別(status), 描述(description), 風險評估ID(risk_id)
+    依照判斷結果產出 RiskAssessment 並包成 Transaction Bundle
+    (單筆與批次模式共用，確保兩邊輸出格式一致)
     """
-    
-    # 1. 初始化
-    risk_id = str(uuid.uuid4())
-    timestamp = datetime.now(timezone.utc).isoformat()
-    
-    # 預設狀態：正常
-    status_type = "normal" 
-    risk_level = "low"
-    description = "All vital signs are within normal limits."
-    
-    # === 2. AI 判斷邏輯 (規則引擎) ===
+    risk_id = risk_id or str(uuid.uuid4())
+    timestamp = timestamp or datetime.now(timezone.utc).isoformat()
+    # 狀態對應的風險等級與機率值 (定義在 rules.json，例如 急救=0.95, 預防=0.6, 正常=0.1)
+    risk_level, probability = get_engine().rules.meta[status_type]
 
-    # [規則 A: 急救回應流程 (Emergency Response)]
-    # 條件：心率極端異常、血氧過低、或血壓危象
-    # 邏輯：只要中一個，就是最高級別危險
-    if (vitals['hr'] > 170 or vitals['hr'] < 40) or \
-       (vitals['spo2'] < 85) or \
-       (vitals['sys_bp'] > 180):
-           
-        status_type = "emergency"
-        risk_level = "critical"
-        
-        reasons = []
-        if vitals['hr'] > 170: reasons.append("Severe Tachycardia")
-        if vitals['hr'] < 40: reasons.append("Severe Bradycardia")
-        if vitals['spo2'] < 85: reasons.append("Hypoxia")
-        if vitals['sys_bp'] > 180: reasons.append("Hypertensive Crisis")
-        
-        description = f"CRITICAL: {', '.join(reasons)}. Immediate medical intervention required."
-
-    # [規則 B: 預防監測流程 (Preventive Flow)]
-    # 條件：非急救狀態，但 壓力過高、睡眠不足 或 HRV 過低
-    elif (vitals['stress'] > 80) or \
-         (vitals['sleep'] < 5) or \
-         (vitals['hrv'] < 30):
-             
-        status_type = "preventive"
-        risk_level = "high"
-        
-        reasons = []
-        if vitals['stress'] > 80: reasons.append("High Stress Level")
-        if vitals['sleep'] < 5: reasons.append("Sleep Deprivation")
-        if vitals['hrv'] < 30: reasons.append("Low HRV (Fatigue)")
-        
-        description = f"WARNING: {', '.join(reasons)}. Rest recommended to prevent burnout."
-    
-    # === 3. 產出 RiskAssessment (風險評估報告) ===
     # 這份報告是 AI 思考後的結晶，會存回 Server
     risk_assessment = {
         "resourceType": "RiskAssessment",
@@ -64,8 +27,7 @@ def analyze_and_create_report(vitals, patient_id):
         "prediction": [
             {
                 "outcome": {"text": description}, # AI 的文字診斷
-                # 根據狀態給予機率值 (急救=0.95, 預防=0.6, 正常=0.1)
-                "probabilityDecimal": 0.95 if status_type == "emergency" else (0.6 if status_type == "preventive" else 0.1),
+                "probabilityDecimal": probability,
                 "qualitativeRisk": {
                     "coding": [{
                         "system": "http://terminology.hl7.org/CodeSystem/risk-probability",
@@ -76,7 +38,6 @@ def analyze_and_create_report(vitals, patient_id):
         ]
     }
 
-    # === 4. 打包回傳 ===
     entries = [
         {
             "fullUrl": f"urn:uuid:{risk_id}", 
@@ -85,19 +46,122 @@ def analyze_and_create_report(vitals, patient_id):
         }
     ]
     
-    ai_bundle = {
+    return {
         "resourceType": "Bundle",
         "type": "transaction",
         "entry": entries
     }
+
+def analyze_and_create_report(vitals, patient_id):
+    """
+    輸入 vitals 字典包含: hr, spo2, hrv, stress, sleep, sys_bp ...
+          (可選) vitals_state.RollingVitalsStore.features() 的趨勢欄位，例如 hrv_trend
+    輸出: FHIR Bundle, 狀態類別(status), 描述(description), 風險評估ID(risk_id)
+    """
+    
+    # 1. 初始化
+    risk_id = str(uuid.uuid4())
+    timestamp = datetime.now(timezone.utc).isoformat()
+    
+    # === 2. AI 判斷邏輯 (規則引擎) ===
+    # 門檻定義在 rules.json (編譯後執行、修改後自動重新載入)，依嚴重度由高到低判斷：
+    # [規則 A: 急救回應流程 (Emergency Response)] 心率極端異常、血氧過低、或血壓危象
+    # [規則 B: 預防監測流程 (Preventive Flow)] 壓力過高、睡眠不足、HRV 過低 或 HRV 一小時內下降超過 30%
+    with metrics.timer("engine.rules"):
+        status_type, description = get_engine().evaluate(vitals)
+    
+    # === 3. 產出 RiskAssessment 並打包成 Transaction Bundle ===
+    with metrics.timer("engine.bundle"):
+        ai_bundle = build_risk_bundle(patient_id, status_type, description, risk_id, timestamp)
     
     # 回傳這些資料讓 App 決定畫面要變紅色(Emergency) 還是 黃色(Preventive)
     return ai_bundle, status_type, description, risk_id
 
+# === 批次模式 (Batch Mode) ===
+# 一次評估 N 位病人的欄位式數據，規則與 analyze_and_create_report 完全相同 (同一份 rules.json)，
+# 只是把逐筆判斷改成 NumPy 陣列運算。
+
+def analyze_batch(vitals):
+    """
+    輸入 vitals: pandas DataFrame 或 {欄位: NumPy 陣列}，欄位同 analyze_and_create_report
+    輸出: 狀態陣列(status), 描述陣列(description), 機率陣列(probability)
+    """
+    return get_engine().evaluate_batch(vitals)
+
+class BatchReports:
+    """
+    批次結果的惰性 Bundle 容器：只有被取用的那一列才會組 RiskAssessment Bundle
+    每列第一次取用時組好並保留，之後重複取用回傳同一個 Bundle 與風險評估ID (重送不會變成另一筆)
+    """
+    def __init__(self, patient_ids, status, description):
+        self.patient_ids = patient_ids
+        self.status = status
+        self.description = description
+        self._built = {} # 列索引 -> 報告
+
+    def __len__(self):
+        return len(self.status)
+
+    def __getitem__(self, i):
+        """回傳 (Bundle, 狀態, 描述, 風險評估ID)，格式同 analyze_and_create_report"""
+        i = range(len(self))[i] # 負索引與越界檢查同 list
+        report = self._built.get(i)
+        if report is None:
+            risk_id = str(uuid.uuid4())
+            status_type = str(self.status[i])
+            bundle = build_risk_bundle(self.patient_ids[i], status_type, self.description[i], risk_id)
+            report = self._built[i] = (bundle, status_type, self.description[i], risk_id)
+        return report
+
+    def flagged(self):
+        """只產出非正常 (emergency / preventive) 的列：(列索引, 報告)"""
+        for i in np.flatnonzero(self.status != "normal"):
+            yield int(i), self[i]
+
+def analyze_batch_and_create_reports(vitals, patient_ids):
+    """批次評估並回傳惰性 Bundle 容器 (BatchReports)"""
+    status, description, _ = analyze_batch(vitals)
+    return BatchReports(list(patient_ids), status, description)
+
 # 測試區
 if __name__ == "__main__":
+    import time
+    import pandas as pd
+
     # 模擬一個危險數據
     test_vitals = {"hr": 180, "spo2": 95, "sys_bp": 120, "stress": 50, "sleep": 7, "hrv": 50}
     b, s, d, rid = analyze_and_create_report(test_vitals, "test-pid")
     print(f"Status: {s}") # 應該要是 emergency
     print(json.dumps(b, indent=2))
+
+    # 批次模式：與單筆模式比對 (含門檻邊界值)，並量測吞吐量
+    rng = np.random.default_rng(0)
+    n = 20000
+    df = pd.DataFrame({
+        "hr": rng.integers(30, 200, n), "spo2": rng.integers(75, 101, n),
+        "sys_bp": rng.integers(90, 200, n), "stress": rng.integers(0, 101, n),
+        "sleep": rng.integers(2, 10, n), "hrv": rng.integers(10, 100, n),
+        "hrv_trend": rng.integers(-50, 20, n).astype(float),
+    })
+    df.loc[::7, "hrv_trend"] = np.nan # 沒有趨勢資料的病人
+    rows = df.to_dict("records")
+
+    t0 = time.perf_counter()
+    scalar = [analyze_and_create_report(r, "p")[1:3] for r in rows]
+    t_scalar = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    status, desc, prob = analyze_batch(df)
+    t_batch = time.perf_counter() - t0
+
+    for i, (s_ref, d_ref) in enumerate(scalar):
+        assert (status[i], desc[i]) == (s_ref, d_ref), (i, rows[i])
+        assert prob[i] == get_engine().rules.meta[s_ref][1]
+    print(f"Parity OK ({n} rows)")
+    print(f"Scalar: {n / t_scalar:,.0f} patients/s | Batch: {n / t_batch:,.0f} patients/s")
+
+    reports = analyze_batch_and_create_reports(df, [f"p{i}" for i in range(n)])
+    flagged = sum(1 for _ in reports.flagged())
+    first = next(reports.flagged())[0]
+    assert reports[first] is reports[first] and reports[first][3] == reports[first - n][3] # 重複取用 ID 不變
+    print(f"Flagged bundles built lazily: {flagged}/{n}")
@@ -1,21 +1,70 @@
-import streamlit as st
+import os
+import json
 import requests
+import streamlit as st
+import streamlit.components.v1 as components
 import uuid
-import time
 from datetime import datetime, timezone
 
-# --- 匯入模組 (請確保您的資料夾中有這兩個檔案) ---
+# --- 匯入模組 (請確保您的資料夾中有這些檔案) ---
 try:
-    from fhir_gateway import create_raw_data_bundle
+    from fhir_gateway import create_raw_data_bundle, register_patient_response, patient_cache, change_detector
     from ai_engine import analyze_and_create_report
-except ImportError:
-    st.error("❌ 找不到必要的模組 (fhir_gateway.py 或 ai_engine.py)。請確認檔案是否在同一目錄下。")
+    from fhir_client import get_client, configure as configure_client
+    from fhir_outbox import get_outbox
+    from vitals_state import RollingVitalsStore
+    from fhir_triage import get_board
+    from watch_push import get_hub, start_server as start_push_server
+    from fhir_validator import validate_bundle
+    import metrics
+except ImportError as e:
+    st.error(f"❌ 找不到必要的模組 ({e.name}.py)。請確認檔案是否在同一目錄下。")
     st.stop()
 
 st.set_page_config(layout="wide", page_title="h1 雙軌醫療系統 (FHIR 標準版)")
 
 # [修正 1] 改用 HAPI FHIR R4 公用伺服器 (比 fire.ly 穩定且權限較寬鬆)
-FHIR_SERVER_URL = "https://hapi.fhir.org/baseR4"
+# 可用環境變數 FHIR_SERVER_URL 改指向本地替身伺服器 (python fhir_stub.py)，方便重現效能量測
+FHIR_SERVER_URL = os.environ.get("FHIR_SERVER_URL", "https://hapi.fhir.org/baseR4")
+# 這台伺服器的傳輸選項 (JSON)，例如 FHIR_HTTP_OPTIONS='{"gzip_requests": true, "prefer_minimal": true, "cache_size": 256}'
+# 必須在第一次 get_client() 之前設定
+if os.environ.get("FHIR_HTTP_OPTIONS"):
+    configure_client(FHIR_SERVER_URL, **json.loads(os.environ["FHIR_HTTP_OPTIONS"]))
+# 離線暫存區 (上傳前先寫入這裡)
+OUTBOX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "outbox")
+# 變化偵測：數值沒變 (或在死區內) 的 Observation 不重送，但至少每 FHIR_HEARTBEAT_SECONDS 秒送一次
+# 最後送出的內容存在離線暫存區旁，重啟後接著用
+CHANGE_CACHE_PATH = os.path.join(OUTBOX_DIR, "change_cache.json")
+change_detector.heartbeat = int(os.environ.get("FHIR_HEARTBEAT_SECONDS", "300"))
+if change_detector.path is None:
+    os.makedirs(OUTBOX_DIR, exist_ok=True)
+    change_detector.load(CHANGE_CACHE_PATH)
+# 效能監控：預設關閉 (FHIR_METRICS=1 開啟，由 metrics 模組讀取)；設定 FHIR_METRICS_PORT 時另外提供 Prometheus /metrics 端點
+if metrics.is_enabled() and os.environ.get("FHIR_METRICS_PORT"):
+    metrics.start_http_server(int(os.environ["FHIR_METRICS_PORT"]))
+
+# 多病人分流看板的自動刷新間隔 (秒)
+TRIAGE_REFRESH_SECONDS = 5
+# 手錶推播 (SSE)：手錶頁面由推播服務提供 (http://127.0.0.1:8765/watch?patient=...&token=...)
+# WATCH_PUSH_TOKEN 沒設定時每次啟動隨機產生；WATCH_PUSH_ORIGINS (逗號分隔) 為額外允許的頁面來源
+WATCH_PUSH_PORT = int(os.environ.get("WATCH_PUSH_PORT", "8765"))
+
+@st.cache_resource
+def _push_server():
+    """整個 process 只啟動一次 (Streamlit 重跑頁面時不會再 bind)"""
+    origins = [o.strip() for o in os.environ.get("WATCH_PUSH_ORIGINS", "").split(",") if o.strip()]
+    return start_push_server(WATCH_PUSH_PORT, token=os.environ.get("WATCH_PUSH_TOKEN"), origins=origins)
+
+try:
+    push_server = _push_server()
+except OSError as e:
+    push_server = None # 失敗不會被快取，下次重跑會再試
+    st.warning(f"⚠️ 手錶推播服務無法啟動 (port {WATCH_PUSH_PORT}: {e})；手錶頁面收不到即時推播")
+
+@st.cache_resource
+def get_trend_store():
+    """每位病人的滾動統計 (趨勢規則用)：整個 process 共用，不同分頁 / 重新整理都看到同一份趨勢"""
+    return RollingVitalsStore()
 
 # --- 初始化 Session State ---
 if 'watch_screen' not in st.session_state: st.session_state['watch_screen'] = "normal"
@@ -25,36 +74,93 @@ if 'vitals' not in st.session_state: st.session_state['vitals'] = {}
 if 'pid' not in st.session_state: st.session_state['pid'] = None
 if 'ai_status' not in st.session_state: st.session_state['ai_status'] = "unknown"
 if 'risk_id' not in st.session_state: st.session_state['risk_id'] = None
+if 'push_last_id' not in st.session_state: st.session_state['push_last_id'] = get_hub().last_id() # 只套用開啟頁面之後的推播事件
 
 # --- Helper Functions ---
 
-def send_bundle(bundle):
-    headers = {"Content-Type": "application/fhir+json"}
-    
+# 只重跑這個區塊 (Streamlit fragment)，不會整頁重新執行；舊版 Streamlit 用 experimental_fragment
+_fragment = getattr(st, "fragment", None) or st.experimental_fragment
+
+def publish_delivered(bundle, response):
+    """
+    outbox 送達後 (含逾時之後才送達、重啟後補送的) 把醫囑推播到手錶；在 outbox 的 drainer 執行緒上執行
+    CPR (stat ServiceRequest) → "cpr"，CommunicationRequest → "message"；clicked_at 取自 authoredOn
+    """
+    for entry in bundle.get("entry", []):
+        resource = entry.get("resource", {})
+        rtype = resource.get("resourceType")
+        if rtype not in ("ServiceRequest", "CommunicationRequest"):
+            continue
+        patient_id = resource.get("subject", {}).get("reference", "").split("/")[-1]
+        authored = resource.get("authoredOn")
+        clicked_at = datetime.fromisoformat(authored).timestamp() * 1000 if authored else None
+        if rtype == "ServiceRequest" and resource.get("priority") == "stat":
+            reasons = resource.get("reasonReference") or [{}]
+            risk_id = reasons[0].get("reference", "").split("/")[-1] or None
+            get_hub().publish(patient_id, "cpr", {"request_id": resource.get("id"), "risk_id": risk_id,
+                                                  "clicked_at": clicked_at})
+        elif rtype == "CommunicationRequest":
+            payload = resource.get("payload") or [{}]
+            get_hub().publish(patient_id, "message", {"request_id": resource.get("id"),
+                                                      "text": payload[0].get("contentString"),
+                                                      "priority": resource.get("priority"), "clicked_at": clicked_at})
+
+def get_app_outbox():
+    """共用的離線暫存區 (第一次建立時掛上 publish_delivered，重啟後補送的醫囑也會推播)"""
+    return get_outbox(OUTBOX_DIR, get_client(FHIR_SERVER_URL), on_delivered=publish_delivered)
+
+def send_bundle(bundle, priority=None, on_reject=None):
+    """
+    先寫入離線暫存區 (fhir_outbox) 再由背景補送：伺服器慢或斷線時資料不會遺失，重啟後也會接著送
+    priority 沒給就依內容分類 (fhir_outbox.classify)：急救 RiskAssessment / stat ServiceRequest 走 emergency，
+    preventive / urgent 醫囑走 urgent，各有保留的送出執行緒，不會被一般生理數據的積壓擋住
+    on_reject: 資料確定沒送出時呼叫 (預檢失敗、伺服器拒絕、佇列寫不進去)；
+    逾時不算，資料已存在佇列裡，之後會補送
+    """
     # [修正 2] 強制將 Bundle 類型設為 transaction，這是根目錄寫入的標準格式
     if bundle.get("resourceType") == "Bundle":
         bundle["type"] = "transaction"
+
+    # 本地預檢：格式錯誤 (缺 subject、UCUM 單位錯誤、佔位 ID ...) 直接擋下，不必等伺服器來回一趟
+    with metrics.timer("app.validate"):
+        issues = validate_bundle(bundle)
+    if issues:
+        st.error(f"資料格式檢查未通過 ({len(issues)} 項)，未送出")
+        with st.expander("🔍 查看檢查結果 (Pre-flight Validation)"):
+            st.text("\n".join(issues))
+        if on_reject:
+            on_reject()
+        return None
     
     try:
-        # 設定 timeout 避免卡死
-        response = requests.post(FHIR_SERVER_URL, json=bundle, headers=headers, timeout=20)
+        # 透過共用連線池送出 (含 429/5xx 重試)，最多等 20 秒避免卡死
+        # cProfile 由 outbox 的 drainer 執行緒記錄 (請求 ID = 第一個 entry 的資源 ID，見 fhir_outbox.request_id)
+        with metrics.timer("app.send_bundle"):
+            # 推播到手錶不在這裡做：逾時後才送達的也要推播，由 publish_delivered 在送達時處理
+            response = get_app_outbox().submit(bundle, priority).result(timeout=20)
         
         # [修正 3] 詳細的錯誤處理
         if response.status_code not in [200, 201]:
             st.error(f"上傳失敗 (HTTP {response.status_code})")
             with st.expander("🔍 查看伺服器錯誤詳情 (Server Response)"):
                 st.text(response.text)  # 印出伺服器具體報錯原因
+            if on_reject:
+                on_reject()
             return None
             
         return response
-    except requests.exceptions.RequestException as e:
-        st.error(f"連線錯誤: {e}")
+    except TimeoutError:
+        st.warning("伺服器暫時無法連線，資料已存入離線佇列，恢復連線後會自動補送。")
+        return None
+    except OSError as e:
+        st.error(f"離線佇列寫入失敗: {e}")
+        if on_reject:
+            on_reject()
         return None
 
 def send_service_request(patient_id, risk_id):
     """發送醫療處置請求 (Start CPR)"""
     req_id = str(uuid.uuid4())
-    safe_risk_id = risk_id if risk_id else "unknown"
     
     sr = {
         "resourceType": "ServiceRequest",
@@ -62,10 +168,13 @@ def send_service_request(patient_id, risk_id):
         "status": "active",
         "intent": "order",
         "priority": "stat",
+        "authoredOn": datetime.now(timezone.utc).isoformat(), # 按下的時間 (手錶端量延遲用)
         "code": {"coding": [{"system": "http://snomed.info/sct", "code": "40617009", "display": "Start CPR"}]},
         "subject": {"reference": f"Patient/{patient_id}"},
-        "reasonReference": [{"reference": f"RiskAssessment/{safe_risk_id}"}],
     }
+    # 沒有 AI 評估時不附 reasonReference (以前的 "unknown" 會變成指向不存在資源的引用)
+    if risk_id:
+        sr["reasonReference"] = [{"reference": f"RiskAssessment/{risk_id}"}]
     
     # 包裝成 Transaction Bundle 發送
     bundle = {
@@ -76,7 +185,7 @@ def send_service_request(patient_id, risk_id):
             "request": {"method": "POST", "url": "ServiceRequest"}
         }]
     }
-    res = send_bundle(bundle)
+    res = send_bundle(bundle) # priority: stat → emergency；伺服器一接受就由 publish_delivered 推播到手錶
     return req_id, sr, res
 
 def send_communication_request(patient_id, message_text, priority="routine"):
@@ -105,9 +214,69 @@ def send_communication_request(patient_id, message_text, priority="routine"):
         }]
     }
     
-    res = send_bundle(bundle)
+    res = send_bundle(bundle) # 依 priority 分類 (stat / asap / urgent 優先送)；送達時由 publish_delivered 推播
     return req_id, comm_req, res
 
+def watch_panel():
+    """手錶畫面：即時顯示由內嵌的手錶頁面 (SSE 推播) 負責；這裡在頁面重跑時補套用推播事件"""
+    pid = st.session_state['pid']
+    if pid:
+        for event_id, event, data in get_hub().since(pid, st.session_state['push_last_id']):
+            st.session_state['push_last_id'] = event_id
+            if event == "cpr":
+                st.session_state['watch_screen'] = "cpr"
+                st.session_state['watch_message'] = None
+            elif event == "message":
+                st.session_state['watch_message'] = data["text"]
+
+    st.subheader("📱 手錶畫面")
+    state = st.session_state['watch_screen']
+    msg = st.session_state['watch_message']
+
+    # [UI 修正] 優先級：CPR > Msg > Rest
+    if state == "cpr":
+        st.error("🆘 EMERGENCY - ServiceRequest Received")
+        st.markdown("""
+        <div style="background-color: #d32f2f; color: white; padding: 20px; border-radius: 10px; text-align: center; animation: pulse 1s infinite;">
+            <h1>START CPR</h1>
+            <p>🚑 Ambulance Dispatched</p>
+        </div>
+        <style>@keyframes pulse { 0% {transform: scale(1);} 50% {transform: scale(1.05);} 100% {transform: scale(1);} }</style>
+        """, unsafe_allow_html=True)
+        if st.button("🔕 解除急救"):
+            st.session_state['watch_screen'] = "normal"
+            st.rerun()
+
+    elif msg:
+        st.info("📩 收到新訊息 (CommunicationRequest)")
+        st.markdown(f"""
+        <div style="background-color: #e3f2fd; color: #0d47a1; padding: 15px; border-radius: 10px; border-left: 5px solid #2196f3;">
+            <strong>👨‍⚕️ Dr. AI:</strong><br>
+            <span style="font-size: 1.2em;">{msg}</span>
+        </div>
+        """, unsafe_allow_html=True)
+        if st.button("知道了 (Dismiss Msg)"):
+            st.session_state['watch_message'] = None
+            st.rerun()
+
+    elif state == "rest":
+        st.warning("⚠️ 疲勞預警")
+        st.write("檢測到高壓力，請休息。")
+        if st.button("✅ 解除提醒"):
+            st.session_state['watch_screen'] = "normal"
+            st.rerun()
+
+    else:
+        st.success("✅ 監測中...")
+        if st.session_state['has_data']:
+            v = st.session_state['vitals']
+            st.metric("Heart Rate", f"{v.get('hr')} bpm")
+
+    if pid and push_server is not None:
+        # 手錶模擬器直接訂閱推播服務，事件到達就更新 (不靠 Streamlit 輪詢)
+        components.iframe(push_server.watch_url(pid), height=460)
+        st.caption(f"手錶模擬器: {push_server.watch_url(pid)}")
+
 # --- UI 開始 ---
 st.title("🏥 h1 智慧醫療系統：CommunicationRequest 實作")
 st.caption(f"目前連線伺服器: {FHIR_SERVER_URL}")
@@ -121,48 +290,7 @@ with tab1:
     col_watch, col_sensor = st.columns([1, 1.5])
 
     with col_watch:
-        st.subheader("📱 手錶畫面")
-        state = st.session_state['watch_screen']
-        msg = st.session_state['watch_message']
-
-        # [UI 修正] 優先級：CPR > Msg > Rest
-        if state == "cpr":
-            st.error("🆘 EMERGENCY - ServiceRequest Received")
-            st.markdown("""
-            <div style="background-color: #d32f2f; color: white; padding: 20px; border-radius: 10px; text-align: center; animation: pulse 1s infinite;">
-                <h1>START CPR</h1>
-                <p>🚑 Ambulance Dispatched</p>
-            </div>
-            <style>@keyframes pulse { 0% {transform: scale(1);} 50% {transform: scale(1.05);} 100% {transform: scale(1);} }</style>
-            """, unsafe_allow_html=True)
-            if st.button("🔕 解除急救"):
-                st.session_state['watch_screen'] = "normal"
-                st.rerun()
-
-        elif msg:
-            st.info("📩 收到新訊息 (CommunicationRequest)")
-            st.markdown(f"""
-            <div style="background-color: #e3f2fd; color: #0d47a1; padding: 15px; border-radius: 10px; border-left: 5px solid #2196f3;">
-                <strong>👨‍⚕️ Dr. AI:</strong><br>
-                <span style="font-size: 1.2em;">{msg}</span>
-            </div>
-            """, unsafe_allow_html=True)
-            if st.button("知道了 (Dismiss Msg)"):
-                st.session_state['watch_message'] = None
-                st.rerun()
-
-        elif state == "rest":
-            st.warning("⚠️ 疲勞預警")
-            st.write("檢測到高壓力，請休息。")
-            if st.button("✅ 解除提醒"):
-                st.session_state['watch_screen'] = "normal"
-                st.rerun()
-
-        else:
-            st.success("✅ 監測中...")
-            if st.session_state['has_data']:
-                v = st.session_state['vitals']
-                st.metric("Heart Rate", f"{v.get('hr')} bpm")
+        watch_panel()
 
     with col_sensor:
         st.subheader("⚙️ 生理感測")
@@ -183,28 +311,72 @@ with tab1:
 
         if st.button("📡 上傳數據"):
             with st.spinner("上傳中..."):
-                # 1. 產生 FHIR 數據包
+                # 1. 產生 FHIR 數據包 (只含有變化的 Observation)
                 raw_bundle, pid, oid = create_raw_data_bundle(
-                    user_id, user_name, hr, spo2, sys_bp, dia_bp, resp_rate, hrv, stress, sleep_hours, 25.033, 121.565
+                    user_id, user_name, hr, spo2, sys_bp, dia_bp, resp_rate, hrv, stress, sleep_hours, 25.033, 121.565,
+                    detector=change_detector
                 )
                 
-                # 2. 上傳到伺服器 (呼叫修正後的函式)
-                res = send_bundle(raw_bundle)
+                # 2. 上傳到伺服器 (呼叫修正後的函式)；全部沒變就不必送
+                if raw_bundle["entry"]:
+                    # 確定沒送出才忘掉基準值 (下次全部重送)；逾時的資料還在佇列裡，會照原樣補送
+                    res = send_bundle(raw_bundle, on_reject=lambda: change_detector.forget(user_id))
+                else:
+                    res = None
+                    st.toast("數值沒有變化，略過上傳", icon="⏭️")
                 
-                if res and res.status_code in [200, 201]:
-                    st.session_state['pid'] = pid
+                if res and res.status_code in [200, 201] or not raw_bundle["entry"]:
+                    # 換成伺服器指派的 Patient ID (並寫入身分快取，下次上傳不再重送 Patient)
+                    if res is not None:
+                        st.session_state['pid'] = register_patient_response(user_id, res.json()) or pid
+                    else:
+                        st.session_state['pid'] = pid
                     st.session_state['has_data'] = True
                     st.session_state['vitals'] = {
                         "hr": hr, "spo2": spo2, "hrv": hrv, "stress": stress, 
                         "name": user_name, "sys_bp": sys_bp, "dia_bp": dia_bp, 
                         "resp": resp_rate, "sleep": sleep_hours
                     }
+                    get_trend_store().update(
+                        st.session_state['pid'], hr=hr, hrv=hrv, spo2=spo2, stress=stress, sys_bp=sys_bp, dia_bp=dia_bp
+                    )
                     st.session_state['watch_screen'] = "normal"
-                    st.toast("上傳成功", icon="✅")
+                    if res is not None:
+                        st.toast("上傳成功", icon="✅")
                 else:
                     # 錯誤訊息已在 send_bundle 中顯示
                     pass
 
+        cache_stats = patient_cache.stats()
+        st.caption(f"病人身分快取: 命中 {cache_stats['hits']} / 未命中 {cache_stats['misses']} (共 {cache_stats['size']} 筆)")
+        change_stats = change_detector.stats()
+        st.caption(f"變化偵測: 送出 {change_stats['sent']} / 略過 {change_stats['skipped']} 筆 Observation "
+                   f"(心跳重送 {change_stats['heartbeats']})")
+
+@_fragment(run_every=TRIAGE_REFRESH_SECONDS)
+def triage_panel():
+    """所有監測中病人的最新數值與 AI 風險 (每次只同步上次之後的新資料)"""
+    board = get_board(get_client(FHIR_SERVER_URL))
+    try:
+        stats = board.refresh()
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        st.warning(f"分流看板同步失敗，顯示上次的資料: {e}")
+        stats = None
+    view = board.view()
+    if view.empty:
+        st.caption("最近一小時內沒有病人數據。")
+        return
+    n_emergency = int((view["status"] == "emergency").sum())
+    n_preventive = int((view["status"] == "preventive").sum())
+    m1, m2, m3 = st.columns(3)
+    m1.metric("監測中病人", len(view))
+    m2.metric("🔴 急救", n_emergency)
+    m3.metric("🟡 預防", n_preventive)
+    st.dataframe(view, use_container_width=True)
+    if stats:
+        st.caption(f"本次同步: {stats['observations']} 筆 Observation / {stats['risks']} 筆 RiskAssessment, "
+                   f"{stats['requests']} 個請求, {stats['seconds'] * 1000:.0f} ms")
+
 # ==========================================
 #  TAB 2: 醫療中心 (Doctor)
 # ==========================================
@@ -218,8 +390,10 @@ with tab2:
         # AI 分析區塊
         if st.button("🤖 AI 風險計算"):
             with st.spinner("AI 分析中..."):
-                bundle, status, desc, risk_id = analyze_and_create_report(v, st.session_state['pid'])
-                res = send_bundle(bundle)
+                # 併入滾動統計的趨勢欄位 (例如 hrv_trend)，讓規則能看到一小時內的變化
+                trends = get_trend_store().features(st.session_state['pid'])
+                bundle, status, desc, risk_id = analyze_and_create_report({**v, **trends}, st.session_state['pid'])
+                res = send_bundle(bundle) # 依 qualitativeRisk 分類 (critical → emergency)
                 
                 if res and res.status_code in [200, 201]:
                     st.session_state['ai_status'] = status
@@ -270,3 +444,37 @@ with tab2:
 
     else:
         st.warning("等待數據... 請先至「穿戴裝置」頁面上傳生理數值。")
+
+    # --- 多病人分流 (Triage) ---
+    st.markdown("---")
+    st.subheader("📋 多病人分流看板")
+    triage_panel()
+
+    # --- 效能監控 (Latency) ---
+    with st.expander("⏱️ 效能監控 (各階段延遲)"):
+        if not metrics.is_enabled():
+            st.caption("效能監控已關閉 (設定 FHIR_METRICS=1 開啟)")
+        else:
+            rows = metrics.snapshot()
+            if rows:
+                st.dataframe(rows, use_container_width=True, hide_index=True)
+            sent = {dict(labels).get("resource_type"): value
+                    for (name, labels), value in metrics.counters().items() if name == "bytes_sent"}
+            if sent:
+                st.caption("送出 bytes (依資源類型): " + ", ".join(f"{k} {v:,}" for k, v in sorted(sent.items())))
+
+            profile_id = st.text_input("cProfile 指定請求 ID (留空 = 下一個送出的請求):")
+            if st.button("🎯 記錄 cProfile"):
+                metrics.arm_profile(profile_id.strip() or None)
+                st.toast(f"已設定: {profile_id.strip() or '下一個請求'}")
+            for rid, report in list(metrics.profiles.items())[-3:]:
+                st.caption(f"Profile {rid}") # expander 裡不能再放 expander
+                st.text(report)
+        # 各優先級 lane 的積壓與 寫入 → 送達 p99 (不受 FHIR_METRICS 影響)
+        lanes = get_app_outbox().stats()
+        st.dataframe([{"lane": name, **row} for name, row in lanes.items()], use_container_width=True, hide_index=True)
+        io = get_client(FHIR_SERVER_URL).io_stats()
+        if io["requests"]:
+            st.caption(f"傳輸: 每個 Bundle {io['bytes_per_bundle'] or 0:,.0f} B "
+                       f"(壓縮比 {io['compression'] or 1:.0%})、接收 {io['bytes_in']:,} B、"
+                       f"ETag 快取命中率 {io['cache_hit_rate'] or 0:.0%}")
@@ -0,0 +1,514 @@
+import io
+import os
+import re
+import sys
+import gzip
+import json
+import time
+import uuid
+import sqlite3
+import hashlib
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from fast_json import dumps, loads
+from fhir_triage import observation_values, VITAL_COLUMNS
+from ai_engine import analyze_batch, build_risk_bundle
+from rule_engine import DEFAULT_RULES_PATH
+
+# 歷史資料重新評分 (Backfill)：rules.json 改版後，把封存的 Transaction Bundle 重新跑一次規則引擎
+# - 串流讀取：*.json (單一 Bundle，逐個 entry 增量解析)、*.ndjson (每行一個 Bundle 或一個資源)，可加 .gz
+#   檔案再大也只佔用一個 entry / 一行的記憶體；散裝資源的分組超過 LOOSE_MAX_GROUPS 組就暫存到磁碟 (SQLite)
+# - 依 LOINC 代碼取出生理數值 (與 fhir_gateway 送出的代碼相同)，缺少的欄位為 NaN (不觸發規則)
+# - 以 process pool 平行處理；大型「每行一個 Bundle」的 NDJSON 切成多段 (依位元組範圍) 分給不同 worker
+# - 輸出 RiskAssessment NDJSON (每個任務一個 part 檔，寫完才改名)，或以 PUT transaction 分批上傳
+# - 可中斷續跑：完成的任務記在 checkpoint 檔；RiskAssessment ID 由內容 (病人、時間、數值) 決定，
+#   與檔案路徑的寫法無關，重跑 (或從別的目錄執行) 結果相同，PUT 上傳不會產生重複資料
+#
+# 用法:
+#   python backfill.py archive/ --out rescored/ --workers 4
+#   python backfill.py archive/*.ndjson --post http://127.0.0.1:8080 --batch-size 200
+#   python backfill.py --bench 20000        # 產生測試資料、比對結果並量測每核心吞吐量
+
+RISK_NAMESPACE = uuid.UUID("6f1c7a52-2f61-4c4e-9b55-3d0f1a9b8e21")
+INPUT_PATTERN = re.compile(r"\.(json|ndjson)(\.gz)?$")
+SCORE_CHUNK = 10000 # 每次批次評分的筆數
+LOOSE_MAX_GROUPS = 50000 # 散裝資源在記憶體內分組的上限
+
+# === 1. 增量 JSON 解析 ===
+_WS = re.compile(r"[ \t\n\r]*")
+_decoder = json.JSONDecoder()
+
+class _Reader:
+    """在緩衝區上用 raw_decode 一次解一個值，不夠時再從檔案讀下一塊"""
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        data = self.f.read(self.chunk_size)
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data # 丟掉已解析的部分
+        self.pos = 0
+        return True
+
+    def char(self):
+        """跳過空白後取下一個字元 (並前進)"""
+        while True:
+            self.pos = _WS.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                self.pos += 1
+                return self.buf[self.pos - 1]
+            if not self._fill():
+                return ""
+
+    def peek(self):
+        c = self.char()
+        if c:
+            self.pos -= 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = _decoder.raw_decode(self.buf, self.pos)
+                # 值剛好停在緩衝區尾端時 (例如數字) 可能還沒讀完，多讀一塊再確認
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+def iter_bundle_entries(f, chunk_size=1 << 20):
+    """逐一產生 Bundle 檔案的 entry (不把整個檔案讀進記憶體)；不是 Bundle 時不產生任何東西"""
+    reader = _Reader(f, chunk_size)
+    if reader.peek() == "\ufeff": # BOM
+        reader.char()
+    if reader.char() != "{":
+        raise ValueError("Expected a JSON object")
+    if reader.peek() == "}":
+        return
+    while True:
+        key = reader.value()
+        if reader.char() != ":":
+            raise ValueError("Expected ':'")
+        if key == "entry":
+            if reader.char() != "[":
+                raise ValueError("Bundle.entry must be an array")
+            if reader.peek() == "]":
+                reader.char()
+            else:
+                while True:
+                    yield reader.value()
+                    c = reader.char()
+                    if c == "]":
+                        break
+                    if c != ",":
+                        raise ValueError("Expected ',' or ']' in Bundle.entry")
+        else:
+            value = reader.value()
+            if key == "resourceType" and value != "Bundle":
+                return
+        c = reader.char()
+        if c == "}":
+            return
+        if c != ",":
+            raise ValueError("Expected ',' or '}'")
+
+# === 2. 取出生理數值 ===
+def unit_key(ref, when, values):
+    """評分單位的 key (RiskAssessment ID 由它產生)：只看內容，不看來源檔案的路徑或位置"""
+    return f"{ref}@{when}#" + dumps(dict(sorted(values.items()))).decode()
+
+def bundle_units(entries):
+    """
+    一個 Bundle 的 entries -> [(單位 key, 病人引用, {欄位: 數值}, 時間)]
+    同一個 Bundle 內以病人分組，每個欄位取最新的一筆；urn:uuid 引用換成 Patient/{id}
+    """
+    patients = {}
+    groups = {}
+    for entry in entries:
+        resource = entry.get("resource") or {}
+        rtype = resource.get("resourceType")
+        if rtype == "Patient":
+            url = entry.get("request", {}).get("url", "")
+            pid = resource.get("id") or (url.split("/")[1] if url.startswith("Patient/") else None)
+            if pid and entry.get("fullUrl"):
+                patients[entry["fullUrl"]] = f"Patient/{pid}"
+        elif rtype == "Observation":
+            ref = resource.get("subject", {}).get("reference")
+            if not ref:
+                continue
+            when = resource.get("effectiveDateTime") or ""
+            group = groups.setdefault(ref, [{}, {}, ""]) # 數值, 各欄位的時間, 最新時間
+            for column, value in observation_values(resource):
+                if when >= group[1].get(column, ""):
+                    group[0][column] = value
+                    group[1][column] = when
+            group[2] = max(group[2], when)
+    return [(unit_key(patients.get(ref, ref), latest, values), patients.get(ref, ref), values, latest)
+            for ref, (values, _, latest) in groups.items() if values]
+
+class _LooseGroups:
+    """
+    散裝 Observation 以 (病人, 時間) 分組，後讀到的欄位覆蓋先前的
+    記憶體內超過 max_groups 組就整批寫入暫存 SQLite 檔，最後依 (病人, 時間, 讀取順序) 排序逐組讀回
+    """
+    def __init__(self, max_groups=LOOSE_MAX_GROUPS):
+        self.max_groups = max_groups
+        self.groups = {}
+        self.db = None
+        self.db_path = None
+        self.seq = 0
+
+    def add(self, ref, when, values):
+        self.groups.setdefault((ref, when), {}).update(values)
+        if len(self.groups) > self.max_groups:
+            self._spill()
+
+    def _spill(self):
+        if self.db is None:
+            fd, self.db_path = tempfile.mkstemp(suffix=".sqlite", prefix="backfill-")
+            os.close(fd)
+            self.db = sqlite3.connect(self.db_path)
+            self.db.execute("CREATE TABLE loose (ref TEXT, t TEXT, seq INTEGER, v BLOB)")
+        self.db.executemany("INSERT INTO loose VALUES (?, ?, ?, ?)",
+                            ((ref, when, self.seq + i, dumps(values))
+                             for i, ((ref, when), values) in enumerate(self.groups.items())))
+        self.db.commit()
+        self.seq += len(self.groups)
+        self.groups.clear()
+
+    def items(self):
+        """產生 (病人, 時間, {欄位: 數值})"""
+        if self.db is None:
+            yield from ((ref, when, values) for (ref, when), values in self.groups.items())
+            return
+        try:
+            self._spill()
+            current, merged = None, {}
+            for ref, when, blob in self.db.execute("SELECT ref, t, v FROM loose ORDER BY ref, t, seq"):
+                if (ref, when) != current:
+                    if current is not None:
+                        yield current[0], current[1], merged
+                    current, merged = (ref, when), {}
+                merged.update(loads(blob))
+            if current is not None:
+                yield current[0], current[1], merged
+        finally:
+            self.db.close()
+            os.remove(self.db_path)
+            self.db = None
+
+def _open(path):
+    return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+
+def iter_units(task, max_groups=LOOSE_MAX_GROUPS):
+    """依任務類型串流讀取，產生評分單位"""
+    path, kind, start, end = task
+    if kind == "bundle":
+        with _open(path) as raw, io.TextIOWrapper(raw, encoding="utf-8") as f:
+            yield from bundle_units(iter_bundle_entries(f))
+        return
+
+    with _open(path) as f:
+        if start:
+            f.seek(start - 1)
+            f.readline() # 從下一個完整的行開始 (前一段會處理跨越 start 的那一行)
+        offset = f.tell()
+        loose = _LooseGroups(max_groups) # 散裝資源：以 (病人, 時間) 分組
+        while end is None or offset < end:
+            line = f.readline()
+            if not line:
+                break
+            offset += len(line)
+            if not line.strip():
+                continue
+            resource = loads(line)
+            if resource.get("resourceType") == "Bundle":
+                yield from bundle_units(resource.get("entry", []))
+            elif resource.get("resourceType") == "Observation":
+                ref = resource.get("subject", {}).get("reference")
+                if ref:
+                    when = resource.get("effectiveDateTime") or ""
+                    loose.add(ref, when, dict(observation_values(resource)))
+        for ref, when, values in loose.items():
+            if values:
+                yield (unit_key(ref, when, values), ref, values, when)
+
+# === 3. 任務規劃 ===
+def _first_resource_type(path):
+    with _open(path) as f:
+        for line in f:
+            if line.strip():
+                return loads(line).get("resourceType")
+    return None
+
+def plan_tasks(paths, split_bytes):
+    """
+    每個檔案一個任務；未壓縮、每行一個 Bundle 的 NDJSON 依 split_bytes 切段
+    (散裝資源的 NDJSON 要在同一個任務內分組，不切)
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, n) for n in sorted(names) if INPUT_PATTERN.search(n))
+        else:
+            files.append(path)
+
+    tasks = []
+    for path in sorted(files):
+        if ".ndjson" not in path:
+            tasks.append((path, "bundle", 0, None))
+            continue
+        size = os.path.getsize(path)
+        if path.endswith(".gz") or size <= split_bytes or _first_resource_type(path) != "Bundle":
+            tasks.append((path, "ndjson", 0, None))
+            continue
+        for start in range(0, size, split_bytes):
+            tasks.append((path, "ndjson", start, min(size, start + split_bytes)))
+    return tasks
+
+def task_key(task):
+    path, kind, start, end = task
+    return f"{os.path.abspath(path)}:{start}-{'' if end is None else end}"
+
+# === 4. 評分 (在 worker process 內執行) ===
+_client = None
+
+def _score(units):
+    """批次評分並組出 RiskAssessment 清單"""
+    if not units:
+        return []
+    cols = {c: np.full(len(units), np.nan) for c in VITAL_COLUMNS}
+    for i, (_, _, values, _) in enumerate(units):
+        for column, value in values.items():
+            cols[column][i] = value
+    status, description, _ = analyze_batch(cols)
+    out = []
+    for i, (key, ref, _, when) in enumerate(units):
+        risk_id = str(uuid.uuid5(RISK_NAMESPACE, key))
+        patient_id = ref.split("/", 1)[1] if ref.startswith("Patient/") else ref
+        risk = build_risk_bundle(patient_id, status[i], description[i], risk_id, when or None)["entry"][0]["resource"]
+        if not ref.startswith("Patient/"):
+            risk["subject"]["reference"] = ref # 找不到 Patient entry 的 urn:uuid 引用，原樣保留
+        out.append(risk)
+    return out
+
+def _post(client, risks, batch_size):
+    """以 PUT transaction 分批上傳 (ID 固定，重送不會產生重複資料)"""
+    for i in range(0, len(risks), batch_size):
+        entries = [{"fullUrl": f"urn:uuid:{r['id']}", "resource": r, # id 是 uuid5，可直接當 urn:uuid
+                    "request": {"method": "PUT", "url": f"RiskAssessment/{r['id']}"}}
+                   for r in risks[i:i + batch_size]]
+        response = client.post_bundle({"resourceType": "Bundle", "type": "transaction", "entry": entries})
+        if response.status_code not in (200, 201):
+            raise RuntimeError(f"Upload failed (HTTP {response.status_code}): {response.text[:200]}")
+
+def run_task(task, out_dir=None, post_url=None, batch_size=100):
+    """處理一個任務，回傳 (key, 單位數, 秒數)"""
+    global _client
+    t0 = time.perf_counter()
+    key = task_key(task)
+    part_path = None
+    part = None
+    if out_dir:
+        part_path = os.path.join(out_dir, f"part-{hashlib.sha1(key.encode()).hexdigest()[:16]}.ndjson")
+        part = open(part_path + ".tmp", "wb")
+    if post_url and _client is None:
+        from fhir_client import FHIRClient
+        _client = FHIRClient(post_url, max_in_flight=1)
+
+    count = 0
+    try:
+        units = []
+        for unit in iter_units(task):
+            units.append(unit)
+            if len(units) >= SCORE_CHUNK:
+                count += _flush(units, part, batch_size)
+                units = []
+        count += _flush(units, part, batch_size)
+        if part is not None:
+            part.close()
+            os.replace(part_path + ".tmp", part_path)
+    finally:
+        if part is not None and not part.closed:
+            part.close()
+    return key, count, time.perf_counter() - t0
+
+def _flush(units, part, batch_size):
+    risks = _score(units)
+    if part is not None:
+        part.write(b"".join(dumps(r) + b"\n" for r in risks))
+    if _client is not None:
+        _post(_client, risks, batch_size)
+    return len(risks)
+
+# === 5. Checkpoint ===
+def rules_hash():
+    with open(DEFAULT_RULES_PATH, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def load_checkpoint(path, fresh):
+    """回傳已完成的任務 key；規則改過或指定 --fresh 時重新開始"""
+    current = rules_hash()
+    if fresh or not os.path.exists(path):
+        with open(path, "wb") as f:
+            f.write(dumps({"rules": current}) + b"\n")
+        return set()
+    done = set()
+    with open(path, "rb") as f:
+        header = loads(f.readline() or b"{}")
+        if header.get("rules") != current:
+            raise SystemExit(f"{path} was written with a different rules.json; use --fresh to start over")
+        for line in f:
+            try:
+                done.add(loads(line)["task"])
+            except (ValueError, KeyError):
+                break # 中斷時寫到一半的最後一行
+    return done
+
+def run(paths, out_dir=None, post_url=None, workers=None, batch_size=100, checkpoint=None,
+        fresh=False, split_bytes=64 << 20, quiet=False):
+    """回傳統計結果 (bundles/s 與每核心 bundles/s)"""
+    workers = workers or os.cpu_count() or 1
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    checkpoint = checkpoint or os.path.join(out_dir or ".", "backfill.checkpoint")
+    done = load_checkpoint(checkpoint, fresh)
+    skipped = len(done)
+    tasks = [t for t in plan_tasks(paths, split_bytes) if task_key(t) not in done]
+
+    t0 = time.perf_counter()
+    total, busy, failed = 0, 0.0, []
+    with open(checkpoint, "ab") as ckpt, ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_task, t, out_dir, post_url, batch_size): t for t in tasks}
+        for future in as_completed(futures):
+            try:
+                key, count, seconds = future.result()
+            except Exception as e:
+                failed.append((futures[future], e))
+                if not quiet:
+                    print(f"FAILED {futures[future][0]}: {e}", file=sys.stderr)
+                continue
+            ckpt.write(dumps({"task": key, "bundles": count, "seconds": round(seconds, 3)}) + b"\n")
+            ckpt.flush()
+            os.fsync(ckpt.fileno())
+            total += count
+            busy += seconds
+            if not quiet:
+                print(f"{len(done) + 1}/{len(done) + len(tasks)} {futures[future][0]}: {count} bundles")
+            done.add(key)
+    elapsed = time.perf_counter() - t0
+    return {"tasks": len(tasks), "skipped": skipped, "failed": len(failed),
+            "bundles": total, "workers": workers, "elapsed_s": elapsed,
+            "bundles_per_s": total / elapsed if elapsed else 0.0,
+            "bundles_per_s_per_core": total / busy if busy else 0.0}
+
+def print_report(result):
+    print(f"{result['bundles']} bundles in {result['elapsed_s']:.2f}s with {result['workers']} worker(s): "
+          f"{result['bundles_per_s']:.0f} bundles/s, {result['bundles_per_s_per_core']:.0f} bundles/s per core "
+          f"| tasks {result['tasks']} (skipped {result['skipped']}, failed {result['failed']})")
+
+def _bench(n):
+    """產生 n 個 Bundle 的測試資料，比對評分結果，並以不同 worker 數量測吞吐量"""
+    import random
+    import shutil
+    from fhir_gateway import create_raw_data_bundle
+    from ai_engine import analyze_and_create_report
+
+    tmp = tempfile.mkdtemp()
+    src = os.path.join(tmp, "archive")
+    os.makedirs(src)
+    rng = random.Random(0)
+    expected = {}
+    with open(os.path.join(src, "bundles.ndjson"), "wb") as f:
+        for i in range(n):
+            v = {"hr": rng.randint(30, 200), "spo2": rng.randint(75, 100), "hrv": rng.randint(10, 100),
+                 "stress": rng.randint(0, 100), "sys_bp": rng.randint(90, 200), "dia_bp": 70,
+                 "resp": 16, "sleep": rng.randint(2, 9)}
+            bundle, pid, _ = create_raw_data_bundle(f"B{i}", "Bench", v["hr"], v["spo2"], v["sys_bp"], v["dia_bp"],
+                                                    v["resp"], v["hrv"], v["stress"], v["sleep"], 25.0, 121.0)
+            expected[pid] = analyze_and_create_report(v, pid)[1]
+            f.write(dumps(bundle) + b"\n")
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), "FHIR_json", "Bundle.json"), src)
+
+    # 正確性：每位病人的狀態與即時路徑 (analyze_and_create_report) 相同，切段與否結果一致
+    out = os.path.join(tmp, "out")
+    result = run([src], out, workers=1, fresh=True, split_bytes=1 << 20, quiet=True)
+    risks = [loads(line) for name in os.listdir(out) if name.endswith(".ndjson")
+             for line in open(os.path.join(out, name), "rb")]
+    by_patient = {r["subject"]["reference"].split("/")[-1]: r for r in risks}
+    assert len(risks) == n + 1 and "12345" in by_patient
+    code_to_status = {"critical": "emergency", "high": "preventive", "low": "normal"}
+    for pid, status in expected.items():
+        assert code_to_status[by_patient[pid]["prediction"][0]["qualitativeRisk"]["coding"][0]["code"]] == status
+    ids = {r["id"] for r in risks}
+
+    # 續跑：checkpoint 內的任務全部略過；ID 固定
+    again = run([src], out, workers=1, split_bytes=1 << 20, quiet=True)
+    assert again["tasks"] == 0 and again["bundles"] == 0
+    shutil.rmtree(out)
+    run([src], out, workers=1, fresh=True, split_bytes=256 << 20, quiet=True)
+    assert {loads(line)["id"] for name in os.listdir(out) if name.endswith(".ndjson")
+            for line in open(os.path.join(out, name), "rb")} == ids
+    # 同一份資料用相對路徑執行，ID 也要相同 (PUT 上傳才不會重複)
+    shutil.rmtree(out)
+    run([os.path.relpath(src)], out, workers=1, fresh=True, split_bytes=1 << 20, quiet=True)
+    assert {loads(line)["id"] for name in os.listdir(out) if name.endswith(".ndjson")
+            for line in open(os.path.join(out, name), "rb")} == ids
+
+    # 散裝資源 NDJSON：分組超過上限時暫存到磁碟，結果與全部放在記憶體相同
+    loose_path = os.path.join(tmp, "loose.ndjson")
+    with open(loose_path, "wb") as f:
+        for i in range(2000):
+            bundle = create_raw_data_bundle(f"L{i % 300}", "Loose", 60 + i % 90, 95, 120, 80, 16, 50, 20, 7,
+                                            25.0, 121.0)[0]
+            for entry in bundle["entry"]:
+                if entry["resource"]["resourceType"] == "Observation":
+                    f.write(dumps(entry["resource"]) + b"\n")
+    task = (loose_path, "ndjson", 0, None)
+    in_memory = sorted(iter_units(task))
+    assert in_memory and sorted(iter_units(task, max_groups=50)) == in_memory
+    print(f"Parity OK: {n + 1} bundles, resume skips finished tasks, IDs stable across splits and path spellings, "
+          f"{len(in_memory)} loose groups identical when spilled to disk")
+
+    for workers in sorted({1, 2, os.cpu_count() or 1}):
+        shutil.rmtree(out)
+        print_report(run([src], out, workers=workers, fresh=True, split_bytes=max(1 << 20, n * 60), quiet=True))
+    shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rescore archived FHIR bundles with the current rules.json")
+    parser.add_argument("inputs", nargs="*", help="*.json / *.ndjson (.gz) 檔案或資料夾")
+    parser.add_argument("--out", help="RiskAssessment NDJSON 輸出資料夾")
+    parser.add_argument("--post", help="直接上傳到這個 FHIR 伺服器")
+    parser.add_argument("--batch-size", type=int, default=100, help="每個上傳 transaction 的 RiskAssessment 數")
+    parser.add_argument("--workers", type=int, default=None, help="process 數 (預設 CPU 核心數)")
+    parser.add_argument("--checkpoint", help="checkpoint 檔 (預設 <out>/backfill.checkpoint)")
+    parser.add_argument("--fresh", action="store_true", help="忽略 checkpoint 從頭開始")
+    parser.add_argument("--split-mb", type=int, default=64, help="大型 NDJSON 每段大小 (MB)")
+    parser.add_argument("--bench", type=int, metavar="N", help="產生 N 個測試 Bundle 並量測吞吐量")
+    args = parser.parse_args()
+
+    if args.bench:
+        _bench(args.bench)
+        sys.exit(0)
+    if not args.inputs or not (args.out or args.post):
+        parser.error("need inputs and at least one of --out / --post")
+    result = run(args.inputs, args.out, args.post, args.workers, args.batch_size, args.checkpoint,
+                 args.fresh, args.split_mb << 20)
+    print_report(result)
+    sys.exit(1 if result["failed"] else 0)
@@ -0,0 +1,57 @@
+import json
+import math
+
+# 有安裝 orjson 就用它 (快數倍)，否則退回標準函式庫
+# 兩邊輸出格式一致：無空白、非 ASCII 直接輸出 UTF-8、numpy 純量 / 陣列照常輸出、NaN / Infinity 輸出 null
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _numpy_value(obj):
+    """與 orjson 的 OPT_SERIALIZE_NUMPY 相同：numpy 純量 / 陣列轉成 Python 值"""
+    if type(obj).__module__ == "numpy" and hasattr(obj, "tolist"):
+        return obj.tolist()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+def _finite(obj):
+    """把 NaN / ±Infinity 換成 None (含 numpy 值)，其餘原樣"""
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {k: _finite(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_finite(v) for v in obj]
+    if type(obj).__module__ == "numpy" and hasattr(obj, "tolist"):
+        return _finite(obj.tolist())
+    return obj
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), allow_nan=False, default=_numpy_value)
+
+def _std_dumps(obj):
+    """標準函式庫版本 (沒有 orjson 時使用)"""
+    try:
+        return _encoder.encode(obj).encode("utf-8")
+    except ValueError: # 含 NaN / Infinity：與 orjson 一樣輸出 null
+        return _encoder.encode(_finite(obj)).encode("utf-8")
+
+if orjson is not None:
+    def dumps(obj):
+        """序列化成 UTF-8 bytes"""
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    loads = orjson.loads
+else:
+    dumps = _std_dumps
+    loads = json.loads
+
+# 測試區
+if __name__ == "__main__":
+    import numpy as np
+
+    sample = {"hr": np.int64(72), "spo2": np.float32(97.5), "bp": np.array([120, 80]), "x": float("nan"),
+              "y": np.float64("inf"), "z": [np.nan, 1.5], "name": "王小美", "ok": True, "none": None}
+    expected = '{"hr":72,"spo2":97.5,"bp":[120,80],"x":null,"y":null,"z":[null,1.5],"name":"王小美","ok":true,"none":null}'
+    assert _std_dumps(sample) == expected.encode(), _std_dumps(sample)
+    assert dumps(sample) == expected.encode(), dumps(sample)
+    print("fast_json: stdlib fallback matches" + (" orjson" if orjson is not None else " (orjson not installed)"))
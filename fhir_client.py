@@ -0,0 +1,507 @@
+import gzip
+import time
+import random
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.exceptions import NewConnectionError
+
+import metrics
+from fast_json import dumps, loads
+
+# 可重試的 HTTP 狀態：伺服器忙碌 (429) 或暫時性錯誤 (5xx)
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# 不可重播的寫入 (一般 POST) 只在伺服器明確表示「還沒處理、稍後再來」時重試 (且要有 Retry-After)
+RETRY_STATUS_UNSAFE = {429, 503}
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """整體期限 (含所有重試) 已用完"""
+
+class BatchResponse:
+    """
+    合併送出後，切回給單一呼叫端的結果 (fhir_outbox 用)
+    介面刻意模仿 requests.Response (status_code / text / json())，讓 send_bundle 的錯誤處理不用改
+    """
+    def __init__(self, status_code, entries, text=None):
+        self.status_code = status_code
+        self.entries = entries # 伺服器 transaction-response 中屬於這個呼叫端的 entry
+        self.text = text if text is not None else dumps({
+            "resourceType": "Bundle", "type": "transaction-response", "entry": entries
+        }).decode("utf-8")
+
+    def json(self):
+        return loads(self.text)
+
+def entry_status(entry):
+    """transaction-response entry 的 response.status 形如 "201 Created"，回傳數字 (無法解析時為 0)"""
+    status = entry.get("response", {}).get("status", "")
+    code = status.split(" ", 1)[0]
+    return int(code) if code.isdigit() else 0
+
+# 每個伺服器的傳輸設定 (get_client 建立 Client 時套用，可用 configure() 覆寫)
+# 伺服器是否接受 gzip 請求內容要先確認過才打開；回應的 gzip 由 requests 自動協商與解壓
+SERVER_PROFILES = {
+    "https://hapi.fhir.org/baseR4": {"prefer_minimal": True, "cache_size": 256},
+}
+
+def configure(base_url, **options):
+    """設定某個伺服器的傳輸選項 (gzip_requests / prefer_minimal / cache_size / cache_max_age ...)"""
+    SERVER_PROFILES[base_url.rstrip("/")] = dict(SERVER_PROFILES.get(base_url.rstrip("/"), {}), **options)
+
+def _last_updated_bound(params):
+    """搜尋條件 _lastUpdated=ge/gt{時間} 的下限 (沒有就回傳 None)"""
+    for name, values in params:
+        if name != "_lastUpdated":
+            continue
+        for value in values:
+            for prefix in ("ge", "gt"):
+                if value.startswith(prefix):
+                    return value[len(prefix):]
+    return None
+
+def _cache_params(params):
+    """
+    搜尋參數 → 可雜湊、可排序的快取鍵：每個值都轉成字串 tuple
+    (dict 的 list 值如 {"_include": [...]}，或重複鍵的 [(name, value), ...] 都適用)
+    """
+    items = params.items() if isinstance(params, dict) else params or ()
+    return tuple(sorted((name, tuple(str(v) for v in value) if isinstance(value, (list, tuple)) else (str(value),))
+                        for name, value in items))
+
+def _replay_safe(bundle):
+    """
+    Transaction 每個 entry 都能安全重送 (conditional create / PUT / DELETE / GET) 時回傳 True：
+    伺服器就算已經處理過第一次，重送也不會產生重複資源 (fhir_outbox.make_idempotent 會補上 ifNoneExist)
+    """
+    if not isinstance(bundle, dict):
+        return False # 已序列化的 bytes 看不到內容，當成不可重送
+    for entry in bundle.get("entry", []):
+        request = entry.get("request", {})
+        if request.get("method") in ("POST", "PATCH") and not request.get("ifNoneExist"):
+            return False
+    return True
+
+def _connect_failed(exc):
+    """請求確定沒送到伺服器 (連線建立失敗)；讀取逾時或中途斷線則不確定伺服器有沒有處理"""
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(exc.args[0], "reason", None) if exc.args else None
+    return isinstance(exc, requests.exceptions.ConnectionError) and isinstance(reason, NewConnectionError)
+
+class _CachedResponse:
+    """ETag 快取的一筆：驗證碼 + 回應內容 (以及失效判斷需要的 resourceType / id / 時間)"""
+    __slots__ = ("etag", "headers", "body", "stored", "rtype", "rid", "last_updated", "bound")
+
+    def response(self, url):
+        response = requests.Response()
+        response.status_code = 200
+        response.headers = CaseInsensitiveDict(self.headers)
+        response._content = self.body
+        response.url = url
+        response.encoding = "utf-8"
+        response.from_cache = True
+        return response
+
+class ResponseCache:
+    """
+    GET / 搜尋的 ETag 快取 (LRU)：
+    - 每次都帶 If-None-Match 重新驗證，伺服器回 304 就直接用快取內容 (不必再傳一次整份資源)
+    - max_age > 0 時，剛存入 max_age 秒內的結果直接回傳 (完全不發請求)；
+      這段期間靠本機寫入來失效：寫入某資源會清掉它的讀取快取與同類型的搜尋，
+      但搜尋條件有 _lastUpdated=ge{T} 而寫入時間早於 T 的，不受影響
+    """
+    def __init__(self, maxsize=256, max_age=0):
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self._data = OrderedDict() # (path, 排序後的參數) -> _CachedResponse
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data.move_to_end(key)
+            return entry
+
+    def fresh(self, entry):
+        return self.max_age > 0 and time.monotonic() - entry.stored < self.max_age
+
+    def put(self, key, response):
+        path, params = key
+        parts = path.strip("/").split("/")
+        entry = _CachedResponse()
+        entry.etag = response.headers["ETag"]
+        entry.headers = dict(response.headers)
+        entry.headers.pop("Content-Encoding", None) # 內容已經解壓
+        entry.body = response.content
+        entry.stored = time.monotonic()
+        entry.rtype = parts[0]
+        entry.rid = parts[1] if len(parts) > 1 else None
+        entry.last_updated = None
+        if entry.rid is not None:
+            try:
+                entry.last_updated = loads(entry.body).get("meta", {}).get("lastUpdated")
+            except ValueError:
+                pass
+        entry.bound = _last_updated_bound(params)
+        with self._lock:
+            self._data[key] = entry
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, rtype, rid=None, last_modified=None):
+        """資源 rtype/rid 在 last_modified 被寫入：清掉可能因此過期的快取"""
+        with self._lock:
+            for key in [k for k, e in self._data.items() if e.rtype == rtype]:
+                entry = self._data[key]
+                if last_modified is not None:
+                    if entry.rid is not None and entry.last_updated and entry.last_updated >= last_modified:
+                        continue # 快取的版本已經比這次寫入新
+                    if entry.rid is None and entry.bound and last_modified < entry.bound:
+                        continue # 搜尋只看 bound 之後的資料
+                if entry.rid is None or rid is None or entry.rid == rid:
+                    del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class FHIRClient:
+    """
+    共用的 FHIR 傳輸層：
+    - requests.Session + 連線池 (keep-alive，省去每次 TCP/TLS 握手)
+    - ThreadPoolExecutor 限制同時在途 (in-flight) 的請求數
+    - 429/5xx 以 jitter 指數退避重試，並遵守 Retry-After；
+      不可重播的 POST 只在連線建立失敗或 429/503 + Retry-After 時重試 (見 _send)
+    - 每個請求都有整體期限 (deadline)，重試不會超過它
+    - gzip_requests: 大於 gzip_min_bytes 的請求內容以 gzip 壓縮 (Content-Encoding: gzip)
+    - accept_gzip: 回應接受 gzip (requests 預設就會協商並自動解壓；設 False 則要求不壓縮)
+    - prefer_minimal: 寫入時帶 Prefer: return=minimal，伺服器不必把整份資源送回來
+    - cache_size > 0: GET / 搜尋的 ETag 快取 (見 ResponseCache)
+    """
+    def __init__(self, base_url, pool_size=32, max_in_flight=16, max_pending=1024,
+                 max_retries=3, backoff_base=0.2, backoff_cap=5.0,
+                 connect_timeout=3.05, read_timeout=10, deadline=20,
+                 gzip_requests=False, gzip_min_bytes=1024, gzip_level=6, accept_gzip=True, prefer_minimal=False,
+                 cache_size=0, cache_max_age=0):
+        self.base_url = base_url.rstrip("/")
+        self.gzip_requests = gzip_requests
+        self.gzip_min_bytes = gzip_min_bytes
+        self.gzip_level = gzip_level
+        self.prefer_minimal = prefer_minimal
+        self.cache = ResponseCache(cache_size, cache_max_age) if cache_size else None
+        self._stats_lock = threading.Lock()
+        self.io = {"requests": 0, "bundles": 0, "bytes_out": 0, "bytes_out_raw": 0, "bytes_in": 0,
+                   "cache_hits": 0, "cache_misses": 0}
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "Content-Type": "application/fhir+json",
+            "Accept": "application/fhir+json",
+        })
+        if not accept_gzip:
+            self.session.headers["Accept-Encoding"] = "identity"
+
+        # 在途上限 = worker 數；排隊上限由 semaphore 控制 (滿了就讓呼叫端等待，形成背壓)
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="fhir")
+        self._pending = threading.BoundedSemaphore(max_pending)
+
+    def _count(self, **values):
+        with self._stats_lock:
+            for key, value in values.items():
+                self.io[key] += value
+
+    def io_stats(self):
+        """傳輸量統計：每個 Bundle 實際送出的 bytes、壓縮比、ETag 快取命中率"""
+        with self._stats_lock:
+            out = dict(self.io)
+        lookups = out["cache_hits"] + out["cache_misses"]
+        out["bytes_per_bundle"] = out["bytes_out"] / out["bundles"] if out["bundles"] else None
+        out["compression"] = out["bytes_out"] / out["bytes_out_raw"] if out["bytes_out_raw"] else None
+        out["cache_hit_rate"] = out["cache_hits"] / lookups if lookups else None
+        return out
+
+    # --- 同步呼叫 ---
+    def request(self, method, path="", body=None, headers=None, params=None, deadline=None, idempotent=None):
+        """
+        送出一個請求 (含重試)，回傳 requests.Response
+        body 可以是 dict (以 fast_json 轉成 JSON bytes) 或已序列化好的 bytes
+        GET 有開快取時，命中的回應會帶 response.from_cache = True
+        idempotent: 重送是否安全；沒給時 POST / PATCH 視為不安全，其他方法視為安全
+        """
+        if idempotent is None:
+            idempotent = method not in ("POST", "PATCH")
+        url = f"{self.base_url}/{path.lstrip('/')}" if path else self.base_url
+        if body is None or isinstance(body, (bytes, str)):
+            data = body
+        else:
+            with metrics.timer("transport.serialize"):
+                data = metrics.dumps_bundle(body)
+        if isinstance(body, bytes):
+            metrics.incr("bytes_sent", len(body), resource_type="Bundle")
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        headers = dict(headers or {})
+        raw_size = len(data) if data else 0
+        if data and self.gzip_requests and raw_size >= self.gzip_min_bytes:
+            with metrics.timer("transport.gzip"):
+                data = gzip.compress(data, self.gzip_level)
+            headers["Content-Encoding"] = "gzip"
+        if method in ("POST", "PUT", "PATCH") and self.prefer_minimal:
+            headers.setdefault("Prefer", "return=minimal")
+
+        key = entry = None
+        if method == "GET" and self.cache is not None:
+            key = (path.strip("/"), _cache_params(params))
+            entry = self.cache.get(key)
+            if entry is not None:
+                if self.cache.fresh(entry):
+                    self._count(cache_hits=1)
+                    metrics.incr("http_cache", outcome="fresh")
+                    return entry.response(url)
+                headers["If-None-Match"] = entry.etag
+
+        response = self._send(method, url, data, headers, params, deadline, idempotent)
+        wire_in = response.headers.get("Content-Length")
+        self._count(requests=1, bytes_out=len(data) if data else 0, bytes_out_raw=raw_size,
+                    bytes_in=int(wire_in) if wire_in and wire_in.isdigit() else len(response.content))
+        if data:
+            metrics.incr("bytes_sent_wire", len(data))
+
+        if key is not None:
+            if response.status_code == 304 and entry is not None:
+                self._count(cache_hits=1)
+                metrics.incr("http_cache", outcome="not_modified")
+                response.close()
+                return entry.response(url)
+            self._count(cache_misses=1)
+            metrics.incr("http_cache", outcome="miss")
+            if response.status_code == 200 and response.headers.get("ETag"):
+                self.cache.put(key, response)
+        elif self.cache is not None and method != "GET" and 200 <= response.status_code < 300:
+            self._invalidate(path, body, response)
+        return response
+
+    def _invalidate(self, path, body, response):
+        """本機寫入成功後，清掉可能因此過期的讀取快取 (依伺服器回傳的 location / lastModified)"""
+        locations = []
+        try:
+            result = response.json() if response.content else {}
+        except ValueError:
+            result = {}
+        for entry in result.get("entry", []) if result.get("resourceType") == "Bundle" else []:
+            res = entry.get("response", {})
+            locations.append((res.get("location", ""), res.get("lastModified")))
+        if response.headers.get("Location"):
+            locations.append((response.headers["Location"].replace(self.base_url + "/", ""), None))
+        if not locations:
+            if path.strip("/"):
+                locations.append((path.strip("/"), None))
+            elif isinstance(body, dict):
+                locations = [(e.get("resource", {}).get("resourceType", ""), None) for e in body.get("entry", [])]
+            else:
+                self.cache.clear() # 不知道寫了什麼，全部作廢
+                return
+        for location, last_modified in locations:
+            parts = location.split("/")
+            if parts[0]:
+                self.cache.invalidate(parts[0], parts[1] if len(parts) > 1 else None, last_modified)
+
+    def _send(self, method, url, data, headers, params, deadline, idempotent=True):
+        """
+        重試規則：
+        - idempotent：連線錯誤、逾時與 RETRY_STATUS 都重試
+        - 否則 (一般 POST)：伺服器可能已經寫入，只在連線建立失敗，或 429/503 且有 Retry-After 時重試
+        """
+        end = time.monotonic() + (deadline if deadline is not None else self.deadline)
+
+        attempt = 0
+        while True:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceeded(f"{method} {url}: deadline exceeded after {attempt} attempt(s)")
+            timeout = (min(self.connect_timeout, remaining), min(self.read_timeout, remaining))
+            try:
+                with metrics.timer("transport.http"):
+                    response = self.session.request(method, url, data=data, headers=headers,
+                                                    params=params, timeout=timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= self.max_retries or not (idempotent or _connect_failed(e)):
+                    raise
+                response = None
+
+            if response is not None:
+                if idempotent:
+                    retry = response.status_code in RETRY_STATUS
+                else:
+                    retry = response.status_code in RETRY_STATUS_UNSAFE and "Retry-After" in response.headers
+                if not retry or attempt >= self.max_retries:
+                    return response
+
+            # 退避：full jitter，若伺服器有給 Retry-After 就以它為下限
+            wait = random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+            if response is not None:
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    wait = max(wait, float(retry_after))
+            if time.monotonic() + wait >= end:
+                if response is not None:
+                    return response # 沒時間再試了，交回最後一次的回應
+                raise DeadlineExceeded(f"{method} {url}: deadline exceeded after {attempt + 1} attempt(s)")
+            if response is not None:
+                response.close() # 釋放連線回連線池
+            metrics.incr("http_retries")
+            time.sleep(wait)
+            attempt += 1
+
+    def post_bundle(self, bundle, deadline=None, headers=None):
+        """把 Transaction Bundle POST 到伺服器根目錄 (全部 entry 都可重播時才會在讀取逾時 / 5xx 後重試)"""
+        self._count(bundles=1)
+        return self.request("POST", "", body=bundle, headers=headers, deadline=deadline,
+                            idempotent=_replay_safe(bundle))
+
+    # --- 非同步呼叫 (Future) ---
+    def submit(self, method, path="", body=None, headers=None, params=None, deadline=None, idempotent=None):
+        """排入執行緒池，回傳 concurrent.futures.Future"""
+        self._pending.acquire()
+        try:
+            future = self.executor.submit(self.request, method, path, body, headers, params, deadline, idempotent)
+        except BaseException:
+            self._pending.release()
+            raise
+        future.add_done_callback(lambda _: self._pending.release())
+        return future
+
+    def submit_bundle(self, bundle, deadline=None, headers=None):
+        return self.submit("POST", "", body=bundle, headers=headers, deadline=deadline,
+                           idempotent=_replay_safe(bundle))
+
+    def post_many(self, bundles, deadline=None):
+        """同時送出多個 Bundle，依輸入順序回傳 Response (或 Exception)"""
+        futures = [self.submit_bundle(b, deadline=deadline) for b in bundles]
+        results = []
+        for f in futures:
+            try:
+                results.append(f.result())
+            except requests.exceptions.RequestException as e:
+                results.append(e)
+        return results
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+# --- 每個伺服器 URL 共用一個 Client (Streamlit 重跑頁面時也不會重建連線池) ---
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(base_url, **options):
+    with _clients_lock:
+        client = _clients.get(base_url)
+        if client is None:
+            client = FHIRClient(base_url, **dict(SERVER_PROFILES.get(base_url.rstrip("/"), {}), **options))
+            _clients[base_url] = client
+        return client
+
+# 測試區
+if __name__ == "__main__":
+    import sys
+
+    # 用法: python fhir_client.py [伺服器URL] [Bundle 數量]
+    #       python fhir_client.py --bench [Bundle 數量]   (本地替身伺服器：原始傳輸 vs gzip / return=minimal / ETag 快取)
+    if len(sys.argv) > 1 and sys.argv[1] == "--bench":
+        from fhir_stub import StubServer
+        from fhir_gateway import create_raw_data_bundle, ChangeDetector
+
+        n = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+        polls = 50
+        profiles = {
+            "baseline": {"accept_gzip": False},
+            "optimized": {"gzip_requests": True, "prefer_minimal": True, "cache_size": 256},
+        }
+        for name, options in profiles.items():
+            stub = StubServer().start()
+            client = FHIRClient(stub.url, **options)
+            for i in range(n):
+                bundle = create_raw_data_bundle(f"B{i % 20}", "Bench", 70 + i % 30, 97, 118, 76, 16, 50, 20, 7,
+                                                25.03, 121.56, detector=ChangeDetector())[0]
+                assert client.post_bundle(bundle).status_code == 200
+            upload = client.io_stats()
+            upload_from_server = stub.stats["bytes_out"]
+
+            # 分流輪詢：watermark 之後沒有新資料 (與 fhir_triage 的增量同步相同的查詢)
+            mark = max(r["meta"]["lastUpdated"] for r in stub.store.resources["Observation"].values())
+            params = {"_lastUpdated": f"ge{mark}", "_sort": "_lastUpdated", "_count": 100}
+            for _ in range(polls):
+                assert client.request("GET", "Observation", params=params).status_code == 200
+                client.request("GET", "Patient/1")
+            # 透過同一個 Client 寫入 → 快取的讀取要失效，重新取得新版本
+            patient = client.request("POST", "", body={"resourceType": "Bundle", "type": "transaction", "entry": [
+                {"resource": {"resourceType": "Patient", "name": [{"text": "Renamed"}]},
+                 "request": {"method": "PUT", "url": "Patient/1"}}]})
+            assert patient.status_code == 200
+            assert client.request("GET", "Patient/1").json()["name"][0]["text"] == "Renamed"
+            # 重複的搜尋參數 (list 值) 也能當快取鍵
+            assert client.request("GET", "Observation", params=dict(params, _include=["a", "b"])).status_code == 200
+
+            io = client.io_stats()
+            print(f"[{name}] upload: {upload['bytes_per_bundle']:,.0f} B/bundle sent "
+                  f"(raw {upload['bytes_out_raw'] / upload['bundles']:,.0f} B), "
+                  f"{upload_from_server / n:,.0f} B/bundle response; "
+                  f"{polls * 2} polls: {stub.stats['bytes_out'] - upload_from_server:,} B from server, "
+                  f"{stub.stats['not_modified']} x 304, cache hit rate {io['cache_hit_rate'] or 0:.0%}")
+            client.close()
+            stub.stop()
+
+        # 重試規則：讀取逾時後，一般 POST 不重送 (伺服器可能已寫入)，conditional create 才重送
+        from fhir_outbox import make_idempotent
+        stub = StubServer(latency=0.3).start()
+        client = FHIRClient(stub.url, read_timeout=0.1, max_retries=2, backoff_base=0.01)
+        for bundle, attempts in ((create_raw_data_bundle("R1", "Retry", 70, 97, 118, 76, 16, 50, 20, 7, 25.03, 121.56)[0], 1),
+                                 (make_idempotent(create_raw_data_bundle("R2", "Retry", 70, 97, 118, 76, 16, 50, 20, 7,
+                                                                         25.03, 121.56)[0]), 3)):
+            before = stub.stats["requests"]
+            try:
+                client.post_bundle(bundle)
+                raise AssertionError("expected a read timeout")
+            except requests.exceptions.ReadTimeout:
+                pass
+            time.sleep(0.4) # 等替身伺服器處理完最後一個請求
+            assert stub.stats["requests"] - before == attempts, (stub.stats["requests"] - before, attempts)
+        client.close()
+        stub.stop()
+        print("Retry policy OK: plain POST sent once after a read timeout, conditional bundle retried")
+        sys.exit(0)
+
+    base = sys.argv[1] if len(sys.argv) > 1 else "https://hapi.fhir.org/baseR4"
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    from fhir_gateway import create_raw_data_bundle
+    bundles = [create_raw_data_bundle(f"T{i}", "Load", 75, 98, 110, 70, 16, 50, 20, 7, 25.0, 121.0)[0]
+               for i in range(n)]
+
+    client = get_client(base)
+    t0 = time.perf_counter()
+    results = client.post_many(bundles)
+    elapsed = time.perf_counter() - t0
+    ok = sum(1 for r in results if not isinstance(r, Exception) and r.status_code in (200, 201))
+    print(f"{ok}/{n} OK in {elapsed:.2f}s ({n / elapsed:.1f} bundles/s)")
+    client.close()
@@ -1,125 +1,570 @@
+import os
 import uuid
 import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
 from datetime import datetime, timezone
 
-# 接收全套生理參數：包含基礎生命徵象 + 進階身心指標
-def create_raw_data_bundle(user_id, user_name, hr, spo2, sys_bp, dia_bp, resp, hrv, stress, sleep, lat, lon):
-    
-    # 1. 生成唯一 ID
-    patient_uuid = str(uuid.uuid4())
-    timestamp = datetime.now(timezone.utc).isoformat()
-
-    # --- 2. 建立 Patient (病人資源) ---
-    patient = {
-        "resourceType": "Patient",
-        "id": patient_uuid,
-        "identifier": [
-            {
-                "system": "http://hospital.org/id", # 模擬醫院的身分證系統
-                "value": user_id
-            }
-        ],
-        "name": [{"family": "Wang", "given": [user_name]}],
-        "gender": "unknown" # 這裡可設參數，暫時預設
-    }
+import metrics
+from fast_json import dumps, loads
 
-    observations = []
+PATIENT_ID_SYSTEM = "http://hospital.org/id" # 模擬醫院的身分證系統
 
-    # --- Helper: 快速建立 Observation 的小工具 ---
-    def make_obs(code, display, value, unit, unit_code):
-        return {
-            "resourceType": "Observation",
-            "id": str(uuid.uuid4()),
-            "status": "final",
-            "code": {
-                "coding": [{
-                    "system": "http://loinc.org", 
-                    "code": code, 
-                    "display": display
-                }]
-            },
-            "subject": {"reference": f"Patient/{patient_uuid}"},
-            "valueQuantity": {
-                "value": value,
-                "unit": unit,
-                "system": "http://unitsofmeasure.org",
-                "code": unit_code
-            },
-            "effectiveDateTime": timestamp
-        }
+class PatientIdentityCache:
+    """
+    本地病人身分快取 (LRU + TTL)
+    key: http://hospital.org/id 的 identifier 值, value: 伺服器指派的 Patient id
+    命中時上傳只需引用 Patient/{id}，不必再送一次 Patient
+    """
+    def __init__(self, maxsize=10000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict() # identifier -> (server_id, 到期時間)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-    # --- 3. 建立各項 Observation (生理數據資源) ---
-    
+    def get(self, identifier):
+        with self._lock:
+            item = self._data.get(identifier)
+            if item is None or item[1] < time.monotonic():
+                if item is not None:
+                    del self._data[identifier] # 過期
+                self.misses += 1
+                return None
+            self._data.move_to_end(identifier)
+            self.hits += 1
+            return item[0]
+
+    def put(self, identifier, server_id):
+        with self._lock:
+            self._data[identifier] = (server_id, time.monotonic() + self.ttl)
+            self._data.move_to_end(identifier)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, identifier):
+        with self._lock:
+            self._data.pop(identifier, None)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "size": len(self._data)}
+
+    # --- pickle (交接給另一個 process)：lock 不能序列化，另外重建 ---
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+patient_cache = PatientIdentityCache()
+
+def register_patient_response(user_id, response_json, cache=None):
+    """
+    從 transaction-response 取出伺服器指派的 Patient id 並寫入快取
+    (conditional create 命中既有病人時，伺服器同樣會回傳 location)
+    cache: 要寫入的 PatientIdentityCache (預設為模組共用的 patient_cache)
+    回傳 Patient id，找不到則回傳 None
+    """
+    cache = patient_cache if cache is None else cache
+    for entry in response_json.get("entry", []):
+        location = entry.get("response", {}).get("location", "")
+        if location.startswith("Patient/"):
+            server_id = location.split("/")[1] # Patient/{id}/_history/{vid}
+            cache.put(user_id, server_id)
+            return server_id
+    return None
+
+# --- 各項 Observation 的靜態定義 (LOINC 代碼 / UCUM 單位) ---
+# (參數名, LOINC code, display, unit, UCUM code)
+OBSERVATION_SPECS = [
     # [生命徵象 Vital Signs]
-    observations.append(make_obs("8867-4", "Heart rate", hr, "beats/minute", "/min"))
-    observations.append(make_obs("2708-6", "Oxygen saturation", spo2, "%", "%"))
-    observations.append(make_obs("9279-1", "Respiratory rate", resp, "breaths/minute", "/min"))
-    
+    ("hr", "8867-4", "Heart rate", "beats/minute", "/min"),
+    ("spo2", "2708-6", "Oxygen saturation", "%", "%"),
+    ("resp", "9279-1", "Respiratory rate", "breaths/minute", "/min"),
     # [進階指標 Advanced Metrics]
     # HRV (使用 LOINC 80404-7 R-R interval SD)
-    observations.append(make_obs("80404-7", "Heart rate variability (SDNN)", hrv, "ms", "ms"))
+    ("hrv", "80404-7", "Heart rate variability (SDNN)", "ms", "ms"),
     # 睡眠時間 (LOINC 9383-2)
-    observations.append(make_obs("9383-2", "Sleep duration", sleep, "h", "h"))
+    ("sleep", "9383-2", "Sleep duration", "h", "h"),
     # 壓力指數 (LOINC 70-5 General stress score)
-    observations.append(make_obs("70-5", "General stress score", stress, "score", "{score}"))
-
-    # [血壓面板 Blood Pressure Panel]
-    # 血壓比較特殊，是一個 Panel 包含收縮壓與舒張壓
-    bp_obs = {
-        "resourceType": "Observation",
-        "id": str(uuid.uuid4()),
-        "status": "final",
-        "code": {"coding": [{"system": "http://loinc.org", "code": "85354-9", "display": "Blood pressure panel"}]},
-        "subject": {"reference": f"Patient/{patient_uuid}"},
-        "effectiveDateTime": timestamp,
-        "component": [
-            {
-                "code": {"coding": [{"system": "http://loinc.org", "code": "8480-6", "display": "Systolic blood pressure"}]},
-                "valueQuantity": {"value": sys_bp, "unit": "mmHg", "system": "http://unitsofmeasure.org", "code": "mm[Hg]"}
-            },
-            {
-                "code": {"coding": [{"system": "http://loinc.org", "code": "8462-4", "display": "Diastolic blood pressure"}]},
-                "valueQuantity": {"value": dia_bp, "unit": "mmHg", "system": "http://unitsofmeasure.org", "code": "mm[Hg]"}
-            }
-        ],
-        # [定位資訊] 將 GPS 藏在 Extension 裡，供緊急救援定位用
-        "extension": [
-            {
-                "url": "http://hl7.org/fhir/StructureDefinition/geolocation", 
-                "valueAddress": {"text": f"{lat},{lon}"}
-            }
-        ]
-    }
-    observations.append(bp_obs)
+    ("stress", "70-5", "General stress score", "score", "{score}"),
+]
+BP_PANEL_CODE = "85354-9"
+# 血壓面板算一筆，所以總共 7 筆 Observation
+OBSERVATION_COUNT = len(OBSERVATION_SPECS) + 1
+
+# === 變化偵測 (Change Detection) ===
+# 穩定的病人每次上傳大多是同樣的數值 (血壓、呼吸、睡眠固定，滑桿沒動)。
+# 每位病人記住每個 LOINC 代碼最後「送出」的內容 (hash + 數值 + 時間)：
+# 內容相同或仍在死區 (deadband) 內就不再寫一筆新的 Observation；
+# 超過心跳間隔 (heartbeat) 則照樣重送，讓伺服器上的最新數值不會過舊。
+# 死區是跟上次送出的值比，不是跟上次看到的值比，所以緩慢漂移累積到門檻時仍會送出。
+
+# 每個 Observation 參與比對的欄位 (血壓面板含定位，移動超過死區也要重送)
+CHANGE_FIELDS = {code: (param,) for param, code, _, _, _ in OBSERVATION_SPECS}
+CHANGE_FIELDS[BP_PANEL_CODE] = ("sys_bp", "dia_bp", "lat", "lon")
+
+# 各參數的死區 (絕對值，差距 <= 死區視為沒變)；lat / lon 共用 geo (約 50 公尺)
+DEFAULT_DEADBANDS = {"hr": 2, "spo2": 1, "resp": 1, "hrv": 3, "stress": 3, "sleep": 0.25,
+                     "sys_bp": 3, "dia_bp": 3, "geo": 0.0005}
+_DEADBAND_KEYS = {"lat": "geo", "lon": "geo"}
+
+def _digest(code, content):
+    return hashlib.blake2b(dumps([code, content]), digest_size=8).hexdigest()
+
+class ChangeDetector:
+    """
+    每位病人 / 每個 LOINC 代碼最後送出的內容 (LRU，最多 maxsize 位病人)
+    heartbeat: 秒，內容沒變也至少這麼久重送一次
+    deadbands: 覆寫 DEFAULT_DEADBANDS，例如 {"hr": 0} 代表心率只要不同就送
+    path: 持久化檔案 (JSON)，重啟後接著用；每 save_interval 秒最多寫一次
+    """
+    def __init__(self, maxsize=10000, heartbeat=300, deadbands=None, path=None, save_interval=30):
+        self.maxsize = maxsize
+        self.heartbeat = heartbeat
+        self.deadbands = dict(DEFAULT_DEADBANDS, **(deadbands or {}))
+        self.path = path
+        self.save_interval = save_interval
+        self._data = OrderedDict() # user_id -> {LOINC: (digest, 數值 list, 送出時間)}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        self.sent = 0
+        self.skipped = 0
+        self.heartbeats = 0
+        self.evictions = 0
+
+    def _within_deadband(self, fields, content, last):
+        for field, value, prev in zip(fields, content, last):
+            if value is None or prev is None:
+                if value != prev:
+                    return False
+            elif abs(value - prev) > self.deadbands.get(_DEADBAND_KEYS.get(field, field), 0):
+                return False
+        return True
+
+    def select(self, user_id, values, now=None):
+        """
+        比對上次送出的內容，回傳這次要送出的 LOINC 代碼集合 (並直接記為已送出)
+        values: {參數名: 數值}，包含 sys_bp / dia_bp / lat / lon
+        上傳失敗時請呼叫 forget(user_id)，下次就會全部重送
+        """
+        now = time.time() if now is None else now
+        changed = set()
+        with self._lock:
+            known = self._data.get(user_id)
+            if known is None:
+                known = self._data[user_id] = {}
+            self._data.move_to_end(user_id)
+            for code, fields in CHANGE_FIELDS.items():
+                content = [values[field] for field in fields]
+                digest = _digest(code, content)
+                last = known.get(code)
+                if last is not None:
+                    same = last[0] == digest or self._within_deadband(fields, content, last[1])
+                    if same and now - last[2] < self.heartbeat:
+                        self.skipped += 1
+                        continue
+                    if same:
+                        self.heartbeats += 1
+                known[code] = (digest, content, now)
+                changed.add(code)
+                self.sent += 1
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+            self._dirty = True
+        skipped = len(CHANGE_FIELDS) - len(changed)
+        if skipped:
+            metrics.incr("observations_skipped", skipped)
+        self._maybe_save()
+        return changed
+
+    def forget(self, user_id):
+        with self._lock:
+            if self._data.pop(user_id, None) is not None:
+                self._dirty = True
 
-    # --- 4. 打包成 Transaction Bundle ---
+    def stats(self):
+        with self._lock:
+            return {"sent": self.sent, "skipped": self.skipped, "heartbeats": self.heartbeats,
+                    "evictions": self.evictions, "size": len(self._data)}
+
+    # --- pickle (交接給另一個 process)：lock 不能序列化，另外重建 ---
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    # --- 持久化 (JSON，依 LRU 順序由舊到新) ---
+    def save(self, path=None):
+        path = path or self.path
+        if not path:
+            return
+        with self._lock:
+            data = dumps({"version": 1, "patients": [[user_id, known] for user_id, known in self._data.items()]})
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path) # 寫完再換名，中途當機不會留下半個檔案
+
+    def load(self, path=None):
+        """讀回上次存的紀錄並設為持久化檔案；檔案不存在或損壞就從空的開始。回傳讀入的病人數"""
+        path = self.path = path or self.path
+        try:
+            with open(path, "rb") as f:
+                patients = loads(f.read())["patients"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return 0
+        with self._lock:
+            for user_id, known in patients[-self.maxsize:]:
+                self._data[user_id] = {code: tuple(item) for code, item in known.items()}
+                self._data.move_to_end(user_id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return len(self._data)
+
+    def _maybe_save(self):
+        if self.path and self._dirty and time.monotonic() - self._saved_at >= self.save_interval:
+            try:
+                self.save()
+            except OSError:
+                pass # 存檔失敗只會讓重啟後多送一輪，不影響這次上傳
+
+change_detector = ChangeDetector()
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+def _resolve_patient(user_id, cache=None):
+    """
+    查詢身分快取：命中就直接引用伺服器上的 Patient，不再重送
+    回傳 (病人ID, subject 引用字串, 是否需要建立 Patient)
+    """
+    server_id = (patient_cache if cache is None else cache).get(user_id)
+    if server_id:
+        return server_id, f"Patient/{server_id}", False
+    # 以 urn:uuid 暫時 ID 互相引用，伺服器寫入後會換成正式 ID
+    patient_uuid = str(uuid.uuid4())
+    return patient_uuid, f"urn:uuid:{patient_uuid}", True
+
+# --- Bundle 模板：每個 spec 的靜態區塊只建一次，每次呼叫只填入數值、ID 與時間 ---
+# code / 單位區塊在所有 Bundle 之間共用 (只會被序列化，呼叫端不可就地修改)；
+# request 區塊會被 fhir_outbox.make_idempotent 補上 ifNoneExist，所以每個 entry 各自複製一份
+_LOINC = "http://loinc.org"
+_UCUM = "http://unitsofmeasure.org"
+_OBS_TEMPLATES = [
+    (param, code, {"coding": [{"system": _LOINC, "code": code, "display": display}]},
+     {"unit": unit, "system": _UCUM, "code": unit_code})
+    for param, code, display, unit, unit_code in OBSERVATION_SPECS
+]
+_BP_PANEL = {"coding": [{"system": _LOINC, "code": BP_PANEL_CODE, "display": "Blood pressure panel"}]}
+_BP_TEMPLATES = [
+    ("sys_bp", {"coding": [{"system": _LOINC, "code": "8480-6", "display": "Systolic blood pressure"}]}),
+    ("dia_bp", {"coding": [{"system": _LOINC, "code": "8462-4", "display": "Diastolic blood pressure"}]}),
+]
+_MMHG = {"unit": "mmHg", "system": _UCUM, "code": "mm[Hg]"}
+_GEOLOCATION_URL = "http://hl7.org/fhir/StructureDefinition/geolocation"
+_OBS_REQUEST = {"method": "POST", "url": "Observation"}
+
+def _bundle_dict(user_id, user_name, patient_uuid, subject_ref, include_patient,
+                 obs_ids, timestamp, values, geo_text, codes=None):
+    """
+    依輸入組出 Transaction Bundle (dict)；不產生 ID、不讀時間 (純函式，方便比對輸出)
+    values: {參數名: 數值}，包含 sys_bp / dia_bp
+    codes: 只放入這些 LOINC 代碼的 Observation (None 代表全部)
+    """
     entries = []
-    
-    # 加入 Patient 的寫入請求
-    entries.append({
-        "fullUrl": f"urn:uuid:{patient_uuid}", 
-        "resource": patient, 
-        "request": {"method": "POST", "url": "Patient"}
-    })
-    
-    # 加入所有 Observation 的寫入請求
-    for obs in observations:
+    # 加入 Patient 的寫入請求 (conditional create：同一個 identifier 已存在就不重複建立)
+    if include_patient:
+        entries.append({
+            "fullUrl": f"urn:uuid:{patient_uuid}",
+            "resource": {
+                "resourceType": "Patient",
+                "id": patient_uuid,
+                "identifier": [{"system": PATIENT_ID_SYSTEM, "value": user_id}],
+                "name": [{"family": "Wang", "given": [user_name]}],
+                "gender": "unknown" # 這裡可設參數，暫時預設
+            },
+            "request": {"method": "POST", "url": "Patient", "ifNoneExist": f"identifier={PATIENT_ID_SYSTEM}|{user_id}"}
+        })
+
+    # 各項 Observation (生理數據資源)
+    for obs_id, (param, code, code_block, unit_block) in zip(obs_ids, _OBS_TEMPLATES):
+        if codes is not None and code not in codes:
+            continue
         entries.append({
-            "fullUrl": f"urn:uuid:{obs['id']}", 
-            "resource": obs, 
-            "request": {"method": "POST", "url": "Observation"}
+            "fullUrl": f"urn:uuid:{obs_id}",
+            "resource": {
+                "resourceType": "Observation",
+                "id": obs_id,
+                "status": "final",
+                "code": code_block,
+                "subject": {"reference": subject_ref},
+                "valueQuantity": {"value": values[param], **unit_block},
+                "effectiveDateTime": timestamp
+            },
+            "request": dict(_OBS_REQUEST)
         })
 
-    bundle = {
+    # [血壓面板 Blood Pressure Panel] 收縮壓與舒張壓放在同一筆 Panel 的 component
+    if codes is None or BP_PANEL_CODE in codes:
+        entries.append({
+            "fullUrl": f"urn:uuid:{obs_ids[-1]}",
+            "resource": {
+                "resourceType": "Observation",
+                "id": obs_ids[-1],
+                "status": "final",
+                "code": _BP_PANEL,
+                "subject": {"reference": subject_ref},
+                "effectiveDateTime": timestamp,
+                "component": [{"code": code_block, "valueQuantity": {"value": values[param], **_MMHG}}
+                              for param, code_block in _BP_TEMPLATES],
+                # [定位資訊] 將 GPS 藏在 Extension 裡，供緊急救援定位用
+                "extension": [{"url": _GEOLOCATION_URL, "valueAddress": {"text": geo_text}}]
+            },
+            "request": dict(_OBS_REQUEST)
+        })
+
+    return {
         "resourceType": "Bundle",
         "type": "transaction",
         "entry": entries
     }
+
+# 接收全套生理參數：包含基礎生命徵象 + 進階身心指標
+# detector: 傳入 ChangeDetector (例如 change_detector) 時只放入有變化的 Observation
+# cache: 身分快取 (預設為模組共用的 patient_cache；各自維護病人狀態的呼叫端，例如 ingest worker，自己傳入)
+@metrics.timed("gateway.build")
+def create_raw_data_bundle(user_id, user_name, hr, spo2, sys_bp, dia_bp, resp, hrv, stress, sleep, lat, lon,
+                           detector=None, cache=None):
     
-    # 回傳：打包好的 Bundle, 病人ID (給Session用), 第一筆數據ID (給AI追溯用)
-    return bundle, patient_uuid, observations[0]['id']
+    # 1. 生成唯一 ID (病人 ID 先查快取)
+    patient_uuid, subject_ref, include_patient = _resolve_patient(user_id, cache)
+    obs_ids = [str(uuid.uuid4()) for _ in range(OBSERVATION_COUNT)]
+    values = {"hr": hr, "spo2": spo2, "resp": resp, "hrv": hrv, "stress": stress,
+              "sleep": sleep, "sys_bp": sys_bp, "dia_bp": dia_bp}
+
+    codes = None
+    if detector is not None:
+        codes = detector.select(user_id, dict(values, lat=lat, lon=lon))
+
+    bundle = _bundle_dict(user_id, user_name, patient_uuid, subject_ref, include_patient,
+                          obs_ids, _now(), values, f"{lat},{lon}", codes)
+    if codes is not None:
+        # 第一筆「實際送出」的數據；全部沒變時為 None (Bundle 可能只剩 Patient 或完全沒有 entry)
+        sent = [e["resource"]["id"] for e in bundle["entry"] if e["resource"]["resourceType"] == "Observation"]
+        obs_ids = sent or [None]
+    
+    # 回傳：打包好的 Bundle, 病人ID (給Session用；快取未命中時為暫時 ID，
+    # 上傳後請用 register_patient_response 換成伺服器 ID), 第一筆數據ID (給AI追溯用)
+    return bundle, patient_uuid, obs_ids[0]
 
 # 測試區
 if __name__ == "__main__":
     b, pid, oid = create_raw_data_bundle("A123", "TestUser", 75, 98, 110, 70, 16, 50, 20, 7, 25.0, 121.0)
     print(json.dumps(b, indent=2))
+
+    # 模擬伺服器回應後，第二次上傳應命中快取且不含 Patient
+    register_patient_response("A123", {"entry": [{"response": {"status": "201 Created", "location": "Patient/987/_history/1"}}]})
+    b2, pid2, _ = create_raw_data_bundle("A123", "TestUser", 76, 98, 110, 70, 16, 50, 20, 7, 25.0, 121.0)
+    assert pid2 == "987" and all(e["resource"]["resourceType"] != "Patient" for e in b2["entry"])
+    print(f"Second upload: {len(b2['entry'])} entries | cache {patient_cache.stats()}")
+
+    # --- 模板 vs 原本的逐筆建立：輸出逐 byte 相同；每秒 Bundle 數、每個 Bundle 的記憶體配置 ---
+    import sys
+    import tracemalloc
+
+    def baseline_bundle_dict(user_id, user_name, patient_uuid, subject_ref, include_patient,
+                     obs_ids, timestamp, values, geo_text, codes=None):
+        """模板化之前的版本：每次呼叫重建所有 coding / 單位 dict"""
+        # --- 2. 建立 Patient (病人資源) ---
+        patient = {
+            "resourceType": "Patient",
+            "id": patient_uuid,
+            "identifier": [
+                {
+                    "system": PATIENT_ID_SYSTEM,
+                    "value": user_id
+                }
+            ],
+            "name": [{"family": "Wang", "given": [user_name]}],
+            "gender": "unknown" # 這裡可設參數，暫時預設
+        }
+
+        # --- 3. 建立各項 Observation (生理數據資源) ---
+        observations = []
+        for obs_id, (param, code, display, unit, unit_code) in zip(obs_ids, OBSERVATION_SPECS):
+            if codes is not None and code not in codes:
+                continue
+            observations.append({
+                "resourceType": "Observation",
+                "id": obs_id,
+                "status": "final",
+                "code": {
+                    "coding": [{
+                        "system": "http://loinc.org", 
+                        "code": code, 
+                        "display": display
+                    }]
+                },
+                "subject": {"reference": subject_ref},
+                "valueQuantity": {
+                    "value": values[param],
+                    "unit": unit,
+                    "system": "http://unitsofmeasure.org",
+                    "code": unit_code
+                },
+                "effectiveDateTime": timestamp
+            })
+
+        # [血壓面板 Blood Pressure Panel]
+        # 血壓比較特殊，是一個 Panel 包含收縮壓與舒張壓
+        bp_obs = {
+            "resourceType": "Observation",
+            "id": obs_ids[-1],
+            "status": "final",
+            "code": {"coding": [{"system": "http://loinc.org", "code": BP_PANEL_CODE, "display": "Blood pressure panel"}]},
+            "subject": {"reference": subject_ref},
+            "effectiveDateTime": timestamp,
+            "component": [
+                {
+                    "code": {"coding": [{"system": "http://loinc.org", "code": "8480-6", "display": "Systolic blood pressure"}]},
+                    "valueQuantity": {"value": values["sys_bp"], "unit": "mmHg", "system": "http://unitsofmeasure.org", "code": "mm[Hg]"}
+                },
+                {
+                    "code": {"coding": [{"system": "http://loinc.org", "code": "8462-4", "display": "Diastolic blood pressure"}]},
+                    "valueQuantity": {"value": values["dia_bp"], "unit": "mmHg", "system": "http://unitsofmeasure.org", "code": "mm[Hg]"}
+                }
+            ],
+            # [定位資訊] 將 GPS 藏在 Extension 裡，供緊急救援定位用
+            "extension": [
+                {
+                    "url": "http://hl7.org/fhir/StructureDefinition/geolocation", 
+                    "valueAddress": {"text": geo_text}
+                }
+            ]
+        }
+        if codes is None or BP_PANEL_CODE in codes:
+            observations.append(bp_obs)
+
+        # --- 4. 打包成 Transaction Bundle ---
+        entries = []
+        
+        # 加入 Patient 的寫入請求 (conditional create：同一個 identifier 已存在就不重複建立)
+        if include_patient:
+            entries.append({
+                "fullUrl": f"urn:uuid:{patient_uuid}", 
+                "resource": patient, 
+                "request": {
+                    "method": "POST",
+                    "url": "Patient",
+                    "ifNoneExist": f"identifier={PATIENT_ID_SYSTEM}|{user_id}"
+                }
+            })
+        
+        # 加入所有 Observation 的寫入請求
+        for obs in observations:
+            entries.append({
+                "fullUrl": f"urn:uuid:{obs['id']}", 
+                "resource": obs, 
+                "request": {"method": "POST", "url": "Observation"}
+            })
+
+        return {
+            "resourceType": "Bundle",
+            "type": "transaction",
+            "entry": entries
+        }
+
+    args = ("A123", "TestUser", str(uuid.uuid4()), "urn:uuid:x", True, [str(uuid.uuid4()) for _ in range(OBSERVATION_COUNT)],
+            _now(), {"hr": 75, "spo2": 98, "resp": 16, "hrv": 50.5, "stress": 20, "sleep": 7.25,
+                     "sys_bp": 110, "dia_bp": 70}, "25.0,121.0")
+    for include_patient, codes in ((True, None), (False, None), (False, {"8867-4", BP_PANEL_CODE}), (True, set())):
+        case = args[:4] + (include_patient,) + args[5:] + (codes,)
+        assert dumps(_bundle_dict(*case)) == dumps(baseline_bundle_dict(*case)), (include_patient, codes)
+    print("Template parity OK: byte-for-byte identical to the per-call builder")
+
+    def measure(build, n=20000):
+        t0 = time.perf_counter()
+        for _ in range(n):
+            build(*args)
+        build_rate = n / (time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        for _ in range(n):
+            dumps(build(*args))
+        rate = n / (time.perf_counter() - t0)
+        # 留著 1000 個結果，平均每個 Bundle 新配置的記憶體區塊數與 bytes
+        tracemalloc.start()
+        blocks, size = sys.getallocatedblocks(), tracemalloc.get_traced_memory()[0]
+        kept = [build(*args) for _ in range(1000)]
+        blocks = (sys.getallocatedblocks() - blocks) / len(kept)
+        size = (tracemalloc.get_traced_memory()[0] - size) / len(kept)
+        tracemalloc.stop()
+        del kept
+        return build_rate, rate, blocks, size
+
+    for label, build in (("per-call", baseline_bundle_dict), ("template", _bundle_dict)):
+        build_rate, rate, blocks, size = measure(build)
+        print(f"{label:9s}: build {build_rate:10,.0f} bundles/s | build + serialize {rate:10,.0f} bundles/s | "
+              f"{blocks:.0f} allocations, {size:,.0f} bytes per bundle")
+
+    # --- 變化偵測：穩定病人的寫入量 (每 10 秒上傳一次，共 1 小時) ---
+    import os
+    import random
+    import tempfile
+
+    rng = random.Random(0)
+    detector = ChangeDetector(heartbeat=300)
+    n_patients, n_rounds, interval = 200, 360, 10
+    full = sent = 0
+    t0 = time.perf_counter()
+    for r in range(n_rounds):
+        for p in range(n_patients):
+            # 滑桿偶爾才動；心率 / HRV 有小幅雜訊，大多落在死區內
+            hr = 75 + rng.choice((0, 0, 0, 1, -1, 2)) + (10 if r % 90 == 45 else 0)
+            b, _, _ = create_raw_data_bundle(f"P{p}", "Steady", hr, 98, 110, 70, 16, 60 + rng.randint(-2, 2), 20, 7,
+                                             25.033, 121.565, detector=detector)
+            full += OBSERVATION_COUNT
+            sent += sum(e["resource"]["resourceType"] == "Observation" for e in b["entry"])
+            # 以假時間推進，心跳才會觸發
+        for known in detector._data.values():
+            for code, (digest, content, at) in known.items():
+                known[code] = (digest, content, at - interval)
+    elapsed = time.perf_counter() - t0
+    print(f"Steady-state writes: {sent:,} / {full:,} Observations ({1 - sent / full:.1%} fewer) | "
+          f"{n_patients * n_rounds / elapsed:,.0f} bundles/s | {detector.stats()}")
+
+    # 持久化：重啟後第一輪不必全部重送
+    path = os.path.join(tempfile.mkdtemp(), "change_cache.json")
+    detector = ChangeDetector(path=path)
+    create_raw_data_bundle("P0", "Steady", 75, 98, 110, 70, 16, 60, 20, 7, 25.033, 121.565, detector=detector)
+    detector.save()
+    restored = ChangeDetector(heartbeat=300)
+    print(f"Restored {restored.load(path)} patients ({os.path.getsize(path):,} bytes)")
+    b, _, oid = create_raw_data_bundle("P0", "Steady", 75, 98, 110, 70, 16, 60, 20, 7, 25.033, 121.565, detector=restored)
+    assert oid is None and all(e["resource"]["resourceType"] != "Observation" for e in b["entry"])
+    print("First upload after restart: 0 Observations (all unchanged)")
+
+    # LRU 上限
+    small = ChangeDetector(maxsize=50)
+    for p in range(120):
+        small.select(f"P{p}", {"hr": 75, "spo2": 98, "resp": 16, "hrv": 60, "stress": 20, "sleep": 7,
+                               "sys_bp": 110, "dia_bp": 70, "lat": 25.0, "lon": 121.0})
+    assert small.stats()["size"] == 50 and small.stats()["evictions"] == 70
@@ -0,0 +1,744 @@
+import os
+import sys
+import mmap
+import time
+import uuid
+import zlib
+import struct
+import random
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+import requests
+
+import metrics
+from fast_json import dumps, loads
+from fhir_client import BatchResponse, entry_status
+
+# 離線暫存區 (Durable Outbox)：每個要送出的 Bundle 先寫入磁碟上的 append-only 日誌 (WAL)，
+# 背景 drainer 依序補送，伺服器慢或斷線時資料不會遺失，程式重啟後也會接著送。
+#
+# 目錄結構 (每個優先級一條 lane)：
+#   outbox/emergency/00000001.seg, 00000002.seg ...   日誌分段 (segment)
+#   outbox/emergency/cursor                            已送達的位置 (segment 編號, offset)
+#   outbox/urgent/...
+#   outbox/routine/...
+#   outbox/dead_letter.ndjson                          伺服器明確拒收 (4xx) 的紀錄
+#
+# 紀錄格式：[長度 4 bytes][CRC32 4 bytes][JSON payload]；
+# 重啟時若最後一筆寫到一半 (長度或 CRC 不符)，會從那裡截斷。
+#
+# 冪等 (idempotency)：寫入前替每個 entry 補上 urn:uuid fullUrl，POST 的資源再加上以 fullUrl 為值的
+# identifier 與 ifNoneExist (conditional create)；當機後重送同一筆，伺服器只會回傳既有資源，不會重複建立。
+#
+# 優先級排程：每個 Bundle 依內容分類 (classify) 到自己的 lane，每條 lane 有自己的 drainer 執行緒，
+# 所以大量的一般生理數據積壓時，急救 RiskAssessment / CPR ServiceRequest 不必排在後面等，
+# 也不會被正在送出的大批次擋住 (head-of-line blocking)。
+#
+# 順序：每條 lane 只有一個 drainer，依寫入順序送；一批送不出去就原地重送，成功前不會送後面的批次，
+# 所以同一位病人較晚的 Observation / RiskAssessment 不會比較早的先到 (跨 lane 則以優先級為準)。
+# 鎖：每條 lane 有自己的 lock，寫入、fsync 與讀日誌都只鎖自己那條，大量一般數據的 fsync 不會擋到急救寫入。
+#
+# deadline：「寫入 → 送達」的目標，超過會記在 deadline_missed (並計入 metrics)；
+# 批次最舊一筆已超過 deadline 時不再等合併，送失敗也不再指數退避 (最多等 retry_base 就重送)。
+
+LANES = ("emergency", "urgent", "routine") # 依優先順序
+# lane -> (deadline 秒, 每批最多 entry 數, 每批最多 bytes, 合併等待秒數)
+# 合併等待：批次還沒滿時，最舊一筆寫入後最多再等這麼久讓後面的紀錄併進來 (急救不等)
+LANE_CONFIG = {
+    "emergency": (2.0, 10, 256 * 1024, 0.0),
+    "urgent": (10.0, 50, 512 * 1024, 0.02),
+    "routine": (60.0, 100, 1024 * 1024, 0.05),
+}
+# RiskAssessment 的 status_type (或 qualitativeRisk 代碼) 與請求的 priority 對應到 lane
+STATUS_LANES = {"emergency": "emergency", "preventive": "urgent"}
+RISK_CODE_LANES = {"critical": "emergency", "high": "urgent"}
+PRIORITY_LANES = {"stat": "emergency", "asap": "urgent", "urgent": "urgent"}
+_HEADER = struct.Struct("<II")
+IDEMPOTENCY_SYSTEM = "urn:ietf:rfc:3986"
+
+def classify(bundle, status_type=None):
+    """
+    依 Bundle 內容決定 lane (取所有 entry 中最高的優先級)：
+    - RiskAssessment：status_type (emergency / preventive)，沒給就看 qualitativeRisk 代碼 (critical / high)
+    - ServiceRequest / CommunicationRequest：priority (stat → emergency，asap / urgent → urgent)
+    - 其他 (生理數據、Patient ...)：routine
+    """
+    best = len(LANES) - 1
+    for entry in bundle.get("entry", []):
+        resource = entry.get("resource", {})
+        rtype = resource.get("resourceType")
+        lane = None
+        if rtype == "RiskAssessment":
+            lane = STATUS_LANES.get(status_type)
+            if lane is None and status_type is None:
+                for prediction in resource.get("prediction", []):
+                    for coding in prediction.get("qualitativeRisk", {}).get("coding", []):
+                        lane = lane or RISK_CODE_LANES.get(coding.get("code"))
+        elif rtype in ("ServiceRequest", "CommunicationRequest"):
+            lane = PRIORITY_LANES.get(resource.get("priority"))
+        if lane is not None:
+            best = min(best, LANES.index(lane))
+    return LANES[best]
+
+def make_idempotent(bundle):
+    """補上 fullUrl 與 conditional create 條件 (就地修改並回傳)"""
+    for entry in bundle.get("entry", []):
+        resource = entry.get("resource", {})
+        if "fullUrl" not in entry:
+            # resource id 本身是 UUID 才沿用，否則 (例如 "obs-1") 產生新的，避免不合法的 urn:uuid
+            try:
+                value = uuid.UUID(resource.get("id") or "")
+            except ValueError:
+                value = uuid.uuid4()
+            entry["fullUrl"] = f"urn:uuid:{value}"
+        request = entry.get("request", {})
+        if request.get("method") == "POST" and "ifNoneExist" not in request:
+            resource.setdefault("identifier", []).append({"system": IDEMPOTENCY_SYSTEM, "value": entry["fullUrl"]})
+            request["ifNoneExist"] = f"identifier={IDEMPOTENCY_SYSTEM}|{entry['fullUrl']}"
+    return bundle
+
+def coalesce(bundles):
+    """
+    把多個 transaction Bundle 的 entry 合併成一個 transaction：
+    相同 (resourceType, ifNoneExist) 的 conditional create 只留第一個 (例如每個 gateway Bundle 都帶的同一位 Patient；
+    伺服器不接受同一個 transaction 內有兩個相同條件)，後面那些 fullUrl 的引用改指向留下來的 entry
+    回傳 (entries, slots)：slots[i] 為第 i 個 Bundle 各 entry 在 transaction-response 中的位置
+    """
+    entries, slots, kept, aliases = [], [], {}, {}
+    for bundle in bundles:
+        mine = []
+        for entry in bundle.get("entry", []):
+            request = entry.get("request", {})
+            key = None
+            if request.get("method") == "POST" and request.get("ifNoneExist"):
+                key = (entry.get("resource", {}).get("resourceType"), request["ifNoneExist"])
+            if key in kept:
+                index = kept[key]
+                if entry.get("fullUrl") and entries[index].get("fullUrl"):
+                    aliases[entry["fullUrl"]] = entries[index]["fullUrl"]
+                mine.append(index)
+                continue
+            if key is not None:
+                kept[key] = len(entries)
+            mine.append(len(entries))
+            entries.append(entry)
+        slots.append(mine)
+    if aliases:
+        entries = [_alias_refs(entry, aliases) for entry in entries]
+    return entries, slots
+
+def _alias_refs(obj, aliases):
+    """回傳把 reference 依 aliases 改寫後的副本"""
+    if isinstance(obj, dict):
+        return {k: aliases.get(v, v) if k == "reference" and isinstance(v, str) else _alias_refs(v, aliases)
+                for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_alias_refs(v, aliases) for v in obj]
+    return obj
+
+def request_id(bundle):
+    """Bundle 的請求 ID：第一個 entry 的資源 ID (沒有就用 fullUrl 的 UUID)，供 metrics.arm_profile 指定"""
+    entries = bundle.get("entry") or [{}]
+    return entries[0].get("resource", {}).get("id") or entries[0].get("fullUrl", "").replace("urn:uuid:", "")
+
+class _Lane:
+    """單一優先級的分段日誌 + 已送達游標"""
+    def __init__(self, path, segment_bytes, use_mmap, deadline=None, max_entries=100, max_bytes=1024 * 1024,
+                 max_wait=0.0):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.segment_bytes = segment_bytes
+        self.use_mmap = use_mmap
+        self.deadline = deadline
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_wait = max_wait
+        os.makedirs(path, exist_ok=True)
+
+        self.cursor = self._load_cursor() # 已送達 (segment, offset)
+        segments = self._segments()
+        self.write_seg = segments[-1] if segments else max(self.cursor[0], 1)
+        self._recover_tail()
+        self._file = open(self._seg_path(self.write_seg), "ab")
+        self.pending = self._count_pending()
+        self.latencies = deque(maxlen=1024) # 寫入 → 送達 (秒)
+        self.deadline_missed = 0
+        self.cond = threading.Condition() # 保護這條 lane 的檔案、游標與計數；drainer 在這裡等新紀錄
+        self.last_sync = time.monotonic()
+
+    def _seg_path(self, seg):
+        return os.path.join(self.path, f"{seg:08d}.seg")
+
+    def _segments(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.path) if name.endswith(".seg"))
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.path, "cursor")) as f:
+                seg, offset = f.read().split()
+                return int(seg), int(offset)
+        except (OSError, ValueError):
+            segments = self._segments()
+            return (segments[0] if segments else 1), 0
+
+    def _recover_tail(self):
+        """截掉最後一個 segment 尾端寫到一半的紀錄"""
+        path = self._seg_path(self.write_seg)
+        if not os.path.exists(path):
+            return
+        valid = 0
+        for _, end, _ in self._scan(self.write_seg, 0):
+            valid = end
+        if valid != os.path.getsize(path):
+            with open(path, "r+b") as f:
+                f.truncate(valid)
+
+    def _count_pending(self):
+        n = 0
+        seg, offset = self.cursor
+        for s in self._segments():
+            if s >= seg:
+                n += sum(1 for _ in self._scan(s, offset if s == seg else 0))
+        return n
+
+    # --- 讀取 ---
+    def _scan(self, seg, offset):
+        """逐筆讀出 (起點, 終點, payload bytes)，遇到不完整或 CRC 錯誤的紀錄就停止"""
+        path = self._seg_path(seg)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        if offset >= size:
+            return
+        with open(path, "rb") as f:
+            if self.use_mmap:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    while offset + _HEADER.size <= size:
+                        length, crc = _HEADER.unpack_from(buf, offset)
+                        end = offset + _HEADER.size + length
+                        payload = buf[offset + _HEADER.size:end]
+                        if end > size or zlib.crc32(payload) != crc:
+                            return
+                        yield offset, end, payload
+                        offset = end
+                return
+
+            f.seek(offset)
+            while True:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    return
+                length, crc = _HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    return
+                end = offset + _HEADER.size + length
+                yield offset, end, payload
+                offset = end
+
+    def read(self, max_records):
+        """從游標往後取最多 max_records 筆：[(payload, 讀完後的位置)]；不移動游標"""
+        out = []
+        seg, offset = self.cursor
+        while len(out) < max_records:
+            for _, end, payload in self._scan(seg, offset):
+                out.append((payload, (seg, end)))
+                if len(out) >= max_records:
+                    break
+            if len(out) >= max_records or seg >= self.write_seg:
+                break
+            seg, offset = seg + 1, 0 # 這個 segment 讀完了，換下一個
+        return out
+
+    # --- 寫入 ---
+    def append(self, payload):
+        if self._file.tell() >= self.segment_bytes:
+            self._file.close()
+            self.write_seg += 1
+            self._file = open(self._seg_path(self.write_seg), "ab")
+        self._file.write(_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+        self._file.flush()
+        self.pending += 1
+
+    def sync(self):
+        os.fsync(self._file.fileno())
+        self.last_sync = time.monotonic()
+
+    def commit(self, pos, n):
+        """確認 pos 之前都已送達：原子地寫入游標，並刪除已送完的舊 segment"""
+        self.cursor = pos
+        self.pending -= n
+        tmp = os.path.join(self.path, "cursor.tmp")
+        with open(tmp, "w") as f:
+            f.write(f"{pos[0]} {pos[1]}")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, "cursor"))
+        for seg in self._segments():
+            if seg < pos[0]:
+                os.remove(self._seg_path(seg))
+
+    def p99(self):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+
+    def close(self):
+        self._file.close()
+
+class DurableOutbox:
+    """
+    submit(bundle, priority) 先寫入日誌再回傳 Future；drainer 送達後 Future 得到 BatchResponse
+    fsync: "always" (每筆寫入都 fsync，最安全) / "interval" (每 fsync_interval 秒一次) / "never"
+    連續的多筆紀錄會合併成一個 transaction 送出 (見 coalesce；最多 max_entries 個 entry、max_bytes bytes，
+    沒滿時最多等 max_wait 秒)，恢復連線後能全速補送
+    lanes: 覆寫 LANE_CONFIG，例如 {"routine": (60.0, 200)} (沒給的欄位沿用預設)；
+    max_entries / max_bytes 給定時套用到所有 lane
+    on_delivered(bundle, response): 每筆紀錄被伺服器接受後呼叫 (在 drainer 執行緒上)；
+    重啟後補送的舊紀錄也會呼叫 (那些沒有 Future 可等)
+    """
+    def __init__(self, path, client, fsync="interval", fsync_interval=0.05, segment_bytes=16 * 2**20,
+                 use_mmap=False, max_entries=None, max_bytes=None, retry_base=0.5, retry_cap=30.0, lanes=None,
+                 on_delivered=None):
+        if fsync not in ("always", "interval", "never"):
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.path = path
+        self.client = client
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+        self.on_delivered = on_delivered
+
+        os.makedirs(path, exist_ok=True)
+        config = dict(LANE_CONFIG, **(lanes or {}))
+        self.lanes = {}
+        for name in LANES:
+            deadline, lane_entries, lane_bytes, max_wait = tuple(config[name]) + LANE_CONFIG[name][len(config[name]):]
+            self.lanes[name] = _Lane(os.path.join(path, name), segment_bytes, use_mmap,
+                                     deadline, max_entries or lane_entries, max_bytes or lane_bytes, max_wait)
+        self._lock = threading.Lock() # 只保護 _futures、dead letter 與計數，不涵蓋任何 lane 的 I/O
+        self._futures = {} # 紀錄 key -> Future (只有本次執行期間 submit 的才有)
+        self._stop = False
+        self._threads = []
+
+        self.delivered = 0
+        self.dead_letters = 0
+
+    # --- 寫入 ---
+    @metrics.timed("outbox.enqueue")
+    def submit(self, bundle, priority=None):
+        """priority 沒給就依內容分類 (classify)"""
+        priority = priority or classify(bundle)
+        if priority not in self.lanes:
+            raise ValueError(f"Unknown priority: {priority}")
+        key = str(uuid.uuid4())
+        payload = dumps({"key": key, "t": time.time(), "bundle": make_idempotent(bundle)})
+        future = Future()
+        lane = self.lanes[priority]
+        with self._lock:
+            self._futures[key] = future # 先登記，drainer 一讀到就可能送達
+        try:
+            with lane.cond:
+                lane.append(payload)
+                if self.fsync == "always":
+                    lane.sync()
+                else:
+                    self._sync_due(lane)
+                lane.cond.notify()
+        except BaseException:
+            with self._lock:
+                self._futures.pop(key, None)
+            raise
+        return future
+
+    def pending(self):
+        out = {}
+        for name, lane in self.lanes.items():
+            with lane.cond:
+                out[name] = lane.pending
+        return out
+
+    def stats(self):
+        """每條 lane 的待送筆數、寫入 → 送達 p99 (ms) 與超過 deadline 的筆數"""
+        out = {}
+        for name, lane in self.lanes.items():
+            with lane.cond:
+                p99 = lane.p99()
+                out[name] = {"pending": lane.pending, "deadline_s": lane.deadline,
+                             "p99_ms": None if p99 is None else round(p99 * 1000, 1),
+                             "deadline_missed": lane.deadline_missed}
+        return out
+
+    # --- 補送 ---
+    def start(self):
+        for lane in self.lanes.values():
+            thread = threading.Thread(target=self._run, args=(lane,), name=f"fhir-outbox-{lane.name}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def close(self):
+        self._stop = True
+        for lane in self.lanes.values():
+            with lane.cond:
+                lane.cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        for lane in self.lanes.values():
+            with lane.cond:
+                lane.sync()
+                lane.close()
+
+    def _next_batch(self, lane):
+        """
+        從游標往後讀一批：([(record, 讀完後的位置)], 是否已滿)
+        不需持有 lock：游標只有這條 lane 的 drainer 會移動，寫到一半的紀錄讀到會因長度 / CRC 不符而停下
+        entry 數不超過 max_entries、日誌 bytes 不超過 max_bytes (單筆超過上限時自己一批)
+        """
+        records, n_entries, n_bytes = [], 0, 0
+        for payload, pos in lane.read(lane.max_entries):
+            record = loads(payload)
+            size = len(record["bundle"].get("entry", []))
+            if records and (n_entries + size > lane.max_entries or n_bytes + len(payload) > lane.max_bytes):
+                return records, True # 這筆留到下一批
+            records.append((record, pos))
+            n_entries += size
+            n_bytes += len(payload)
+        return records, n_entries >= lane.max_entries or n_bytes >= lane.max_bytes
+
+    def _sync_due(self, lane):
+        """fsync="interval" 時，這條 lane 距離上次 fsync 超過間隔就補做 (呼叫時需持有 lane.cond)"""
+        if self.fsync == "interval" and time.monotonic() - lane.last_sync >= self.fsync_interval:
+            lane.sync()
+
+    def _run(self, lane):
+        """
+        lane 的 drainer：只送自己那條 lane，所以別條 lane 的積壓不會擋到它
+        一批沒送達就原地重送 (後面的批次等著)，維持寫入順序；停止時未送達的批次還在日誌裡，重啟後接著送
+        """
+        failures = 0
+        records = []
+        while True:
+            with lane.cond:
+                self._sync_due(lane)
+                while not self._stop and not (records or lane.pending):
+                    lane.cond.wait(self.fsync_interval if self.fsync == "interval" else None)
+                    self._sync_due(lane)
+            if self._stop:
+                return
+            if not records:
+                records, full = self._next_batch(lane)
+                # 批次還沒滿：等到最舊一筆寫入後 max_wait 秒 (或後面累積到一整批) 再讀一次，讓更多紀錄併進來；
+                # 最舊一筆已超過 deadline 就不等了
+                age = time.time() - records[0][0].get("t", 0) if records else 0
+                if records and not full and age < min(lane.max_wait, lane.deadline):
+                    end = time.monotonic() + lane.max_wait - age
+                    with lane.cond:
+                        while not self._stop and time.monotonic() < end and lane.pending < lane.max_entries:
+                            lane.cond.wait(end - time.monotonic())
+                    records, _ = self._next_batch(lane)
+            if not records:
+                continue
+
+            remaining = self._deliver(records)
+            done = records[:len(records) - len(remaining)]
+            if done:
+                self._complete(lane, done)
+            records = remaining
+            if not remaining:
+                failures = 0
+                continue
+            # 伺服器暫時無法使用：以 jitter 指數退避後重送同一批 (急救 lane 有自己的 drainer，不必等這裡)；
+            # 最舊一筆已超過 deadline 時退避上限降到 retry_base，伺服器一恢復就盡快送到
+            failures += 1
+            cap = self.retry_cap
+            if time.time() - remaining[0][0].get("t", time.time()) > lane.deadline:
+                cap = min(cap, self.retry_base)
+            end = time.monotonic() + random.uniform(0, min(cap, self.retry_base * 2 ** failures))
+            with lane.cond:
+                while not self._stop and time.monotonic() < end:
+                    lane.cond.wait(end - time.monotonic())
+
+    def _merge(self, records):
+        return coalesce(record["bundle"] for record, _ in records)
+
+    def _post(self, records, entries):
+        # cProfile 要在真正送出的執行緒上跑 (序列化、HTTP、重試都在這裡)
+        with metrics.profiled(*(request_id(record["bundle"]) for record, _ in records)):
+            return self.client.post_bundle({"resourceType": "Bundle", "type": "transaction", "entry": entries})
+
+    def _deliver(self, records):
+        """送出一批；回傳還需要重送的紀錄 (空 list 代表全部送達，或確定無法送達而轉入 dead letter)"""
+        entries, slots = self._merge(records)
+        try:
+            response = self._post(records, entries)
+        except requests.exceptions.RequestException:
+            return records
+
+        if response.status_code in (200, 201):
+            try:
+                result = response.json().get("entry", [])
+            except ValueError:
+                result = [] # 已寫入成功，只是回應無法解析
+            for (record, _), positions in zip(records, slots):
+                mine = [result[i] for i in positions if i < len(result)]
+                ok = all(200 <= entry_status(e) < 300 for e in mine)
+                result_response = BatchResponse(response.status_code if ok else 207, mine)
+                self._resolve(record["key"], result_response)
+                if ok and self.on_delivered is not None:
+                    try:
+                        self.on_delivered(record["bundle"], result_response)
+                    except Exception as e: # 通知失敗不能讓 drainer 停下來 (紀錄已送達)
+                        print(f"outbox: on_delivered failed: {e!r}", file=sys.stderr)
+            return []
+
+        if response.status_code == 429 or response.status_code >= 500:
+            return records
+
+        # 4xx：逐筆重送找出被拒的那筆，轉入 dead letter，其餘照常送達
+        if len(records) > 1:
+            for i in range(len(records)):
+                if self._deliver(records[i:i + 1]):
+                    return records[i:] # 前 i 筆已處理，剩下的下次再送
+            return []
+        record = records[0][0]
+        with self._lock:
+            with open(os.path.join(self.path, "dead_letter.ndjson"), "ab") as f:
+                f.write(dumps({"key": record["key"], "status": response.status_code,
+                               "error": response.text, "bundle": record["bundle"]}) + b"\n")
+            self.dead_letters += 1
+        self._resolve(record["key"], BatchResponse(response.status_code, [], text=response.text))
+        return []
+
+    def _complete(self, lane, records):
+        """records 已送達：記錄延遲並把游標推進到最後一筆之後"""
+        now = time.time()
+        with lane.cond:
+            for record, _ in records:
+                latency = now - record.get("t", now) # 舊版紀錄沒有寫入時間
+                lane.latencies.append(latency)
+                if latency > lane.deadline:
+                    lane.deadline_missed += 1
+                    metrics.incr("outbox_deadline_missed", lane=lane.name)
+                metrics.observe(f"outbox.{lane.name}", latency)
+            lane.commit(records[-1][1], len(records))
+        with self._lock:
+            self.delivered += len(records)
+
+    def _resolve(self, key, response):
+        with self._lock:
+            future = self._futures.pop(key, None)
+        if future is not None:
+            future.set_result(response)
+
+# --- 每個目錄共用一個 Outbox ---
+_outboxes = {}
+_outboxes_lock = threading.Lock()
+
+def get_outbox(path, client, **options):
+    with _outboxes_lock:
+        outbox = _outboxes.get(path)
+        if outbox is None:
+            outbox = DurableOutbox(path, client, **options).start()
+            _outboxes[path] = outbox
+        return outbox
+
+# 測試區
+if __name__ == "__main__":
+    import signal
+    import subprocess
+    import tempfile
+    from fhir_client import FHIRClient
+    from fhir_stub import StubServer
+
+    # 子行程模式：寫入大量 Bundle 並開始補送，等著被父行程 kill -9
+    if len(sys.argv) == 4 and sys.argv[1] == "--child":
+        outbox = DurableOutbox(sys.argv[2], FHIRClient(sys.argv[3], max_retries=0), fsync="always", max_entries=10)
+        for i in range(300):
+            outbox.submit({"resourceType": "Bundle", "type": "transaction", "entry": [
+                {"resource": {"resourceType": "Observation", "id": f"o{i}-{k}"},
+                 "request": {"method": "POST", "url": "Observation"}} for k in range(2)]})
+        print("ready", flush=True)
+        outbox.start()
+        time.sleep(60)
+        sys.exit(0)
+
+    # 本地替身伺服器 (支援 ifNoneExist，並記錄寫入順序)
+    stub = StubServer(latency=0.02).start()
+    url = stub.url
+    store = stub.store
+
+    # 1. 補送途中 kill -9，重啟後必須全部送達且不重複
+    workdir = tempfile.mkdtemp()
+    child = subprocess.Popen([sys.executable, __file__, "--child", workdir, url], stdout=subprocess.PIPE, text=True)
+    child.stdout.readline()
+    time.sleep(0.3)
+    os.kill(child.pid, signal.SIGKILL)
+    child.wait()
+    before = len(store.writes)
+
+    replayed = []
+    outbox = DurableOutbox(workdir, FHIRClient(url), use_mmap=True,
+                           on_delivered=lambda bundle, response: replayed.append(bundle))
+    pending_at_restart = sum(outbox.pending().values())
+    outbox.start()
+    deadline = time.monotonic() + 30
+    while sum(outbox.pending().values()) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    outbox.close()
+    created = len(store.resources["Observation"])
+    replays = sum(1 for w in store.writes if w[3] == "200 OK")
+    assert created == 600, created
+    assert len(replayed) == pending_at_restart, (len(replayed), pending_at_restart) # 補送的紀錄也會通知
+    print(f"Kill/restart OK: {before} entries sent before kill, {len(store.writes) - before} after restart, "
+          f"{created} unique resources, {replays} idempotent replays")
+
+    # 2. 伺服器斷線時累積，恢復後急救紀錄先送，且每條 lane 內維持寫入順序
+    assert make_idempotent({"entry": [{"resource": {"id": "obs-1"}}]})["entry"][0]["fullUrl"] != "urn:uuid:obs-1"
+    rid = str(uuid.uuid4())
+    assert make_idempotent({"entry": [{"resource": {"id": rid}}]})["entry"][0]["fullUrl"] == f"urn:uuid:{rid}"
+    workdir = tempfile.mkdtemp()
+    dead_url = "http://127.0.0.1:9" # 沒有服務的埠
+    outbox = DurableOutbox(workdir, FHIRClient(dead_url, max_retries=0, deadline=1), retry_base=0.01, retry_cap=0.05)
+    store.writes.clear()
+    store.resources.pop("Observation", None)
+    stub.latency = 0.05 # routine 積壓要送 10 批 (約 0.5 s)，比重試退避上限長得多
+    futures = [outbox.submit({"resourceType": "Bundle", "type": "transaction", "entry": [
+        {"resource": {"resourceType": "Observation", "identifier": [{"system": "seq", "value": str(i)}]},
+         "request": {"method": "POST", "url": "Observation"}}]}) for i in range(1000)]
+    futures.append(outbox.submit({"resourceType": "Bundle", "type": "transaction", "entry": [
+        {"resource": {"resourceType": "ServiceRequest", "id": "emergency-0"},
+         "request": {"method": "POST", "url": "ServiceRequest"}}]}, priority="emergency"))
+    outbox.start()
+    time.sleep(0.3)
+    outbox.client = FHIRClient(url) # 伺服器恢復
+    t0 = time.perf_counter()
+    futures[-1].result(timeout=30)
+    emergency_at = time.perf_counter() - t0
+    for f in futures:
+        f.result(timeout=30)
+    elapsed = time.perf_counter() - t0
+    outbox.close()
+    stub.latency = 0.02
+    order = [w[1] for w in store.writes]
+    emergency_index = order.index("ServiceRequest")
+    assert order[emergency_index + 1:].count("Observation") >= 100, emergency_index # 急救紀錄在 routine 積壓送完前就送達
+    observations = sorted(store.resources["Observation"].values(), key=lambda r: int(r["id"]))
+    seq = [int(i["value"]) for r in observations for i in r["identifier"] if i["system"] == "seq"]
+    assert seq == list(range(1000)), "routine lane delivered out of order"
+    # 超過 deadline 的批次不再指數退避：伺服器恢復後最多 retry_base 內重送 (退避上限 retry_cap 設得很長)
+    outbox = DurableOutbox(tempfile.mkdtemp(), FHIRClient(dead_url, max_retries=0, deadline=1),
+                           retry_base=0.05, retry_cap=10.0, lanes={"emergency": (0.1,)}).start()
+    late = outbox.submit({"resourceType": "Bundle", "type": "transaction", "entry": [
+        {"resource": {"resourceType": "ServiceRequest", "id": "emergency-late"},
+         "request": {"method": "POST", "url": "ServiceRequest"}}]}, priority="emergency")
+    time.sleep(1.0)
+    outbox.client = FHIRClient(url)
+    t0 = time.perf_counter()
+    late.result(timeout=30)
+    late_at = time.perf_counter() - t0
+    outbox.close()
+    assert late_at < 1.0, late_at
+    # 分類規則
+    def one(resource):
+        return {"entry": [{"resource": resource}]}
+    assert classify(one({"resourceType": "ServiceRequest", "priority": "stat"})) == "emergency"
+    assert classify(one({"resourceType": "CommunicationRequest", "priority": "asap"})) == "urgent"
+    assert classify(one({"resourceType": "CommunicationRequest", "priority": "routine"})) == "routine"
+    assert classify(one({"resourceType": "RiskAssessment"}), status_type="preventive") == "urgent"
+    assert classify(one({"resourceType": "RiskAssessment", "prediction": [
+        {"qualitativeRisk": {"coding": [{"code": "critical"}]}}]})) == "emergency"
+    print(f"Drained {len(futures)} bundles in {elapsed:.2f}s ({len(futures) / elapsed:,.0f} bundles/s), "
+          f"emergency delivered after {emergency_at * 1000:.0f} ms")
+
+    # 3. 壓力測試：一般生理數據塞滿連線時，急救 / 醫囑的 寫入 → 送達 p99
+    #    對照組：全部擠在同一條 FIFO lane (以前急救也會被大批次與積壓擋住)
+    from ai_engine import build_risk_bundle
+
+    def vitals(i):
+        return {"resourceType": "Bundle", "type": "transaction", "entry": [
+            {"resource": {"resourceType": "Observation", "id": f"v{i}-{k}", "status": "final"},
+             "request": {"method": "POST", "url": "Observation"}} for k in range(7)]}
+
+    def critical(i):
+        if i % 2:
+            return build_risk_bundle("p1", "emergency", "load test")
+        return {"resourceType": "Bundle", "type": "transaction", "entry": [
+            {"resource": {"resourceType": "ServiceRequest", "priority": "stat", "status": "active"},
+             "request": {"method": "POST", "url": "ServiceRequest"}}]}
+
+    def load_test(label, fifo, seconds=5.0, routine_rate=400, critical_rate=10):
+        stub.latency = 0.2 # 每個請求 200 ms：routine 補送能力約 140 bundles/s，寫入速度遠超過它 (積壓持續變長)
+        outbox = DurableOutbox(tempfile.mkdtemp(), FHIRClient(url), fsync="never").start()
+        latencies, submitted = [], []
+        t_end = time.monotonic() + seconds
+        i = 0
+        while time.monotonic() < t_end:
+            outbox.submit(vitals(i))
+            if i % (routine_rate // critical_rate) == 0:
+                t = time.perf_counter()
+                f = outbox.submit(critical(i), "routine" if fifo else None)
+                f.add_done_callback(lambda _, t=t: latencies.append(time.perf_counter() - t))
+                submitted.append(f)
+            i += 1
+            time.sleep(1 / routine_rate)
+        for f in submitted:
+            f.result(timeout=120)
+        stats = outbox.stats()
+        backlog = stats["routine"]["pending"]
+        outbox.close()
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+        print(f"{label:10s}: {i} routine + {len(submitted)} critical bundles | critical p50 {p50:,.0f} ms, "
+              f"p99 {p99:,.0f} ms | routine backlog at end {backlog}")
+        return p99
+
+    # 4. 合併送出：gateway 的 Bundle 都帶同一位 Patient 的 conditional create
+    #    逐筆送 vs 直接串接 (伺服器拒收同一 transaction 內重複的條件 → 退回逐筆) vs coalesce
+    from fhir_gateway import PatientIdentityCache, create_raw_data_bundle
+
+    class _Concat(DurableOutbox):
+        """對照組：entry 直接串接，不合併重複的 conditional create"""
+        def _merge(self, records):
+            entries, slots = [], []
+            for record, _ in records:
+                n = len(record["bundle"]["entry"])
+                slots.append(list(range(len(entries), len(entries) + n)))
+                entries.extend(record["bundle"]["entry"])
+            return entries, slots
+
+    stub.latency = 0.0
+    users, per_user = 20, 10
+    raw = [create_raw_data_bundle(f"C{u}", "Coalesce", 60 + k, 97, 118, 76, 16, 50, 20, 7, 25.03, 121.56,
+                                  cache=PatientIdentityCache())[0] for u in range(users) for k in range(per_user)]
+    for label, cls, options in (("per record", DurableOutbox, {"max_entries": 1}),
+                                ("concatenate", _Concat, {}), ("coalesce", DurableOutbox, {})):
+        for rtype in ("Patient", "Observation"):
+            store.resources.pop(rtype, None)
+        store._identifiers.clear()
+        requests_before = stub.stats["requests"]
+        outbox = cls(tempfile.mkdtemp(), FHIRClient(url, max_retries=0), fsync="never", **options)
+        futures = [outbox.submit(loads(dumps(b))) for b in raw] # submit 會就地修改，每次用新的副本
+        t0 = time.perf_counter()
+        outbox.start()
+        statuses = [f.result(timeout=60).status_code for f in futures]
+        elapsed = time.perf_counter() - t0
+        outbox.close()
+        patients = len(store.resources.get("Patient", {}))
+        assert patients == users and all(s in (200, 201) for s in statuses), (label, patients, set(statuses))
+        print(f"{label:12s}: {len(raw)} gateway bundles -> {stub.stats['requests'] - requests_before} HTTP requests "
+              f"in {elapsed:.2f}s, {patients} Patients")
+    observations = list(store.resources["Observation"].values())
+    assert len(observations) == len(raw) * 7 and all(
+        o["subject"]["reference"].startswith("Patient/") for o in observations)
+
+    fifo_p99 = load_test("FIFO", fifo=True)
+    lanes_p99 = load_test("scheduler", fifo=False)
+    assert lanes_p99 < LANE_CONFIG["emergency"][0] * 1000, lanes_p99
+    print(f"Emergency p99 {fifo_p99:,.0f} ms -> {lanes_p99:,.0f} ms (deadline {LANE_CONFIG['emergency'][0]:.0f} s)")
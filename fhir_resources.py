@@ -0,0 +1,386 @@
+import sys
+from collections import defaultdict
+
+from fast_json import dumps, loads
+
+# 緊湊的資源表示 (Compact Resources) 與 Bundle 引用索引
+# - 每筆資源原本是好幾層的 dict / list (每層都有自己的 hash table)；快取大量 Observation 時非常佔記憶體
+# - 這裡用 __slots__ 類別只展開常用欄位 (代碼、數值、單位、subject ...)，重複的字串 (LOINC 代碼、
+#   單位、病人引用) 以 sys.intern 共用；其餘欄位保留成一段緊湊的 JSON bytes，需要時才轉回 dict
+#   (keep_raw=False 時連 bytes 都不留，json() 依展開的欄位重建，適合只用到數值的快取)
+# - BundleIndex：fullUrl / resourceType / subject 引用 / 代碼 (含血壓面板的 component 代碼)
+#   都是 dict 查詢 (O(1))；subject 不論寫成 urn:uuid 還是 Patient/{id} 都查得到
+#
+# 用法:
+#   index = BundleIndex.load("FHIR_json/Bundle.json")
+#   index.latest("Patient/12345", "8867-4").value    # 最新心率
+#   index.resolve("urn:uuid:...")                    # 引用 -> 資源
+#   index.to_bundle()                                # 轉回 FHIR JSON
+
+LOINC_SYSTEM = "http://loinc.org"
+UCUM_SYSTEM = "http://unitsofmeasure.org"
+
+def _s(value):
+    """重複出現的字串共用同一個物件"""
+    return sys.intern(value) if isinstance(value, str) else value
+
+def _ref(node):
+    return _s((node or {}).get("reference"))
+
+def _coding(concept):
+    """CodeableConcept -> (system, code, display)；有 LOINC 就優先取 LOINC"""
+    codings = (concept or {}).get("coding") or [{}]
+    coding = next((c for c in codings if c.get("system") == LOINC_SYSTEM), codings[0])
+    return _s(coding.get("system")), _s(coding.get("code")), _s(coding.get("display"))
+
+def _concept(system, code, display):
+    coding = {"system": system, "code": code}
+    if display is not None:
+        coding["display"] = display
+    return {"coding": [coding]}
+
+def _quantity(value, unit, unit_code):
+    out = {"value": value}
+    if unit is not None:
+        out["unit"] = unit
+    if unit_code is not None:
+        out["system"] = UCUM_SYSTEM
+        out["code"] = unit_code
+    return out
+
+class Resource:
+    """通用資源：只展開 resourceType / id / subject (Device 則是 patient)，其餘留在 JSON bytes"""
+    __slots__ = ("resource_type", "id", "subject", "_raw")
+
+    def __init__(self, resource_type, id=None, subject=None):
+        self.resource_type = _s(resource_type)
+        self.id = id
+        self.subject = _s(subject)
+        self._raw = None
+
+    @classmethod
+    def from_json(cls, resource, keep_raw=True):
+        obj = cls.__new__(cls)
+        obj.resource_type = _s(resource.get("resourceType"))
+        obj.id = resource.get("id")
+        obj.subject = _ref(resource.get("subject") or resource.get("patient"))
+        obj._load(resource)
+        obj._raw = dumps(resource) if keep_raw else None
+        return obj
+
+    def _load(self, resource):
+        pass
+
+    def _build(self):
+        out = {"resourceType": self.resource_type}
+        if self.id is not None:
+            out["id"] = self.id
+        if self.subject is not None:
+            out["subject"] = {"reference": self.subject}
+        return out
+
+    def json(self):
+        """轉回 FHIR JSON dict (每次都產生新的 dict，不快取)"""
+        return loads(self._raw) if self._raw is not None else self._build()
+
+    def raw(self):
+        """序列化好的 JSON bytes"""
+        return self._raw if self._raw is not None else dumps(self._build())
+
+    def codes(self):
+        return ()
+
+    def __repr__(self):
+        return f"<{self.resource_type}/{self.id}>"
+
+class Observation(Resource):
+    """components: 血壓面板等的 ((system, code, display, value, unit, unit_code), ...)"""
+    __slots__ = ("status", "system", "code", "display", "value", "unit", "unit_code",
+                 "effective", "components", "device")
+
+    def __init__(self, id, subject, code, value, unit=None, unit_code=None, effective=None,
+                 system=LOINC_SYSTEM, display=None, status="final", components=(), device=None):
+        super().__init__("Observation", id, subject)
+        self.status = _s(status)
+        self.system, self.code, self.display = _s(system), _s(code), _s(display)
+        self.value, self.unit, self.unit_code = value, _s(unit), _s(unit_code)
+        self.effective = effective
+        self.components = tuple(components)
+        self.device = _s(device)
+
+    def _load(self, resource):
+        self.status = _s(resource.get("status"))
+        self.system, self.code, self.display = _coding(resource.get("code"))
+        quantity = resource.get("valueQuantity") or {}
+        self.value, self.unit, self.unit_code = quantity.get("value"), _s(quantity.get("unit")), _s(quantity.get("code"))
+        self.effective = resource.get("effectiveDateTime")
+        self.components = tuple(
+            _coding(c.get("code")) + (q.get("value"), _s(q.get("unit")), _s(q.get("code")))
+            for c in resource.get("component", []) for q in [c.get("valueQuantity") or {}])
+        self.device = _ref(resource.get("device"))
+
+    def _build(self):
+        out = super()._build()
+        out.pop("subject", None) # 依 FHIR 慣例的欄位順序重排
+        out["status"] = self.status
+        out["code"] = _concept(self.system, self.code, self.display)
+        if self.subject is not None:
+            out["subject"] = {"reference": self.subject}
+        if self.device is not None:
+            out["device"] = {"reference": self.device}
+        if self.effective is not None:
+            out["effectiveDateTime"] = self.effective
+        if self.value is not None:
+            out["valueQuantity"] = _quantity(self.value, self.unit, self.unit_code)
+        if self.components:
+            out["component"] = [{"code": _concept(system, code, display),
+                                 "valueQuantity": _quantity(value, unit, unit_code)}
+                                for system, code, display, value, unit, unit_code in self.components]
+        return out
+
+    def codes(self):
+        return (self.code,) + tuple(c[1] for c in self.components)
+
+    def component(self, code):
+        """component 的數值 (例如收縮壓 8480-6)；沒有就回傳 None"""
+        return next((c[3] for c in self.components if c[1] == code), None)
+
+class Patient(Resource):
+    __slots__ = ("identifiers", "family", "given", "gender")
+
+    def _load(self, resource):
+        self.identifiers = tuple((_s(i.get("system")), i.get("value")) for i in resource.get("identifier", []))
+        name = (resource.get("name") or [{}])[0]
+        self.family, self.given = name.get("family"), tuple(name.get("given", ()))
+        self.gender = _s(resource.get("gender"))
+
+    def _build(self):
+        out = super()._build()
+        if self.identifiers:
+            out["identifier"] = [{"system": system, "value": value} for system, value in self.identifiers]
+        if self.family is not None or self.given:
+            out["name"] = [{"family": self.family, "given": list(self.given)}]
+        if self.gender is not None:
+            out["gender"] = self.gender
+        return out
+
+class RiskAssessment(Resource):
+    """risk_code: qualitativeRisk 代碼 (critical / high / low)；basis: 依據的 Observation 引用"""
+    __slots__ = ("status", "occurrence", "risk_code", "probability", "outcome", "basis")
+
+    def _load(self, resource):
+        self.status = _s(resource.get("status"))
+        self.occurrence = resource.get("occurrenceDateTime")
+        prediction = (resource.get("prediction") or [{}])[0]
+        self.risk_code = _coding(prediction.get("qualitativeRisk"))[1]
+        self.probability = prediction.get("probabilityDecimal")
+        outcome = prediction.get("outcome") or {}
+        self.outcome = outcome.get("text") or _coding(outcome)[2]
+        self.basis = tuple(_ref(b) for b in resource.get("basis", []))
+
+    def _build(self):
+        out = super()._build()
+        out["status"] = self.status
+        if self.occurrence is not None:
+            out["occurrenceDateTime"] = self.occurrence
+        if self.basis:
+            out["basis"] = [{"reference": ref} for ref in self.basis]
+        prediction = {"outcome": {"text": self.outcome}}
+        if self.probability is not None:
+            prediction["probabilityDecimal"] = self.probability
+        if self.risk_code is not None:
+            prediction["qualitativeRisk"] = {"coding": [{
+                "system": "http://terminology.hl7.org/CodeSystem/risk-probability", "code": self.risk_code}]}
+        out["prediction"] = [prediction]
+        return out
+
+TYPES = {"Observation": Observation, "Patient": Patient, "RiskAssessment": RiskAssessment}
+
+def from_json(resource, keep_raw=True):
+    """FHIR JSON dict -> 緊湊資源 (不認得的 resourceType 用通用的 Resource)"""
+    return TYPES.get(resource.get("resourceType"), Resource).from_json(resource, keep_raw)
+
+class BundleIndex:
+    """
+    Bundle 的引用索引；所有查詢都是 dict 查詢，不必逐一掃過 entry
+    keep_raw: 保留未展開欄位的 JSON bytes (to_bundle 可完整還原)
+    """
+    def __init__(self, keep_raw=True):
+        self.keep_raw = keep_raw
+        self.type = "transaction"
+        self.entries = [] # (fullUrl, 資源, request)
+        self.by_url = {} # fullUrl (沒有時用 Type/id) -> 資源
+        self.by_type = defaultdict(list)
+        self.by_subject = defaultdict(list) # 資源上寫的 subject 引用原字串 -> 資源
+        self.by_code = defaultdict(list) # 代碼 -> Observation
+        self.by_subject_code = defaultdict(list) # (subject 引用, 代碼) -> Observation
+        self._aliases = {} # Type/id -> fullUrl
+
+    @classmethod
+    def from_bundle(cls, bundle, keep_raw=True):
+        index = cls(keep_raw)
+        index.type = bundle.get("type", index.type)
+        for entry in bundle.get("entry", []):
+            index.add(entry.get("resource") or {}, entry.get("fullUrl"), entry.get("request"))
+        return index
+
+    @classmethod
+    def load(cls, path, keep_raw=True):
+        with open(path, "rb") as f:
+            return cls.from_bundle(loads(f.read()), keep_raw)
+
+    def add(self, resource, full_url=None, request=None):
+        """加入一筆資源 (dict 或緊湊資源)；回傳緊湊資源"""
+        if not isinstance(resource, Resource):
+            resource = from_json(resource, self.keep_raw)
+        local = f"{resource.resource_type}/{resource.id}" if resource.id else None
+        key = full_url or local
+        self.entries.append((full_url, resource, request))
+        if key is not None:
+            self.by_url[key] = resource
+        if full_url and local:
+            self._aliases[local] = full_url
+        self.by_type[resource.resource_type].append(resource)
+        if resource.subject is not None:
+            self.by_subject[resource.subject].append(resource)
+        for code in resource.codes():
+            self.by_code[code].append(resource)
+            self.by_subject_code[(resource.subject, code)].append(resource)
+        return resource
+
+    def __len__(self):
+        return len(self.entries)
+
+    # --- 查詢 ---
+    def resolve(self, reference):
+        """引用 (urn:uuid:... 或 Type/id) -> 資源；不在這個 Bundle 內回傳 None"""
+        found = self.by_url.get(reference)
+        if found is None and reference in self._aliases:
+            found = self.by_url.get(self._aliases[reference])
+        return found
+
+    def _subject_keys(self, reference):
+        """同一個資源可能被寫成 urn:uuid 或 Type/id，兩種都要查"""
+        keys = {reference}
+        target = self.resolve(reference)
+        if target is not None:
+            if target.id:
+                local = f"{target.resource_type}/{target.id}"
+                keys.add(local)
+                keys.add(self._aliases.get(local, local))
+            else:
+                keys.add(reference)
+        return keys
+
+    def of_type(self, resource_type):
+        return list(self.by_type.get(resource_type, ()))
+
+    def for_subject(self, reference, resource_type=None):
+        out = [r for key in self._subject_keys(reference) for r in self.by_subject.get(key, ())]
+        if resource_type is not None:
+            out = [r for r in out if r.resource_type == resource_type]
+        return out
+
+    def with_code(self, code, subject=None):
+        if subject is None:
+            return list(self.by_code.get(code, ()))
+        return [r for key in self._subject_keys(subject) for r in self.by_subject_code.get((key, code), ())]
+
+    def latest(self, subject, code):
+        """某位病人某個代碼最新的一筆 Observation (依 effectiveDateTime)"""
+        return max(self.with_code(code, subject), key=lambda r: r.effective or "", default=None)
+
+    # --- 轉回 FHIR JSON ---
+    def to_bundle(self):
+        entries = []
+        for full_url, resource, request in self.entries:
+            entry = {}
+            if full_url is not None:
+                entry["fullUrl"] = full_url
+            entry["resource"] = resource.json()
+            if request is not None:
+                entry["request"] = request
+            entries.append(entry)
+        return {"resourceType": "Bundle", "type": self.type, "entry": entries}
+
+# 測試區
+if __name__ == "__main__":
+    import os
+    import json
+    import time
+    import tracemalloc
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "FHIR_json", "Bundle.json")
+    with open(path, "rb") as f:
+        original = loads(f.read())
+
+    # --- 封存 Bundle 的交叉引用 ---
+    index = BundleIndex.from_bundle(original)
+    patient = index.of_type("Patient")[0]
+    device = index.for_subject("Patient/12345", "Device")[0]
+    risk = index.of_type("RiskAssessment")[0]
+    hr = index.latest("Patient/12345", "8867-4")
+    print(f"{patient!r} {patient.family}{''.join(patient.given)} | device {device!r} | "
+          f"{len(index.for_subject('Patient/12345', 'Observation'))} Observations")
+    print(f"latest HR {hr.value} {hr.unit} @ {hr.effective} | risk '{risk.outcome}' ({risk.probability}) "
+          f"based on {[index.resolve(ref).code for ref in risk.basis]}")
+    assert index.resolve(hr.subject) is patient and index.resolve(hr.device) is device
+    assert index.to_bundle() == original # 保留 JSON bytes 時可完整還原
+    print("Round trip to FHIR JSON: identical")
+
+    # --- gateway 產出的 Observation (含血壓面板) 不保留 bytes 也能還原 ---
+    from fhir_gateway import create_raw_data_bundle
+    raw_bundle = create_raw_data_bundle("A123", "TestUser", 75, 98, 110, 70, 16, 50, 20, 7, 25.0, 121.0)[0]
+    for entry in raw_bundle["entry"]:
+        resource = entry["resource"]
+        if resource["resourceType"] == "Observation":
+            rebuilt = from_json(resource, keep_raw=False).json()
+            resource = {k: v for k, v in resource.items() if k != "extension"} # 定位 extension 沒有展開
+            assert rebuilt == resource, (rebuilt, resource)
+    compact = BundleIndex.from_bundle(raw_bundle, keep_raw=False)
+    bp = compact.by_code["8480-6"][0]
+    print(f"Gateway bundle rebuilt without raw JSON | BP {bp.component('8480-6')}/{bp.component('8462-4')}")
+
+    # --- 記憶體：每筆快取的 Observation ---
+    n = 20000
+    observations = [e["resource"] for e in original["entry"] if e["resource"]["resourceType"] == "Observation"]
+    payloads = []
+    for i in range(n):
+        obs = dict(observations[i % len(observations)], id=f"obs-{i}",
+                   subject={"reference": f"urn:uuid:00000000-0000-0000-0000-{i % 500:012d}"})
+        payloads.append(json.dumps(obs).encode())
+
+    def measure(build):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        cache = [build(p) for p in payloads]
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        return cache, used / n
+
+    dict_cache, dict_bytes = measure(loads)
+    print(f"{'dict':24s}: {dict_bytes:8,.0f} bytes per Observation")
+    for label, keep_raw in [("compact (keep JSON)", True), ("compact (fields only)", False)]:
+        cache, per_obs = measure(lambda p: Observation.from_json(loads(p), keep_raw))
+        print(f"{label:24s}: {per_obs:8,.0f} bytes per Observation ({per_obs / dict_bytes:.0%} of dict)")
+
+    # --- 查詢：索引 vs 逐一掃描 ---
+    big = BundleIndex(keep_raw=False)
+    for p in payloads:
+        big.add(loads(p))
+    subject = "urn:uuid:00000000-0000-0000-0000-000000000042"
+    t0 = time.perf_counter()
+    for _ in range(1000):
+        found = big.with_code("8867-4", subject)
+    indexed = (time.perf_counter() - t0) / 1000
+    t0 = time.perf_counter()
+    for _ in range(20):
+        scanned = [r for r in dict_cache if r["subject"]["reference"] == subject
+                   and r["code"]["coding"][0]["code"] == "8867-4"]
+    linear = (time.perf_counter() - t0) / 20
+    assert len(found) == len(scanned)
+    t0 = time.perf_counter()
+    for i in range(n):
+        big.resolve(f"Observation/obs-{i}")
+    print(f"with_code(subject): {indexed * 1e6:,.1f} µs vs linear scan {linear * 1e6:,.0f} µs | "
+          f"resolve: {(time.perf_counter() - t0) / n * 1e6:.2f} µs")
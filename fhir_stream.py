@@ -0,0 +1,302 @@
+import uuid
+import json
+import time
+import threading
+from datetime import datetime, timezone
+
+from fhir_gateway import OBSERVATION_SPECS, BP_PANEL_CODE
+
+# 高頻串流模式：同一位病人、同一個 LOINC 代碼在一個時間窗內的讀數，
+# 合併成一筆 valueSampledData 的 Observation (取代每秒一筆 Observation)
+
+# 參數名 -> (LOINC code, display, unit, UCUM code)
+STREAM_SPECS = {param: (code, display, unit, unit_code) for param, code, display, unit, unit_code in OBSERVATION_SPECS}
+# 血壓兩個分量，放進同一筆 85354-9 面板的 component
+BP_COMPONENTS = {
+    "sys_bp": ("8480-6", "Systolic blood pressure", "mmHg", "mm[Hg]"),
+    "dia_bp": ("8462-4", "Diastolic blood pressure", "mmHg", "mm[Hg]"),
+}
+
+def _iso(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).isoformat()
+
+def _format(value):
+    """
+    SampledData.data 以空白分隔的十進位字串，缺值 (None / NaN) 以 E 表示
+    浮點數用 repr (最短且能完整還原的寫法)，不會像 :g 一樣只留 6 位有效數字
+    """
+    if value is None:
+        return "E"
+    if isinstance(value, int):
+        return str(value)
+    value = float(value)
+    return "E" if value != value else repr(value)
+
+def _sampled_data(values, period, unit, unit_code):
+    return {
+        "origin": {"value": 0, "unit": unit, "system": "http://unitsofmeasure.org", "code": unit_code},
+        "period": period * 1000, # FHIR 規定單位為毫秒
+        "dimensions": 1,
+        "data": " ".join(_format(v) for v in values),
+    }
+
+class _Window:
+    """
+    一個 (病人, 參數群組) 的緩衝：起始時間 + 每個參數依 period 對齊的樣本槽
+    血壓的收縮壓 / 舒張壓是同一個群組，共用起始時間，打包成一筆面板
+    """
+    __slots__ = ("start", "values")
+
+    def __init__(self, start):
+        self.start = start
+        self.values = {} # param -> [數值或 None]
+
+    def length(self):
+        return max(len(v) for v in self.values.values())
+
+def _group(param):
+    return "bp" if param in BP_COMPONENTS else param
+
+class SampledDataStream:
+    """
+    依病人與 LOINC 代碼緩衝讀數，每 flush_interval 秒把每個時間窗打包成一筆 Observation
+    sink(bundle): 送出函式，例如 FHIRClient.submit_bundle 或 FHIROutbox.submit
+    period: 取樣間隔 (秒)；max_window: 單一 Observation 最多幾個樣本，超過就切新時間窗
+    晚到的樣本放回它所屬的時間窗；比目前所有時間窗都早 (或該時段已經送出) 的直接丟棄，
+    計入 late_dropped，不會另開一個重疊的時間窗
+    """
+    def __init__(self, sink=None, period=1.0, flush_interval=30.0, max_window=600):
+        self.sink = sink
+        self.period = period
+        self.flush_interval = flush_interval
+        self.max_window = max_window
+
+        self._lock = threading.Lock()
+        self._buffers = {} # (subject_ref, 參數群組) -> [_Window, ...] (依起始時間排序、互不重疊)
+        self._sent_until = {} # (subject_ref, 參數群組) -> 已送出的最後一個樣本時間
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.samples_in = 0
+        self.observations_out = 0
+        self.late_dropped = 0
+
+    # --- 寫入讀數 ---
+    def add(self, subject_ref, param, value, t=None):
+        """加入一個讀數；t 為 epoch 秒，預設為現在"""
+        if param not in STREAM_SPECS and param not in BP_COMPONENTS:
+            raise ValueError(f"Unknown vital sign: {param}")
+        t = time.time() if t is None else t
+        key = (subject_ref, _group(param))
+        with self._lock:
+            sent = self._sent_until.get(key)
+            if sent is not None and t < sent + self.period / 2:
+                self.late_dropped += 1 # 這個時段已經送出
+                return
+            windows = self._buffers.setdefault(key, [])
+            window = slot = None
+            for candidate in reversed(windows): # 通常是最後一個；晚到的樣本往前找所屬的時間窗
+                slot = round((t - candidate.start) / self.period)
+                if slot >= 0:
+                    window = candidate
+                    break
+            if window is None:
+                if windows:
+                    self.late_dropped += 1 # 比緩衝中最早的時間窗還早
+                    return
+                window, slot = _Window(t), 0
+                windows.append(window)
+            elif slot >= self.max_window:
+                if window is not windows[-1]:
+                    self.late_dropped += 1 # 落在兩個時間窗之間的空檔
+                    return
+                window, slot = _Window(t), 0
+                windows.append(window)
+            values = window.values.setdefault(param, [])
+            if slot >= len(values):
+                values.extend([None] * (slot + 1 - len(values)))
+            values[slot] = value
+            self.samples_in += 1
+
+    def add_reading(self, subject_ref, t=None, **values):
+        """一次加入手錶的一整組讀數，例如 add_reading(ref, hr=75, spo2=98)"""
+        t = time.time() if t is None else t
+        for param, value in values.items():
+            self.add(subject_ref, param, value, t)
+
+    # --- 打包與送出 ---
+    def _observation(self, subject_ref, code, display, window, value_or_components):
+        end = window.start + (window.length() - 1) * self.period
+        obs = {
+            "resourceType": "Observation",
+            "id": str(uuid.uuid4()),
+            "status": "final",
+            "code": {"coding": [{"system": "http://loinc.org", "code": code, "display": display}]},
+            "subject": {"reference": subject_ref},
+            "effectivePeriod": {"start": _iso(window.start), "end": _iso(end)},
+        }
+        obs.update(value_or_components)
+        return obs
+
+    def drain(self):
+        """取出目前所有緩衝並轉成 Observation 清單 (不送出)"""
+        with self._lock:
+            buffers, self._buffers = self._buffers, {}
+            for key, windows in buffers.items():
+                last = windows[-1]
+                self._sent_until[key] = last.start + (last.length() - 1) * self.period
+
+        observations = []
+        for (subject_ref, group), windows in buffers.items():
+            for window in windows:
+                if group != "bp":
+                    code, display, unit, unit_code = STREAM_SPECS[group]
+                    observations.append(self._observation(subject_ref, code, display, window, {
+                        "valueSampledData": _sampled_data(window.values[group], self.period, unit, unit_code)
+                    }))
+                    continue
+                # [血壓面板] 收縮壓 / 舒張壓共用同一個時間窗 (先到的分量決定起始時間，另一個前面補 E)
+                components = []
+                for param, (code, display, unit, unit_code) in BP_COMPONENTS.items():
+                    if param in window.values:
+                        components.append({
+                            "code": {"coding": [{"system": "http://loinc.org", "code": code, "display": display}]},
+                            "valueSampledData": _sampled_data(window.values[param], self.period, unit, unit_code),
+                        })
+                observations.append(self._observation(subject_ref, BP_PANEL_CODE, "Blood pressure panel",
+                                                      window, {"component": components}))
+
+        self.observations_out += len(observations)
+        return observations
+
+    def flush(self):
+        """打包成 Transaction Bundle 並交給 sink；沒有資料則回傳 None"""
+        observations = self.drain()
+        if not observations:
+            return None
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "transaction",
+            "entry": [{
+                "fullUrl": f"urn:uuid:{obs['id']}",
+                "resource": obs,
+                "request": {"method": "POST", "url": "Observation"}
+            } for obs in observations]
+        }
+        if self.sink is not None:
+            self.sink(bundle)
+        return bundle
+
+    # --- 背景定時送出 ---
+    def start(self):
+        def loop():
+            while not self._stop.wait(self.flush_interval):
+                self.flush()
+        self._thread = threading.Thread(target=loop, name="sampled-data-flush", daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+# === 解碼 (Decoder) ===
+def decode_sampled_data(sampled, start):
+    """
+    把一個 SampledData 還原成 [(epoch 秒, 數值或 None)]
+    start: 對應 effectivePeriod.start (ISO 字串)
+    """
+    t0 = datetime.fromisoformat(start).timestamp()
+    period = sampled["period"] / 1000
+    origin = sampled.get("origin", {}).get("value", 0)
+    factor = sampled.get("factor", 1)
+    samples = []
+    for i, token in enumerate(sampled["data"].split()):
+        value = None if token in ("E", "L", "U") else origin + float(token) * factor
+        samples.append((t0 + i * period, value))
+    return samples
+
+def decode_observation(obs):
+    """Observation -> {LOINC code: [(epoch 秒, 數值或 None)]} (血壓面板會展開成兩個分量)"""
+    start = obs["effectivePeriod"]["start"]
+    if "valueSampledData" in obs:
+        code = obs["code"]["coding"][0]["code"]
+        return {code: decode_sampled_data(obs["valueSampledData"], start)}
+    return {comp["code"]["coding"][0]["code"]: decode_sampled_data(comp["valueSampledData"], start)
+            for comp in obs.get("component", [])}
+
+# 測試區
+if __name__ == "__main__":
+    import random
+    from fhir_gateway import create_raw_data_bundle, register_patient_response
+
+    # 模擬 10 位病人、每秒一組讀數、持續 60 秒 (中間故意掉幾筆)
+    random.seed(0)
+    n_patients, seconds = 10, 60
+    t_start = 1_700_000_000.0
+    stream = SampledDataStream(period=1.0, max_window=60)
+    sent = {} # (ref, LOINC code) -> [(t, value)]
+    codes = {param: spec[0] for param, spec in STREAM_SPECS.items()}
+    codes.update({param: spec[0] for param, spec in BP_COMPONENTS.items()})
+    per_reading_bytes = 0
+    # 對照組假設病人已在快取中 (不含 Patient)，只比較 Observation 的差異
+    register_patient_response("A123", {"entry": [{"response": {"location": "Patient/987"}}]})
+    for s in range(seconds):
+        for p in range(n_patients):
+            ref = f"Patient/p{p}"
+            reading = {"hr": random.randint(60, 120), "spo2": random.randint(90, 100), "resp": 16,
+                       "hrv": random.randint(20, 80), "stress": random.randint(0, 100), "sleep": 7,
+                       "sys_bp": 110 + random.randint(-5, 5), "dia_bp": 70}
+            if random.random() < 0.05:
+                del reading["hr"] # 掉線
+            stream.add_reading(ref, t=t_start + s, **reading)
+            for param, value in reading.items():
+                sent.setdefault((ref, codes[param]), []).append((t_start + s, float(value)))
+
+            # 對照組：目前每一組讀數就是一個 7 筆 Observation 的 Bundle
+            full = dict(hr=75, spo2=98, sys_bp=110, dia_bp=70, resp=16, hrv=50, stress=20, sleep=7)
+            full.update(reading)
+            per_reading_bytes += len(json.dumps(create_raw_data_bundle(
+                "A123", "TestUser", full["hr"], full["spo2"], full["sys_bp"], full["dia_bp"], full["resp"],
+                full["hrv"], full["stress"], full["sleep"], 25.0, 121.0)[0]))
+
+    bundle = stream.flush()
+
+    # 解碼後必須與送進去的讀數一致 (缺值為 None)
+    decoded = {}
+    for entry in bundle["entry"]:
+        obs = entry["resource"]
+        for code, samples in decode_observation(obs).items():
+            decoded.setdefault((obs["subject"]["reference"], code), []).extend(
+                (t, v) for t, v in samples if v is not None)
+    assert decoded == sent, "round-trip mismatch"
+    print("Round-trip OK")
+
+    # 精度：不會被截成 6 位有效數字
+    exact = SampledDataStream()
+    exact.add("Patient/x", "hr", 72.123456789, t=t_start)
+    exact.add("Patient/x", "hr", 1234567.5, t=t_start + 1)
+    assert exact.flush()["entry"][0]["resource"]["valueSampledData"]["data"] == "72.123456789 1234567.5"
+
+    # 晚到的樣本放回所屬時間窗，不另開重疊的時間窗；血壓分量先後到也是同一筆面板
+    late = SampledDataStream(max_window=10)
+    for s in (0, 1, 2, 4, 3, 12, 5): # 3 晚到 (同一窗)、5 晚到 (前一窗)
+        late.add("Patient/x", "hr", 60 + s, t=t_start + s)
+    late.add("Patient/x", "dia_bp", 80, t=t_start + 1)
+    late.add("Patient/x", "sys_bp", 120, t=t_start + 2)
+    late.add("Patient/x", "hr", 50, t=t_start - 5) # 比所有時間窗都早 → 丟棄
+    observations = late.drain()
+    hr = [o for o in observations if o["code"]["coding"][0]["code"] == codes["hr"]]
+    assert [o["valueSampledData"]["data"] for o in hr] == ["60 61 62 63 64 65", "72"], hr
+    panels = [o for o in observations if o["code"]["coding"][0]["code"] == BP_PANEL_CODE]
+    assert len(panels) == 1 and len(panels[0]["component"]) == 2
+    assert decode_observation(panels[0])[codes["sys_bp"]] == [(t_start + 1, None), (t_start + 2, 120.0)]
+    late.add("Patient/x", "hr", 70, t=t_start + 11) # 該時段已經送出 → 丟棄
+    assert late.late_dropped == 2 and late.drain() == []
+    print("Precision / late samples / BP panel OK")
+
+    stream_bytes = len(json.dumps(bundle))
+    print(f"Resources: {n_patients * seconds * 7} -> {len(bundle['entry'])} | "
+          f"Bytes: {per_reading_bytes:,} -> {stream_bytes:,} ({per_reading_bytes / stream_bytes:.1f}x smaller)")
@@ -0,0 +1,357 @@
+import gzip
+import time
+import random
+import hashlib
+import socket
+import threading
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, parse_qs, urlencode
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from fast_json import dumps, loads
+
+# 本地 FHIR R4 替身伺服器 (Stub)：讓效能量測不受公用伺服器 (hapi.fhir.org) 影響、可重現
+# 支援：
+# - POST /            transaction Bundle (urn:uuid 引用改寫、ifNoneExist conditional create、PUT upsert)
+# - POST /{type}      建立單一資源
+# - GET  /{type}/{id} 讀取
+# - GET  /{type}?...  基本搜尋：_id, identifier, subject/patient, subject:Patient.identifier (chained), code,
+#                     _lastUpdated, _count, _offset, _elements
+# - 注入延遲 (latency + jitter) 與錯誤 (error_rate 機率回 503)
+# - HTTP 傳輸：gzip 請求 (Content-Encoding) 與回應 (Accept-Encoding)、ETag / If-None-Match → 304、
+#   Prefer: return=minimal (預設寫入會把資源送回來，即 return=representation)
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+def _rewrite_refs(node, mapping):
+    """把 resource 內所有指向 urn:uuid 的 reference 換成伺服器 ID"""
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == "reference" and isinstance(value, str) and value in mapping:
+                node[key] = mapping[value]
+            else:
+                _rewrite_refs(value, mapping)
+    elif isinstance(node, list):
+        for item in node:
+            _rewrite_refs(item, mapping)
+
+class FHIRStore:
+    """記憶體內的資源表：{resourceType: {id: resource}}"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.resources = {}
+        self._next_id = 1
+        self.writes = [] # (方法, resourceType, id, 狀態) 依寫入順序，方便測試檢查
+        # conditional create 常用的 identifier=system|value 索引，免得每個 entry 都掃過整張表
+        self._identifiers = {} # (resourceType, system, value) -> id
+
+    def _new_id(self):
+        new_id = str(self._next_id)
+        self._next_id += 1
+        return new_id
+
+    def _store(self, resource, rid, status):
+        rtype = resource["resourceType"]
+        old = self.resources.setdefault(rtype, {}).get(rid)
+        version = int(old["meta"]["versionId"]) + 1 if old else 1
+        resource["id"] = rid
+        resource["meta"] = {"versionId": str(version), "lastUpdated": _now()}
+        self.resources[rtype][rid] = resource
+        for ident in resource.get("identifier", []):
+            self._identifiers[(rtype, ident.get("system"), ident.get("value"))] = rid
+        return {"status": status, "location": f"{rtype}/{rid}/_history/{version}",
+                "lastModified": resource["meta"]["lastUpdated"]}
+
+    def search(self, rtype, params):
+        """回傳符合條件的資源清單 (依 lastUpdated 由舊到新)"""
+        params = dict(params)
+        # chained search：subject:Patient.identifier=system|value → 先找出符合的病人
+        subjects = None
+        for key in [k for k in params if ":Patient." in k]:
+            field = key.split(":Patient.", 1)[1]
+            value = params.pop(key)
+            refs = {f"Patient/{pid}" for pid, p in self.resources.get("Patient", {}).items()
+                    if _match(p, field, value)}
+            subjects = refs if subjects is None else subjects & refs
+        matches = []
+        for resource in self.resources.get(rtype, {}).values():
+            if subjects is not None and resource.get("subject", {}).get("reference") not in subjects:
+                continue
+            if all(_match(resource, key, value) for key, value in params.items()):
+                matches.append(resource)
+        matches.sort(key=lambda r: r["meta"]["lastUpdated"])
+        return matches
+
+    def create(self, resource):
+        with self.lock:
+            response = self._store(resource, self._new_id(), "201 Created")
+            self.writes.append(("POST", resource["resourceType"], resource["id"], response["status"]))
+            return response
+
+    def transaction(self, bundle):
+        """處理 transaction Bundle；回傳 transaction-response 的 entry 清單"""
+        with self.lock:
+            mapping, plans, conditions = {}, [], set()
+            # 第一輪：決定每個 entry 的 ID (conditional create 命中就沿用既有資源)
+            for entry in bundle.get("entry", []):
+                request = entry.get("request", {})
+                resource = entry.get("resource", {})
+                method = request.get("method", "POST")
+                rtype = resource.get("resourceType") or request.get("url", "").split("/")[0]
+                existing = None
+                if method == "POST" and request.get("ifNoneExist"):
+                    # 與 HAPI 相同：同一個 transaction 內兩個相同條件的 conditional create 整批拒收
+                    if (rtype, request["ifNoneExist"]) in conditions:
+                        raise ValueError(f"Duplicate conditional create in transaction: "
+                                         f"{rtype}?{request['ifNoneExist']}")
+                    conditions.add((rtype, request["ifNoneExist"]))
+                    params = {k: v[0] for k, v in parse_qs(request["ifNoneExist"]).items()}
+                    system, _, ident = params.get("identifier", "").rpartition("|")
+                    if system and len(params) == 1:
+                        rid = self._identifiers.get((rtype, system, ident))
+                        existing = self.resources[rtype][rid] if rid is not None else None
+                    else:
+                        found = self.search(rtype, params)
+                        existing = found[0] if found else None
+                if existing is not None:
+                    rid, action = existing["id"], "exists"
+                elif method == "PUT":
+                    rid, action = request["url"].split("/")[1], "put"
+                else:
+                    rid, action = self._new_id(), "create"
+                if entry.get("fullUrl"):
+                    mapping[entry["fullUrl"]] = f"{rtype}/{rid}"
+                plans.append((resource, rtype, rid, action, method))
+
+            # 第二輪：改寫引用並寫入
+            out = []
+            for resource, rtype, rid, action, method in plans:
+                if action == "exists":
+                    existing = self.resources[rtype][rid]
+                    response = {"status": "200 OK",
+                                "location": f"{rtype}/{rid}/_history/{existing['meta']['versionId']}"}
+                else:
+                    _rewrite_refs(resource, mapping)
+                    status = "201 Created" if action == "create" or rid not in self.resources.get(rtype, {}) else "200 OK"
+                    response = self._store(resource, rid, status)
+                self.writes.append((method, rtype, rid, response["status"]))
+                out.append({"response": response})
+            return out
+
+def _match(resource, key, value):
+    """單一搜尋參數比對"""
+    if key == "_id":
+        return resource.get("id") == value
+    if key == "identifier":
+        system, _, ident = value.rpartition("|")
+        # "system|" (值留空) = 這個系統的任何 identifier
+        return any((not ident or i.get("value") == ident) and (not system or i.get("system") == system)
+                   for i in resource.get("identifier", []))
+    if key in ("subject", "patient"):
+        ref = resource.get("subject", {}).get("reference", "")
+        return ref == value or ref == f"Patient/{value}"
+    if key == "code":
+        system, _, code = value.rpartition("|")
+        return any(c.get("code") == code and (not system or c.get("system") == system)
+                   for c in resource.get("code", {}).get("coding", []))
+    if key == "_lastUpdated":
+        for prefix in ("ge", "gt", "le", "lt"):
+            if value.startswith(prefix):
+                value, op = value[len(prefix):], prefix
+                break
+        else:
+            op = "eq"
+        # 時間一律正規化成 UTC ISO 字串後比較
+        bound = datetime.fromisoformat(value.replace("Z", "+00:00")).astimezone(timezone.utc).isoformat()
+        last = resource["meta"]["lastUpdated"]
+        return {"ge": last >= bound, "gt": last > bound, "le": last <= bound,
+                "lt": last < bound, "eq": last == bound}[op]
+    return True # 不支援的參數直接忽略 (與多數伺服器的寬鬆行為一致)
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FHIRStub/0.1"
+
+    def setup(self):
+        super().setup()
+        # 關閉 Nagle：標頭與內容分兩次寫出時，避免與 delayed ACK 互相等待 (~40 ms)
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=None, headers=None, etag=None):
+        stub = self.server.stub
+        data = dumps(body) if body is not None else b""
+        headers = dict(headers or {})
+        if status == 200 and etag is None and self.command == "GET":
+            etag = 'W/"%s"' % hashlib.blake2b(data, digest_size=12).hexdigest() # 搜尋結果以內容雜湊當版本
+        if etag is not None:
+            headers["ETag"] = etag
+            if self.headers.get("If-None-Match") == etag:
+                stub.count("not_modified")
+                status, data = 304, b""
+        if len(data) >= 1024 and "gzip" in self.headers.get("Accept-Encoding", ""):
+            data = gzip.compress(data, 6)
+            headers["Content-Encoding"] = "gzip"
+        stub.count("bytes_out", len(data))
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/fhir+json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _minimal(self):
+        return "return=minimal" in self.headers.get("Prefer", "")
+
+    def _inject(self):
+        """模擬延遲與錯誤；回傳 True 代表這次請求要回錯誤"""
+        stub = self.server.stub
+        stub.count("requests")
+        delay = stub.latency + random.uniform(0, stub.jitter)
+        if delay:
+            time.sleep(delay)
+        if stub.error_rate and random.random() < stub.error_rate:
+            stub.count("injected_errors")
+            self._reply(503, {"resourceType": "OperationOutcome", "issue": [
+                {"severity": "error", "code": "transient", "diagnostics": "Injected error"}]},
+                headers={"Retry-After": "0"})
+            return True
+        return False
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if not length:
+            return {}
+        data = self.rfile.read(length)
+        self.server.stub.count("bytes_in", length)
+        if self.headers.get("Content-Encoding") == "gzip":
+            data = gzip.decompress(data)
+        return loads(data)
+
+    def do_POST(self):
+        body = self._body()
+        if self._inject():
+            return
+        store = self.server.stub.store
+        path = urlsplit(self.path).path.strip("/")
+        if not path:
+            if body.get("resourceType") != "Bundle" or body.get("type") not in ("transaction", "batch"):
+                self._reply(400, {"resourceType": "OperationOutcome", "issue": [
+                    {"severity": "error", "code": "invalid", "diagnostics": "Expected a transaction Bundle"}]})
+                return
+            try:
+                entries = store.transaction(body)
+            except ValueError as e:
+                self._reply(400, {"resourceType": "OperationOutcome", "issue": [
+                    {"severity": "error", "code": "processing", "diagnostics": str(e)}]})
+                return
+            self.server.stub.count("transactions")
+            if not self._minimal():
+                with store.lock:
+                    for entry in entries:
+                        rtype, rid = entry["response"]["location"].split("/")[:2]
+                        entry["resource"] = store.resources[rtype][rid]
+            self._reply(200, {"resourceType": "Bundle", "type": "transaction-response", "entry": entries})
+            return
+        body["resourceType"] = path.split("/")[0]
+        response = store.create(body)
+        self._reply(201, None if self._minimal() else body, headers={"Location": response["location"]})
+
+    def do_GET(self):
+        if self._inject():
+            return
+        store = self.server.stub.store
+        url = urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        with store.lock:
+            if len(parts) == 2:
+                resource = store.resources.get(parts[0], {}).get(parts[1])
+                if resource is None:
+                    self._reply(404, {"resourceType": "OperationOutcome", "issue": [
+                        {"severity": "error", "code": "not-found"}]})
+                else:
+                    self._reply(200, resource, etag=f'W/"{resource["meta"]["versionId"]}"')
+                return
+
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            count = int(query.pop("_count", 100))
+            offset = int(query.pop("_offset", 0))
+            elements = query.pop("_elements", None)
+            query.pop("_sort", None)
+            matches = store.search(parts[0], query)
+            page = matches[offset:offset + count]
+            if elements:
+                keep = set(elements.split(",")) | {"resourceType", "id", "meta"}
+                page = [{k: v for k, v in r.items() if k in keep} for r in page]
+            bundle = {"resourceType": "Bundle", "type": "searchset", "total": len(matches),
+                      "link": [{"relation": "self", "url": self.server.stub.url + self.path}],
+                      "entry": [{"fullUrl": f"{self.server.stub.url}/{r['resourceType']}/{r['id']}", "resource": r}
+                                for r in page]}
+            if offset + count < len(matches):
+                next_query = dict(query, _count=count, _offset=offset + count)
+                if elements:
+                    next_query["_elements"] = elements
+                bundle["link"].append({"relation": "next",
+                                       "url": f"{self.server.stub.url}/{parts[0]}?{urlencode(next_query)}"})
+        self._reply(200, bundle)
+
+class StubServer:
+    """
+    在背景執行緒啟動替身伺服器：
+        stub = StubServer(latency=0.01, error_rate=0.01).start()
+        client = FHIRClient(stub.url)
+    """
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.store = FHIRStore()
+        self.stats = {"requests": 0, "transactions": 0, "injected_errors": 0,
+                      "bytes_in": 0, "bytes_out": 0, "not_modified": 0}
+        self._stats_lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), StubHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.stub = self
+        self.url = f"http://{host}:{self.httpd.server_port}"
+        self._thread = None
+
+    def count(self, name, amount=1):
+        with self._stats_lock:
+            self.stats[name] += amount
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fhir-stub", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+# 測試區
+if __name__ == "__main__":
+    import argparse
+
+    # 用法: python fhir_stub.py --port 8080 --latency 0.02 --error-rate 0.01
+    # 然後以 FHIR_SERVER_URL=http://127.0.0.1:8080 streamlit run app.py 指向這台伺服器
+    parser = argparse.ArgumentParser(description="Minimal in-process FHIR R4 stub server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="每個請求固定延遲 (秒)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="額外隨機延遲上限 (秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="回 503 的機率 (0~1)")
+    args = parser.parse_args()
+
+    stub = StubServer(args.host, args.port, args.latency, args.jitter, args.error_rate)
+    print(f"FHIR stub listening on {stub.url}")
+    try:
+        stub.httpd.serve_forever()
+    except KeyboardInterrupt:
+        stub.stop()
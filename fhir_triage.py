@@ -0,0 +1,294 @@
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit, parse_qsl
+
+import numpy as np
+import pandas as pd
+
+from fhir_gateway import OBSERVATION_SPECS, BP_PANEL_CODE, PATIENT_ID_SYSTEM
+from rule_engine import get_engine
+
+# 多病人分流看板 (Triage Board)：醫療中心同時看數百位病人最新的生理數值與 AI 風險
+# - 增量同步：每種資源記住看過的最大 meta.lastUpdated (watermark)，下次只搜尋 _lastUpdated=ge{watermark}
+#   (用 ge 而不是 gt，避免同一毫秒寫入的資源被漏掉；watermark 那一刻已看過的 ID 會被略過)
+# - _count 分頁 + 跟著 next 連結走，_elements 只取需要的欄位，_sort=_lastUpdated 讓中途停下也能接續
+# - 結果併入以病人 ID 為索引的 pandas DataFrame，每次刷新只處理增量 (delta)
+# - 第一次同步只往回看 lookback 秒，避免把公用伺服器上的所有資料拉下來
+# - 只搜尋本專案的病人 (identifier 系統為 PATIENT_ID_SYSTEM)：公用伺服器上還有其他人寫入的資料
+
+# LOINC -> 欄位名 (血壓面板拆成收縮壓 / 舒張壓兩欄)
+LOINC_COLUMNS = {code: param for param, code, _, _, _ in OBSERVATION_SPECS}
+BP_COMPONENT_COLUMNS = {"8480-6": "sys_bp", "8462-4": "dia_bp"}
+# 其他代碼系統的同義代碼 (例如 FHIR_json/Bundle.json 的睡眠時長用 SNOMED CT)
+CODE_ALIASES = {("http://snomed.info/sct", "248263006"): "sleep"}
+VITAL_COLUMNS = [param for param, _, _, _, _ in OBSERVATION_SPECS] + ["sys_bp", "dia_bp"]
+COLUMNS = ["user_id", "name"] + VITAL_COLUMNS + ["obs_time", "status", "probability", "description", "risk_time"]
+
+# 每種資源只拿分流需要的欄位
+ELEMENTS = {
+    "Patient": "identifier,name",
+    "Observation": "subject,code,valueQuantity,component,effectiveDateTime",
+    "RiskAssessment": "subject,prediction,occurrenceDateTime",
+}
+
+# 每種資源的範圍條件：Patient 看自己的 identifier，其他資源以 chained search 限定 subject
+SCOPE = {
+    "Patient": {"identifier": f"{PATIENT_ID_SYSTEM}|"},
+    "Observation": {"subject:Patient.identifier": f"{PATIENT_ID_SYSTEM}|"},
+    "RiskAssessment": {"subject:Patient.identifier": f"{PATIENT_ID_SYSTEM}|"},
+}
+
+def _last_updated(resource):
+    """meta.lastUpdated (伺服器沒給 meta 時為空字串)"""
+    return (resource.get("meta") or {}).get("lastUpdated") or ""
+
+def _patient_id(resource):
+    ref = resource.get("subject", {}).get("reference", "")
+    return ref.split("/")[-1] if ref.startswith("Patient/") or "/Patient/" in ref else None
+
+def _loinc(concept):
+    for coding in (concept or {}).get("coding", []):
+        if coding.get("system") in (None, "http://loinc.org"):
+            return coding.get("code")
+    return None
+
+def observation_values(resource):
+    """Observation -> [(欄位名, 數值)]；不認得的代碼回傳空清單"""
+    code = _loinc(resource.get("code"))
+    if code == BP_PANEL_CODE:
+        out = []
+        for component in resource.get("component", []):
+            column = BP_COMPONENT_COLUMNS.get(_loinc(component.get("code")))
+            value = component.get("valueQuantity", {}).get("value")
+            if column and value is not None:
+                out.append((column, value))
+        return out
+    column = LOINC_COLUMNS.get(code)
+    if column is None:
+        column = next((CODE_ALIASES[key] for key in ((c.get("system"), c.get("code"))
+                       for c in resource.get("code", {}).get("coding", [])) if key in CODE_ALIASES), None)
+    value = resource.get("valueQuantity", {}).get("value")
+    return [(column, value)] if column and value is not None else []
+
+class TriageBoard:
+    """
+    board = TriageBoard(get_client(url))
+    board.refresh()   # 只搬移上次之後的新資料
+    board.view()      # 依嚴重度排序的 DataFrame
+    """
+    def __init__(self, client, page_size=200, max_pages=20, lookback=3600):
+        self.client = client
+        self.page_size = page_size
+        self.max_pages = max_pages # 每次刷新每種資源最多翻幾頁，剩下的下次接著拿
+        start = (datetime.now(timezone.utc) - timedelta(seconds=lookback)).isoformat()
+        self._marks = {rtype: start for rtype in ELEMENTS} # resourceType -> watermark
+        self._seen = {rtype: set() for rtype in ELEMENTS} # watermark 那一刻已處理的 ID
+        self._lock = threading.Lock()
+        self.frame = pd.DataFrame({c: pd.Series(dtype=float if c in VITAL_COLUMNS + ["probability"] else object)
+                                   for c in COLUMNS}, index=pd.Index([], dtype=object, name="patient_id"))
+        self.requests = 0
+
+        # 風險等級代碼 -> 狀態 (critical -> emergency ...)，排序用的嚴重度 (rules.json 的順序)
+        rules = get_engine().rules
+        self._status_by_code = {level: status for status, (level, _) in rules.meta.items()}
+        self._severity = {level["status"]: i for i, level in enumerate(rules.levels)}
+        self._severity[rules.default["status"]] = len(rules.levels)
+
+    # --- 增量搜尋 ---
+    def _search(self, rtype):
+        """回傳 watermark 之後的新資源 (依 lastUpdated 排序)，並推進 watermark"""
+        mark = self._marks[rtype]
+        params = dict(SCOPE[rtype], _lastUpdated=f"ge{mark}", _sort="_lastUpdated",
+                      _count=self.page_size, _elements=ELEMENTS[rtype])
+        resources = []
+        for _ in range(self.max_pages):
+            response = self.client.request("GET", rtype, params=params)
+            self.requests += 1
+            response.raise_for_status()
+            bundle = response.json()
+            resources.extend(e["resource"] for e in bundle.get("entry", []) if "resource" in e)
+            next_url = next((link["url"] for link in bundle.get("link", []) if link.get("relation") == "next"), None)
+            if next_url is None:
+                break
+            params = dict(parse_qsl(urlsplit(next_url).query))
+
+        seen = self._seen[rtype]
+        fresh = [r for r in resources if not (_last_updated(r) == mark and r.get("id") in seen)]
+        stamped = [r for r in fresh if _last_updated(r)]
+        if stamped: # 沒有 meta.lastUpdated 的資源照常併入，但不拿來推進 watermark
+            new_mark = max(_last_updated(r) for r in stamped)
+            at_mark = {r.get("id") for r in stamped if _last_updated(r) == new_mark}
+            self._seen[rtype] = at_mark | seen if new_mark == mark else at_mark
+            self._marks[rtype] = new_mark
+        return fresh
+
+    # --- 併入快取 ---
+    def _upsert(self, delta):
+        """delta: 以病人 ID 為索引的 DataFrame；只覆寫非空值"""
+        if delta.empty:
+            return
+        new = delta.index.difference(self.frame.index)
+        if len(new):
+            self.frame = pd.concat([self.frame, pd.DataFrame(index=pd.Index(new, name="patient_id"),
+                                                              columns=self.frame.columns).astype(self.frame.dtypes)])
+        for column in delta.columns:
+            values = delta[column].dropna()
+            if len(values):
+                self.frame.loc[values.index, column] = values
+
+    def _merge_patients(self, resources):
+        rows = {}
+        for r in resources:
+            user_id = next((i.get("value") for i in r.get("identifier", []) if i.get("system") == PATIENT_ID_SYSTEM), None)
+            names = r.get("name") or [{}]
+            given = " ".join(names[0].get("given", []))
+            rows[r["id"]] = {"user_id": user_id, "name": given or names[0].get("family")}
+        self._upsert(pd.DataFrame.from_dict(rows, orient="index"))
+
+    def _merge_observations(self, resources):
+        pids, columns, values, times = [], [], [], []
+        for r in resources:
+            pid = _patient_id(r)
+            if pid is None:
+                continue
+            for column, value in observation_values(r):
+                pids.append(pid)
+                columns.append(column)
+                values.append(value)
+                times.append(r.get("effectiveDateTime") or _last_updated(r))
+        if not pids:
+            return
+        long = pd.DataFrame({"pid": pids, "column": columns, "value": np.asarray(values, dtype=float), "time": times})
+        # 同一位病人同一欄位只留最新的一筆
+        latest = long.sort_values("time", kind="stable").drop_duplicates(["pid", "column"], keep="last")
+        delta = latest.pivot(index="pid", columns="column", values="value")
+        delta["obs_time"] = latest.groupby("pid")["time"].max()
+        self._upsert(delta)
+
+    def _merge_risks(self, resources):
+        rows = {}
+        for r in sorted(resources, key=lambda r: r.get("occurrenceDateTime") or ""):
+            pid = _patient_id(r)
+            prediction = (r.get("prediction") or [{}])[0]
+            if pid is None:
+                continue
+            code = next((c.get("code") for c in prediction.get("qualitativeRisk", {}).get("coding", [])), None)
+            rows[pid] = {"status": self._status_by_code.get(code, code),
+                         "probability": prediction.get("probabilityDecimal"),
+                         "description": prediction.get("outcome", {}).get("text"),
+                         "risk_time": r.get("occurrenceDateTime")}
+        self._upsert(pd.DataFrame.from_dict(rows, orient="index"))
+
+    def refresh(self):
+        """抓取並併入所有新資料，回傳這次搬了多少資料"""
+        with self._lock:
+            t0 = time.perf_counter()
+            requests_before = self.requests
+            patients = self._search("Patient")
+            observations = self._search("Observation")
+            risks = self._search("RiskAssessment")
+            t1 = time.perf_counter()
+            self._merge_patients(patients)
+            self._merge_observations(observations)
+            self._merge_risks(risks)
+            return {"patients": len(patients), "observations": len(observations), "risks": len(risks),
+                    "requests": self.requests - requests_before, "seconds": time.perf_counter() - t0,
+                    "merge_seconds": time.perf_counter() - t1,
+                    "total_patients": len(self.frame)}
+
+    def view(self):
+        """依嚴重度 (急救 > 預防 > 正常 > 尚未評估) 與機率排序"""
+        with self._lock:
+            frame = self.frame.copy()
+        severity = frame["status"].map(self._severity).fillna(len(self._severity)).astype(float)
+        order = np.lexsort((-frame["probability"].fillna(0).to_numpy(), severity.to_numpy()))
+        return frame.iloc[order]
+
+# --- 每個伺服器共用一個看板 (Streamlit 各個 Session 共用同步結果) ---
+_boards = {}
+_boards_lock = threading.Lock()
+
+def get_board(client, **options):
+    with _boards_lock:
+        board = _boards.get(client.base_url)
+        if board is None:
+            board = _boards[client.base_url] = TriageBoard(client, **options)
+        return board
+
+# 測試區
+if __name__ == "__main__":
+    import random
+    from fhir_client import FHIRClient
+    from fhir_stub import StubServer
+    from fhir_gateway import create_raw_data_bundle, register_patient_response, patient_cache
+    from ai_engine import analyze_and_create_report
+
+    stub = StubServer().start()
+    client = FHIRClient(stub.url)
+    rng = random.Random(0)
+
+    def upload(user_id):
+        v = {"hr": rng.randint(45, 180), "spo2": rng.randint(82, 100), "hrv": rng.randint(15, 90),
+             "stress": rng.randint(0, 100), "sys_bp": rng.randint(100, 190), "dia_bp": 70, "resp": 16, "sleep": 7}
+        bundle, pid, _ = create_raw_data_bundle(user_id, user_id, v["hr"], v["spo2"], v["sys_bp"], v["dia_bp"],
+                                                v["resp"], v["hrv"], v["stress"], v["sleep"], 25.0, 121.0)
+        pid = register_patient_response(user_id, client.post_bundle(bundle).json()) or pid
+        report, status, _, _ = analyze_and_create_report(v, pid)
+        client.post_bundle(report)
+        return pid, v, status
+
+    # 正確性：看板內容與最後一次上傳一致，之後的刷新只搬新資料
+    board = TriageBoard(client, page_size=50)
+    expected = {}
+    for i in range(30):
+        pid, v, status = upload(f"T{i:03d}")
+        expected[pid] = (v, status)
+    print("initial", board.refresh())
+    pid, v, status = upload("T007")
+    expected[pid] = (v, status)
+    stats = board.refresh()
+    print("delta  ", stats)
+    assert stats["observations"] == 7 and stats["risks"] == 1 and stats["patients"] == 0
+    assert board.refresh()["observations"] == 0
+    for pid, (v, status) in expected.items():
+        row = board.frame.loc[pid]
+        assert all(row[c] == v[c] for c in VITAL_COLUMNS), (pid, row)
+        assert row["status"] == status
+    top = board.view().iloc[0]
+    assert top["status"] in ("emergency", "preventive") or not (board.frame["status"] == "emergency").any()
+    print("Parity OK:", len(board.frame), "patients")
+
+    # 範圍：其他系統的病人與資料不會被拉進看板；沒有 meta 的資源不會讓合併失敗
+    foreign = {"resourceType": "Bundle", "type": "transaction", "entry": [
+        {"fullUrl": "urn:uuid:f1", "resource": {"resourceType": "Patient",
+                                               "identifier": [{"system": "urn:other", "value": "X1"}]},
+         "request": {"method": "POST", "url": "Patient"}},
+        {"resource": {"resourceType": "Observation", "status": "final", "subject": {"reference": "urn:uuid:f1"},
+                      "code": {"coding": [{"system": "http://loinc.org", "code": "8867-4"}]},
+                      "valueQuantity": {"value": 60}},
+         "request": {"method": "POST", "url": "Observation"}}]}
+    client.post_bundle(foreign)
+    stats = board.refresh()
+    assert stats["patients"] == 0 and stats["observations"] == 0, stats
+    board._merge_observations([{"subject": {"reference": "Patient/zz"},
+                                "code": {"coding": [{"code": "8867-4"}]}, "valueQuantity": {"value": 1}}])
+    board.frame = board.frame.drop(index="zz")
+    print("Scope OK: other systems' patients are not fetched")
+
+    # 規模：病人數增加時，一次只有 10 位病人有新數據的刷新成本 (客戶端合併 + 請求數)
+    print(f"{'patients':>9s}{'delta refresh ms':>18s}{'merge ms':>10s}{'requests':>10s}")
+    total = 30
+    for target in (100, 500, 2000):
+        for i in range(total, target):
+            upload(f"T{i:05d}")
+        total = target
+        while board.refresh()["requests"] > len(ELEMENTS): # 先把這批新病人同步完
+            pass
+        for i in range(10):
+            upload(f"T{rng.randrange(total):05d}")
+        stats = board.refresh()
+        print(f"{len(board.frame):9d}{stats['seconds'] * 1000:18.1f}"
+              f"{stats['merge_seconds'] * 1000:10.2f}{stats['requests']:10d}")
+    client.close()
+    stub.stop()
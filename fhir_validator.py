@@ -0,0 +1,352 @@
+import re
+import threading
+
+from fhir_gateway import OBSERVATION_SPECS, BP_PANEL_CODE
+
+# 本地預檢 (Pre-flight Validation)：送出前先檢查本專案產生的資源格式，不必等伺服器來回一趟才發現錯誤
+# - 涵蓋 Patient / Observation (含血壓面板 component 與 geolocation extension) / RiskAssessment /
+#   ServiceRequest / CommunicationRequest；其他資源類型只做 Bundle 層級的檢查
+# - 每種 (資源類型, profile) 的檢查第一次用到時編譯成一串函式並快取，之後每次只是依序呼叫
+# - 回傳問題清單 ["entry[2] Observation.subject: required", ...]，空清單代表通過
+
+UCUM = "http://unitsofmeasure.org"
+LOINC = "http://loinc.org"
+GEOLOCATION_URL = "http://hl7.org/fhir/StructureDefinition/geolocation"
+VITALSIGNS_PROFILE = "http://hl7.org/fhir/StructureDefinition/vitalsigns"
+
+# LOINC -> 應使用的 UCUM 單位 (與 fhir_gateway / fhir_stream 送出的一致)
+EXPECTED_UNITS = {code: unit_code for _, code, _, _, unit_code in OBSERVATION_SPECS}
+BP_COMPONENT_UNITS = {"8480-6": "mm[Hg]", "8462-4": "mm[Hg]"}
+
+_REFERENCE = re.compile(r"^(urn:uuid:[0-9a-fA-F-]{36}|[A-Z][A-Za-z]+/[A-Za-z0-9\-.]{1,64})$")
+_DATETIME = re.compile(r"^\d{4}(-\d{2}(-\d{2}(T\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:\d{2}))?)?)?$")
+# 程式裡常見的「沒有 ID 時的替代值」，送出去會變成指向不存在資源的引用
+_PLACEHOLDER_IDS = {"unknown", "None", "null", "undefined", ""}
+
+class ValidationError(ValueError):
+    """Bundle 沒有通過預檢；issues 為問題清單"""
+    def __init__(self, issues):
+        super().__init__("; ".join(issues))
+        self.issues = issues
+
+# === 1. 檢查積木：每個函式回傳 check(resource, report) ===
+def _get(resource, path):
+    for key in path:
+        if not isinstance(resource, dict):
+            return None
+        resource = resource.get(key)
+    return resource
+
+def required(*path):
+    name = ".".join(path)
+    def check(resource, report):
+        if _get(resource, path) in (None, "", [], {}):
+            report(name, "required")
+    return check
+
+def one_of(*paths):
+    """choice 型別 (例如 value[x])：至少要有其中一個"""
+    names = " | ".join(".".join(p) for p in paths)
+    def check(resource, report):
+        if all(_get(resource, p) in (None, [], {}) for p in paths):
+            report(names, "required")
+    return check
+
+def code_in(path, allowed):
+    name = ".".join(path)
+    allowed = frozenset(allowed)
+    def check(resource, report):
+        value = _get(resource, path)
+        if value is not None and value not in allowed:
+            report(name, f"{value!r} not in {sorted(allowed)}")
+    return check
+
+def reference(path, types=None):
+    name = ".".join(path)
+    def check(resource, report):
+        ref = _get(resource, path)
+        if ref is not None:
+            _check_reference(name, ref, types, report)
+    return check
+
+def references(path, types=None):
+    """Reference 陣列 (例如 reasonReference)"""
+    name = ".".join(path)
+    def check(resource, report):
+        for i, item in enumerate(_get(resource, path) or []):
+            _check_reference(f"{name}[{i}].reference", item.get("reference"), types, report)
+    return check
+
+def _check_reference(name, ref, types, report):
+    if not isinstance(ref, str) or not _REFERENCE.match(ref):
+        report(name, f"malformed reference {ref!r}")
+        return
+    if ref.startswith("urn:uuid:"):
+        return
+    rtype, rid = ref.split("/", 1)
+    if rid in _PLACEHOLDER_IDS:
+        report(name, f"placeholder id in {ref!r}")
+    elif types and rtype not in types:
+        report(name, f"must reference {' | '.join(types)}, got {rtype}")
+
+def is_datetime(path):
+    name = ".".join(path)
+    def check(resource, report):
+        value = _get(resource, path)
+        if value is not None and (not isinstance(value, str) or not _DATETIME.match(value)):
+            report(name, f"invalid dateTime {value!r}")
+    return check
+
+def _coding_code(concept, system):
+    for coding in (concept or {}).get("coding", []):
+        if coding.get("system") == system:
+            return coding.get("code")
+    return None
+
+def _check_quantity(name, quantity, unit_code, report):
+    if quantity.get("system") != UCUM:
+        report(f"{name}.system", f"must be {UCUM}")
+    if unit_code is not None and quantity.get("code") != unit_code:
+        report(f"{name}.code", f"expected UCUM {unit_code!r}, got {quantity.get('code')!r}")
+
+def _check_value(name, holder, unit_code, report):
+    """valueQuantity 或 valueSampledData (串流模式) 的數值與單位"""
+    name = f"{name}." if name else ""
+    if "valueQuantity" in holder:
+        quantity = holder["valueQuantity"]
+        _check_quantity(f"{name}valueQuantity", quantity, unit_code, report)
+        value = quantity.get("value")
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            report(f"{name}valueQuantity.value", f"must be a number, got {value!r}")
+    elif "valueSampledData" in holder:
+        sampled = holder["valueSampledData"]
+        _check_quantity(f"{name}valueSampledData.origin", sampled.get("origin", {}), unit_code, report)
+        if not isinstance(sampled.get("period"), (int, float)) or not sampled.get("data"):
+            report(f"{name}valueSampledData", "period and data are required")
+
+def observation_value(resource, report):
+    """依 LOINC 代碼檢查單位；血壓面板改檢查 component"""
+    code = _coding_code(resource.get("code"), LOINC)
+    if code == BP_PANEL_CODE:
+        components = resource.get("component") or []
+        seen = set()
+        for i, component in enumerate(components):
+            ccode = _coding_code(component.get("code"), LOINC)
+            if ccode not in BP_COMPONENT_UNITS:
+                report(f"component[{i}].code", f"unexpected code {ccode!r} in blood pressure panel")
+                continue
+            seen.add(ccode)
+            _check_value(f"component[{i}]", component, BP_COMPONENT_UNITS[ccode], report)
+        for missing in sorted(set(BP_COMPONENT_UNITS) - seen):
+            report("component", f"blood pressure panel missing {missing}")
+        return
+    if not any(k in resource for k in ("valueQuantity", "valueSampledData", "component", "dataAbsentReason")):
+        report("value[x]", "required")
+        return
+    _check_value("", resource, EXPECTED_UNITS.get(code), report)
+
+def geolocation(resource, report):
+    """本專案把 GPS 以 "lat,lon" 文字放在 geolocation extension 的 valueAddress"""
+    for i, ext in enumerate(resource.get("extension") or []):
+        if ext.get("url") != GEOLOCATION_URL:
+            continue
+        text = (ext.get("valueAddress") or {}).get("text")
+        try:
+            lat, lon = (float(x) for x in text.split(","))
+            ok = -90 <= lat <= 90 and -180 <= lon <= 180
+        except (AttributeError, ValueError):
+            ok = False
+        if not ok:
+            report(f"extension[{i}].valueAddress.text", f"expected 'lat,lon', got {text!r}")
+
+def identifiers(resource, report):
+    for i, ident in enumerate(resource.get("identifier") or []):
+        if not ident.get("system") or not ident.get("value"):
+            report(f"identifier[{i}]", "system and value are required")
+
+def risk_prediction(resource, report):
+    for i, prediction in enumerate(resource.get("prediction") or []):
+        p = prediction.get("probabilityDecimal")
+        if p is not None and (isinstance(p, bool) or not isinstance(p, (int, float)) or not 0 <= p <= 1):
+            report(f"prediction[{i}].probabilityDecimal", f"must be a number in [0, 1], got {p!r}")
+
+def vitalsigns_profile(resource, report):
+    if not (_get(resource, ("effectiveDateTime",)) or _get(resource, ("effectivePeriod",))):
+        report("effective[x]", "required by vitalsigns profile")
+
+# === 2. 各資源類型的規格 ===
+SPECS = {
+    "Patient": [
+        identifiers,
+        code_in(("gender",), ("male", "female", "other", "unknown")),
+    ],
+    "Observation": [
+        required("status"),
+        code_in(("status",), ("registered", "preliminary", "final", "amended", "corrected", "cancelled",
+                              "entered-in-error", "unknown")),
+        required("code", "coding"),
+        required("subject", "reference"),
+        reference(("subject", "reference"), ("Patient",)),
+        is_datetime(("effectiveDateTime",)),
+        observation_value,
+        geolocation,
+    ],
+    "RiskAssessment": [
+        required("status"),
+        code_in(("status",), ("registered", "preliminary", "final", "amended", "corrected", "cancelled",
+                              "entered-in-error", "unknown")),
+        required("subject", "reference"),
+        reference(("subject", "reference"), ("Patient",)),
+        is_datetime(("occurrenceDateTime",)),
+        required("prediction"),
+        risk_prediction,
+    ],
+    "ServiceRequest": [
+        required("status"),
+        code_in(("status",), ("draft", "active", "on-hold", "revoked", "completed", "entered-in-error", "unknown")),
+        required("intent"),
+        code_in(("intent",), ("proposal", "plan", "directive", "order", "original-order", "reflex-order",
+                              "filler-order", "instance-order", "option")),
+        code_in(("priority",), ("routine", "urgent", "asap", "stat")),
+        required("code", "coding"),
+        required("subject", "reference"),
+        reference(("subject", "reference"), ("Patient", "Group", "Location", "Device")),
+        references(("reasonReference",), ("Condition", "Observation", "DiagnosticReport",
+                                          "DocumentReference", "RiskAssessment")),
+    ],
+    "CommunicationRequest": [
+        required("status"),
+        code_in(("status",), ("draft", "active", "on-hold", "revoked", "completed", "entered-in-error", "unknown")),
+        code_in(("priority",), ("routine", "urgent", "asap", "stat")),
+        required("subject", "reference"),
+        reference(("subject", "reference"), ("Patient", "Group")),
+        one_of(("payload",), ("reasonCode",)),
+        is_datetime(("authoredOn",)),
+    ],
+}
+
+# profile 額外的檢查 (meta.profile 有列出時才套用)
+PROFILE_SPECS = {
+    ("Observation", VITALSIGNS_PROFILE): [vitalsigns_profile],
+}
+
+# === 3. 編譯與快取 ===
+_compiled = {}
+_compiled_lock = threading.Lock()
+
+def compiled_checks(rtype, profile=None):
+    """(資源類型, profile) -> 檢查函式 tuple；只編譯一次"""
+    key = (rtype, profile)
+    checks = _compiled.get(key)
+    if checks is None:
+        with _compiled_lock:
+            checks = _compiled.get(key)
+            if checks is None:
+                checks = tuple(SPECS.get(rtype, ())) + tuple(PROFILE_SPECS.get(key, ()))
+                _compiled[key] = checks
+    return checks
+
+def validate_resource(resource, prefix=""):
+    """回傳問題清單 (空清單 = 通過)"""
+    issues = []
+    rtype = resource.get("resourceType")
+    if not rtype:
+        return [f"{prefix}resourceType: required"]
+    report = lambda path, message: issues.append(f"{prefix}{rtype}.{path}: {message}")
+    for profile in (resource.get("meta") or {}).get("profile") or [None]:
+        for check in compiled_checks(rtype, profile):
+            check(resource, report)
+    return issues
+
+def validate_bundle(bundle):
+    """檢查 transaction Bundle 與每個 entry 的資源；urn:uuid 引用必須指向同一個 Bundle 內的 fullUrl"""
+    if bundle.get("resourceType") != "Bundle":
+        return validate_resource(bundle)
+    issues = []
+    if bundle.get("type") not in ("transaction", "batch", "collection", "searchset", "transaction-response"):
+        issues.append(f"Bundle.type: invalid {bundle.get('type')!r}")
+    entries = bundle.get("entry") or []
+    full_urls = {e.get("fullUrl") for e in entries}
+    for i, entry in enumerate(entries):
+        prefix = f"entry[{i}] "
+        resource = entry.get("resource")
+        if not isinstance(resource, dict):
+            issues.append(f"{prefix}resource: required")
+            continue
+        if bundle.get("type") in ("transaction", "batch"):
+            request = entry.get("request") or {}
+            if request.get("method") not in ("GET", "HEAD", "POST", "PUT", "DELETE", "PATCH"):
+                issues.append(f"{prefix}request.method: invalid {request.get('method')!r}")
+            url = request.get("url") or ""
+            if url.split("/")[0].split("?")[0] != resource.get("resourceType"):
+                issues.append(f"{prefix}request.url: {url!r} does not match {resource.get('resourceType')}")
+            # conditional create 用的 identifier 必須真的在資源上，否則每次都會建立新病人
+            condition = request.get("ifNoneExist") or ""
+            if condition.startswith("identifier="):
+                system, _, value = condition[len("identifier="):].rpartition("|")
+                if not any(i.get("value") == value and (not system or i.get("system") == system)
+                           for i in resource.get("identifier") or []):
+                    issues.append(f"{prefix}request.ifNoneExist: {condition!r} does not match resource identifier")
+        issues.extend(validate_resource(resource, prefix))
+        subject = _get(resource, ("subject", "reference"))
+        if isinstance(subject, str) and subject.startswith("urn:uuid:") and subject not in full_urls:
+            issues.append(f"{prefix}{resource.get('resourceType')}.subject.reference: {subject} not in bundle")
+    return issues
+
+def check_bundle(bundle):
+    """有問題就丟 ValidationError"""
+    issues = validate_bundle(bundle)
+    if issues:
+        raise ValidationError(issues)
+
+# 測試區
+if __name__ == "__main__":
+    import os
+    import json
+    import time
+    import copy
+    from fhir_gateway import create_raw_data_bundle
+    from ai_engine import analyze_and_create_report
+    from fhir_stream import SampledDataStream
+
+    # 本專案產生的資源都要通過
+    bundle, pid, _ = create_raw_data_bundle("A123", "Test", 75, 98, 110, 70, 16, 50, 20, 7, 25.0, 121.0)
+    report, _, _, risk_id = analyze_and_create_report({"hr": 180, "spo2": 98, "hrv": 50, "stress": 20, "sleep": 7,
+                                                        "sys_bp": 110}, "987")
+    stream = SampledDataStream()
+    for t in range(10):
+        stream.add_reading("Patient/987", t=1_700_000_000 + t, hr=70 + t, sys_bp=120, dia_bp=80)
+    sr = {"resourceType": "Bundle", "type": "transaction", "entry": [{"resource": {
+        "resourceType": "ServiceRequest", "status": "active", "intent": "order", "priority": "stat",
+        "code": {"coding": [{"system": "http://snomed.info/sct", "code": "40617009"}]},
+        "subject": {"reference": "Patient/987"}, "reasonReference": [{"reference": f"RiskAssessment/{risk_id}"}]},
+        "request": {"method": "POST", "url": "ServiceRequest"}}]}
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "FHIR_json", "Bundle.json"), encoding="utf-8") as f:
+        sample = json.load(f)
+    for good in (bundle, report, stream.flush(), sr, sample):
+        assert validate_bundle(good) == [], validate_bundle(good)
+
+    # 常見錯誤
+    bad = copy.deepcopy(bundle)
+    del bad["entry"][1]["resource"]["subject"]
+    bad["entry"][2]["resource"]["valueQuantity"]["code"] = "percent"
+    bad["entry"][7]["resource"]["component"].pop()
+    bad["entry"][7]["resource"]["extension"][0]["valueAddress"]["text"] = "25.0"
+    bad["entry"][0]["resource"]["identifier"][0]["value"] = "A124"
+    bad_sr = copy.deepcopy(sr)
+    bad_sr["entry"][0]["resource"]["reasonReference"] = [{"reference": "RiskAssessment/unknown"}]
+    bad_sr["entry"][0]["resource"]["subject"] = {"reference": "Patient/None"}
+    issues = validate_bundle(bad) + validate_bundle(bad_sr)
+    for issue in issues:
+        print("  ", issue)
+    assert len(issues) == 7
+
+    # 每個 Bundle 的成本
+    n = 20000
+    bundles = [create_raw_data_bundle(f"U{i}", "Bench", 75, 98, 110, 70, 16, 50, 20, 7, 25.0, 121.0)[0]
+               for i in range(200)]
+    t0 = time.perf_counter()
+    for i in range(n):
+        validate_bundle(bundles[i % 200])
+    per_bundle = (time.perf_counter() - t0) / n * 1e6
+    print(f"Pre-flight validation: {per_bundle:.1f} us per 8-entry bundle | cached checks: {len(_compiled)}")
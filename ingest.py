@@ -0,0 +1,499 @@
+import os
+import sys
+import time
+import queue
+import pickle
+import random
+import signal
+import hashlib
+import argparse
+import threading
+import socketserver
+import multiprocessing as mp
+
+from fast_json import dumps, loads
+
+# 多 process 分片收資料 (Sharded Ingestion)：單一 process 跑 gateway + 規則引擎 + 上傳只能用到一個核心。
+# - 原始生理數據從本地佇列 (IngestService.submit) 或 TCP socket (每行一筆 JSON) 進來
+# - 依病人 identifier 的 hash 分到 N 個 worker process 之一；同一位病人永遠在同一個 worker、
+#   同一條佇列，依序處理，所以每位病人的順序不會亂
+# - 每個 worker 有自己的病人狀態：身分快取 (patient_cache)、變化偵測 (ChangeDetector)、
+#   滾動統計 (RollingVitalsStore) 與上次上傳的風險狀態；跑 create_raw_data_bundle →
+#   上傳 → analyze_and_create_report → 風險狀態改變時上傳 RiskAssessment
+# - 重啟單一 worker 時先交接：舊 worker 處理完佇列中已排在前面的資料，把狀態交回主 process，
+#   新 worker 接手同一條佇列 (後來的資料在佇列裡等著，順序不變)
+# - 關閉時每個 worker 處理完佇列才結束，狀態可存成檔案，下次啟動 (worker 數相同時) 接著用
+# - worker 意外結束 (OOM、segfault ...) 時，以它最後交接 / 啟動時的狀態重新啟動，繼續消化同一條佇列
+#   (它手上那一批會遺失；變化偵測的狀態較舊，只會多送幾筆 Observation)
+# - --sampled SECONDS：高頻串流模式，已註冊過的病人的讀數交給 fhir_stream.SampledDataStream，
+#   每 SECONDS 秒把每個參數打包成一筆 valueSampledData Observation (取代每筆讀數一個 Bundle)；
+#   病人第一筆 (還沒有伺服器 ID) 照一般流程上傳以註冊 Patient；緩衝在交接 / 關閉時送出，worker 意外結束時遺失
+#
+# 用法:
+#   python ingest.py --workers 4 --listen 127.0.0.1:9400 --server http://127.0.0.1:8080 --state ingest_state/
+#   python ingest.py --bench 20000 --bench-workers 1,2,4,8       # 不指定 --server 時只序列化不上傳
+#   python ingest.py --workers 4 --server http://127.0.0.1:8080 --sampled 30   # 高頻串流模式
+#
+# 每筆資料: {"user_id": "A123", "name": "...", "hr": 75, "spo2": 98, "sys_bp": 110, "dia_bp": 70,
+#           "resp": 16, "hrv": 50, "stress": 20, "sleep": 7, "lat": 25.03, "lon": 121.56, "t": <epoch 秒>}
+
+VITAL_FIELDS = ("hr", "spo2", "sys_bp", "dia_bp", "resp", "hrv", "stress", "sleep")
+TREND_FIELDS = ("hr", "hrv", "spo2", "stress", "sys_bp", "dia_bp")
+
+def shard_of(user_id, n_shards):
+    """穩定的分片 (不能用內建 hash()：每個 process 的字串 hash 種子不同)"""
+    digest = hashlib.blake2b(str(user_id).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % n_shards
+
+# === 1. Worker process ===
+def _new_state():
+    """
+    一個 worker 的所有病人狀態 (整包 pickle 交接)；用 dict 而不是自訂類別，
+    因為 worker 以 spawn 啟動時本模組叫 __mp_main__，自訂類別存檔後在別的 process 讀不回來
+    """
+    from fhir_gateway import PatientIdentityCache, ChangeDetector
+    from vitals_state import RollingVitalsStore
+    return {"patients": PatientIdentityCache(), "changes": ChangeDetector(), "trends": RollingVitalsStore(),
+            "last_status": {}, # user_id -> 上次上傳的風險狀態
+            "last_t": {}} # user_id -> 上次處理的資料時間 (檢查順序用)
+
+class _Worker:
+    def __init__(self, shard, server, state, sampled=None):
+        self.shard = shard
+        self.state = state or _new_state()
+        self.client = None
+        if server:
+            from fhir_client import FHIRClient
+            self.client = FHIRClient(server, pool_size=2, max_in_flight=1)
+        self.stream = None
+        if sampled:
+            from fhir_stream import SampledDataStream
+            self.stream = SampledDataStream(sink=self._post, flush_interval=sampled)
+            self._flushed_at = time.monotonic()
+        self.stats = {"readings": 0, "bundles": 0, "reports": 0, "skipped": 0, "errors": 0, "out_of_order": 0,
+                      "sampled": 0}
+
+    def flush(self, force=False):
+        """高頻串流模式：距上次送出超過 flush_interval 秒 (或 force) 就把緩衝打包送出"""
+        if self.stream is None or not (force or time.monotonic() - self._flushed_at >= self.stream.flush_interval):
+            return
+        self._flushed_at = time.monotonic()
+        try:
+            if self.stream.flush() is not None:
+                self.stats["bundles"] += 1
+        except Exception:
+            self.stats["errors"] += 1
+
+    def _post(self, bundle):
+        """上傳一個 Bundle；沒有伺服器時只序列化 (量測用)"""
+        if self.client is None:
+            dumps(bundle)
+            return None
+        res = self.client.post_bundle(bundle)
+        if res.status_code not in (200, 201):
+            raise RuntimeError(f"HTTP {res.status_code}")
+        return res
+
+    def handle(self, reading):
+        from fhir_gateway import create_raw_data_bundle, register_patient_response
+
+        state = self.state
+        user_id = reading["user_id"]
+        t = reading.get("t") or time.time()
+        # 比上一筆還舊的讀數 (順序錯亂)：不更新滾動統計與 AI 評估 (趨勢只跟著時間往前)
+        late = t < state["last_t"].get(user_id, t)
+        if late:
+            self.stats["out_of_order"] += 1
+        else:
+            state["last_t"][user_id] = t
+        self.stats["readings"] += 1
+
+        vitals = {field: reading[field] for field in VITAL_FIELDS}
+        server_id = state["patients"].get(user_id) if self.stream is not None else None
+        if server_id is not None:
+            # 高頻串流模式：讀數先緩衝，定時打包成 SampledData (不經變化偵測，每個樣本都保留)
+            # 晚到的讀數以它自己的時間放回所屬的時間窗 (該時段已送出就丟棄，見 SampledDataStream)
+            self.stream.add_reading(f"Patient/{server_id}", t=t, **vitals)
+            self.stats["sampled"] += 1
+            self.flush()
+            if not late:
+                self._assess(user_id, t, vitals, server_id)
+            return
+        if late:
+            # 一般模式的 Bundle 以「現在」為 effectiveDateTime，送出會蓋過較新的數值，直接略過
+            self.stats["skipped"] += 1
+            return
+        bundle, pid, _ = create_raw_data_bundle(
+            user_id, reading.get("name", user_id), vitals["hr"], vitals["spo2"], vitals["sys_bp"], vitals["dia_bp"],
+            vitals["resp"], vitals["hrv"], vitals["stress"], vitals["sleep"],
+            reading.get("lat", 0.0), reading.get("lon", 0.0), detector=state["changes"], cache=state["patients"])
+        try:
+            if bundle["entry"]:
+                res = self._post(bundle)
+                self.stats["bundles"] += 1
+                if res is not None:
+                    pid = register_patient_response(user_id, res.json(), state["patients"]) or pid
+            else:
+                self.stats["skipped"] += 1
+        except Exception:
+            state["changes"].forget(user_id) # 下次全部重送
+            self.stats["errors"] += 1
+            return
+        self._assess(user_id, t, vitals, pid)
+
+    def _assess(self, user_id, t, vitals, pid):
+        """更新滾動統計、跑 AI 評估；風險狀態改變時上傳 RiskAssessment"""
+        from ai_engine import analyze_and_create_report
+
+        state = self.state
+        trends = state["trends"]
+        trends.update(user_id, t=t, **{field: vitals[field] for field in TREND_FIELDS})
+        report, status, _, _ = analyze_and_create_report({**vitals, **trends.features(user_id)}, pid)
+        # 風險狀態沒變就不必每筆都寫一份 RiskAssessment
+        if status == state["last_status"].get(user_id):
+            return
+        try:
+            self._post(report)
+        except Exception:
+            self.stats["errors"] += 1
+            return
+        state["last_status"][user_id] = status
+        self.stats["reports"] += 1
+
+def _worker_main(shard, generation, inbox, results, server, state_bytes, sampled=None):
+    """
+    worker process 入口：依序處理佇列中的批次，收到控制訊息 (指令, 世代) 就交回狀態並結束
+    世代比自己舊的控制訊息是發給已經死掉的前一個 worker 的，略過
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl-C 由主 process 統一處理 (先排空再結束)
+    worker = _Worker(shard, server, pickle.loads(state_bytes) if state_bytes else None, sampled)
+    while True:
+        try:
+            batch = inbox.get(timeout=sampled) # 串流模式下沒有新資料時也要定時送出緩衝
+        except queue.Empty:
+            worker.flush()
+            continue
+        if isinstance(batch, tuple): # ("stop" / "handoff", 世代)
+            if batch[1] < generation:
+                continue
+            worker.flush(force=True) # 緩衝不交接，先送出
+            results.put((shard, generation, pickle.dumps(worker.state), worker.stats))
+            return
+        for reading in batch:
+            try:
+                worker.handle(reading)
+            except Exception:
+                worker.stats["errors"] += 1 # 欄位缺漏、格式錯誤或其他單筆失敗，不讓整個 worker 結束
+
+# === 2. 主 process：分片、交接、關閉 ===
+class IngestService:
+    """
+    workers: worker process 數 (分片數)
+    server: FHIR 伺服器 URL；None 時只組 Bundle + 序列化不上傳
+    state_dir: 關閉時把各分片狀態存成 shard-{i}.pkl，啟動時讀回 (分片數不同就忽略)
+    sampled: 高頻串流模式的打包間隔 (秒)；None 時每筆讀數各自上傳
+    """
+    def __init__(self, workers=4, server=None, state_dir=None, sampled=None):
+        self.n = workers
+        self.server = server
+        self.state_dir = state_dir
+        self.sampled = sampled
+        self._ctx = mp.get_context("spawn") # 主 process 有執行緒 (socket 服務)，不用 fork
+        self.inboxes = [self._ctx.Queue() for _ in range(workers)]
+        self.results = [self._ctx.Queue() for _ in range(workers)] # 每個分片各一條，worker 死掉時只影響自己那條
+        self.procs = [None] * workers
+        self.generations = [0] * workers # 每次啟動 worker 加一，控制訊息帶著它
+        self.last_states = [None] * workers # 各分片最後一次交回 (或啟動時) 的狀態，worker 死掉時用來重啟
+        self.stats = [{} for _ in range(workers)] # 已結束的 worker 累計的統計
+        self.restarts = 0
+        self.crashes = 0
+        self._lock = threading.Lock()
+        self._submit_lock = threading.Lock() # 換佇列時擋住 submit，保持順序
+        self._closed = False
+
+    def _state_path(self, shard):
+        return os.path.join(self.state_dir, f"shard-{shard}.pkl")
+
+    def _load_states(self):
+        if not self.state_dir:
+            return [None] * self.n
+        try:
+            with open(os.path.join(self.state_dir, "shards")) as f:
+                if int(f.read()) != self.n:
+                    print(f"ingest: saved state was for a different worker count, starting fresh", file=sys.stderr)
+                    return [None] * self.n
+            states = []
+            for shard in range(self.n):
+                with open(self._state_path(shard), "rb") as f:
+                    states.append(f.read())
+            return states
+        except (OSError, ValueError):
+            return [None] * self.n
+
+    def _spawn(self, shard, state_bytes):
+        self.generations[shard] += 1
+        self.last_states[shard] = state_bytes
+        proc = self._ctx.Process(target=_worker_main, name=f"ingest-{shard}",
+                                 args=(shard, self.generations[shard], self.inboxes[shard], self.results[shard],
+                                       self.server, state_bytes, self.sampled))
+        proc.start()
+        self.procs[shard] = proc
+
+    def _revive(self, shard):
+        """
+        worker 意外結束：以最後保存的狀態重新啟動 (呼叫時需持有 lock)
+        被 kill 的 worker 可能還握著佇列的讀取鎖 (卡在 get() 裡)，舊佇列不能再用：
+        換一條新佇列，把舊佇列裡還沒處理的批次依原順序搬過去 (直接讀底層 pipe，繞過那個鎖)
+        """
+        code = self.procs[shard].exitcode
+        self.procs[shard].join()
+        print(f"ingest: worker {shard} died (exit code {code}), restarting from last saved state", file=sys.stderr)
+        self.crashes += 1
+        with self._submit_lock:
+            old, new = self.inboxes[shard], self._ctx.Queue()
+            try:
+                while old._reader.poll(0.2): # 給 feeder 執行緒時間把緩衝的資料寫進 pipe
+                    new.put(pickle.loads(old._reader.recv_bytes()))
+            except (EOFError, OSError, pickle.UnpicklingError):
+                pass # worker 死在讀到一半：剩下的資料無法復原
+            old.cancel_join_thread()
+            old.close()
+            self.inboxes[shard] = new
+            self.results[shard] = self._ctx.Queue()
+            self._spawn(shard, self.last_states[shard])
+
+    def check(self):
+        """重新啟動已經死掉的 worker；回傳重啟的數量 (主程式定期呼叫)"""
+        with self._lock:
+            dead = [shard for shard, proc in enumerate(self.procs)
+                    if not self._closed and proc is not None and not proc.is_alive()]
+            for shard in dead:
+                self._revive(shard)
+            return len(dead)
+
+    def start(self):
+        for shard, state in enumerate(self._load_states()):
+            self._spawn(shard, state)
+        return self
+
+    # --- 送入資料 ---
+    def submit_many(self, readings):
+        """依病人分片後，每個分片整批放進佇列 (同一批內的順序保留)"""
+        batches = [[] for _ in range(self.n)]
+        for reading in readings:
+            batches[shard_of(reading["user_id"], self.n)].append(reading)
+        with self._submit_lock:
+            for inbox, batch in zip(self.inboxes, batches):
+                if batch:
+                    inbox.put(batch)
+
+    def submit(self, reading):
+        shard = shard_of(reading["user_id"], self.n)
+        with self._submit_lock:
+            self.inboxes[shard].put([reading])
+
+    # --- 控制 ---
+    def _collect(self, command, expected):
+        """
+        對 expected 這些分片送出控制訊息並等它們交回狀態；回傳 {shard: 狀態 bytes} (呼叫時需持有 lock)
+        等待中發現 worker 已死就從最後保存的狀態重啟，並重送控制訊息 (它會先處理完佇列中剩下的資料)
+        """
+        for shard in expected:
+            self.inboxes[shard].put((command, self.generations[shard]))
+        states = {}
+        while len(states) < len(expected):
+            for shard in expected:
+                if shard in states:
+                    continue
+                try:
+                    _, generation, state_bytes, stats = self.results[shard].get(timeout=0.2)
+                except queue.Empty:
+                    if not self.procs[shard].is_alive() and self.procs[shard].exitcode != 0: # 0 = 正常交回，結果還在路上
+                        self._revive(shard)
+                        self.inboxes[shard].put((command, self.generations[shard]))
+                    continue
+                if generation != self.generations[shard]:
+                    continue # 已被取代的 worker
+                states[shard] = state_bytes
+                self.last_states[shard] = state_bytes
+                for key, value in stats.items():
+                    self.stats[shard][key] = self.stats[shard].get(key, 0) + value
+        return states
+
+    def restart(self, shard):
+        """重啟一個 worker：舊的處理完已排入的資料後交出狀態，新的接手同一條佇列"""
+        with self._lock:
+            state_bytes = self._collect("handoff", [shard])[shard]
+            self.procs[shard].join()
+            self._spawn(shard, state_bytes)
+            self.restarts += 1
+
+    def close(self):
+        """排空所有佇列後結束 worker；有 state_dir 就把狀態存檔"""
+        with self._lock:
+            if self._closed:
+                return
+            states = self._collect("stop", range(self.n))
+            self._closed = True
+            for proc in self.procs:
+                proc.join()
+        if self.state_dir:
+            os.makedirs(self.state_dir, exist_ok=True)
+            for shard, state_bytes in states.items():
+                with open(self._state_path(shard) + ".tmp", "wb") as f:
+                    f.write(state_bytes)
+                os.replace(self._state_path(shard) + ".tmp", self._state_path(shard))
+            with open(os.path.join(self.state_dir, "shards"), "w") as f:
+                f.write(str(self.n))
+
+    def totals(self):
+        out = {}
+        for stats in self.stats:
+            for key, value in stats.items():
+                out[key] = out.get(key, 0) + value
+        return out
+
+# === 3. TCP 輸入 (每行一筆 JSON) ===
+class _LineHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        service = self.server.service
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                reading = loads(line)
+                service.submit(reading)
+            except (ValueError, KeyError, TypeError):
+                self.server.rejected += 1
+
+class LineServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, service):
+        super().__init__(address, _LineHandler)
+        self.service = service
+        self.rejected = 0
+
+# === 4. 基準測試 ===
+def make_readings(n, n_patients, seed=0):
+    """n 筆資料，輪流分給 n_patients 位病人，每位病人的時間遞增"""
+    rng = random.Random(seed)
+    t0 = time.time() - n
+    readings = []
+    for i in range(n):
+        readings.append({"user_id": f"P{i % n_patients:05d}", "name": "Bench",
+                         "hr": rng.randint(55, 150), "spo2": rng.randint(88, 100), "sys_bp": 110, "dia_bp": 70,
+                         "resp": 16, "hrv": rng.randint(20, 80), "stress": rng.randint(0, 90), "sleep": 7,
+                         "lat": 25.033, "lon": 121.565, "t": t0 + i})
+    return readings
+
+def crash_check(workers=2):
+    """worker 被 kill -9 後，close() / restart() 不能卡住，分片要從保存的狀態重啟並消化剩下的資料"""
+    readings = make_readings(2000, 50)
+    service = IngestService(workers).start()
+    service.submit_many(readings[:200])
+    service.restart(0) # 交接一次，last_states 有內容
+    os.kill(service.procs[0].pid, signal.SIGKILL)
+    service.procs[0].join()
+    service.submit_many(readings[200:])
+    service.restart(0) # 等待交接時發現 worker 已死 → 重啟後再交接
+    os.kill(service.procs[1].pid, signal.SIGKILL)
+    service.procs[1].join()
+    t0 = time.perf_counter()
+    service.close()
+    assert service.crashes == 2, service.crashes
+    totals = service.totals()
+    print(f"crash check: 2 workers killed, close() returned in {time.perf_counter() - t0:.2f}s, "
+          f"{totals['readings']:,} readings reported by the surviving workers")
+
+def sampled_check(n_patients=5, seconds=120):
+    """高頻串流模式：第一筆註冊 Patient，之後的讀數打包成 SampledData，樣本數要對得上"""
+    from fhir_stub import StubServer
+    stub = StubServer().start()
+    service = IngestService(1, stub.url, sampled=3600).start() # 間隔很長：只在關閉時送出
+    service.submit_many(make_readings(n_patients * seconds, n_patients))
+    service.close()
+    observations = list(stub.store.resources.get("Observation", {}).values())
+    hr = [o for o in observations if o["code"]["coding"][0]["code"] == "8867-4" and "valueSampledData" in o]
+    samples = sum(token != "E" for o in hr for token in o["valueSampledData"]["data"].split())
+    stub.stop()
+    totals = service.totals()
+    assert totals["sampled"] == n_patients * (seconds - 1) and samples == totals["sampled"], (totals, samples)
+    print(f"sampled check: {totals['sampled']:,} readings -> {len(hr)} heart-rate SampledData Observations, "
+          f"{totals['bundles']} bundles")
+
+def order_check():
+    """順序錯亂的讀數不更新滾動統計 / AI 評估，也不會把 last_t 往回拉"""
+    worker = _Worker(0, None, None)
+    readings = make_readings(20, 1)
+    for reading in readings[:10] + readings[15:] + readings[10:15]: # 後 5 筆晚到
+        worker.handle(reading)
+    trends = worker.state["trends"].features(readings[0]["user_id"])
+    expected = sum(r["hr"] for r in readings[:10] + readings[15:]) / 15
+    assert worker.stats["out_of_order"] == 5 and abs(trends["hr_mean"] - expected) < 1e-9, (worker.stats, trends)
+    assert worker.state["last_t"][readings[0]["user_id"]] == readings[-1]["t"]
+    print(f"order check: {worker.stats['out_of_order']} late readings skipped for trends and AI")
+
+def bench(n, worker_counts, server=None, n_patients=2000, chunk=500):
+    crash_check()
+    sampled_check()
+    order_check()
+    readings = make_readings(n, n_patients)
+    rows = []
+    for workers in worker_counts:
+        service = IngestService(workers, server).start()
+        service.submit_many(readings[:workers * 10]) # 暖機：等每個 worker 都載入模組
+        service.restart(0)
+        t0 = time.perf_counter()
+        for i in range(0, n, chunk):
+            service.submit_many(readings[i:i + chunk])
+            if i == n // 2:
+                service.restart(workers - 1) # 途中重啟一個 worker，順序與狀態要接得上
+        service.close()
+        elapsed = time.perf_counter() - t0
+        totals = service.totals()
+        rows.append((workers, n / elapsed, totals))
+        print(f"{workers} workers: {n / elapsed:10,.0f} readings/s | bundles {totals['bundles']:,} "
+              f"skipped {totals['skipped']:,} reports {totals['reports']:,} errors {totals['errors']} "
+              f"out-of-order {totals['out_of_order']}")
+    base = rows[0][1]
+    print(f"speedup vs {worker_counts[0]} worker(s): " +
+          ", ".join(f"{w}={rate / base:.2f}x" for w, rate, _ in rows) + f" ({os.cpu_count()} CPU cores)")
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sharded multi-process ingestion: gateway -> upload -> AI -> upload")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker process 數")
+    parser.add_argument("--listen", default="127.0.0.1:9400", help="TCP 輸入位址 host:port (每行一筆 JSON)")
+    parser.add_argument("--server", help="FHIR 伺服器 URL (不指定時只組 Bundle 不上傳)")
+    parser.add_argument("--state", help="狀態資料夾：關閉時存檔，下次啟動接著用")
+    parser.add_argument("--sampled", type=float, metavar="SECONDS",
+                        help="高頻串流模式：每 SECONDS 秒把讀數打包成 SampledData Observation")
+    parser.add_argument("--bench", type=int, metavar="N", help="送入 N 筆測試資料並量測吞吐量")
+    parser.add_argument("--bench-workers", default="1,2,4,8", help="基準測試的 worker 數 (逗號分隔)")
+    args = parser.parse_args()
+
+    if args.bench:
+        bench(args.bench, [int(w) for w in args.bench_workers.split(",")], args.server)
+        sys.exit(0)
+
+    service = IngestService(args.workers, args.server, args.state, args.sampled).start()
+    host, port = args.listen.rsplit(":", 1)
+    listener = LineServer((host, int(port)), service)
+    threading.Thread(target=listener.serve_forever, name="ingest-listen", daemon=True).start()
+    print(f"ingest: {args.workers} workers listening on {args.listen}", file=sys.stderr)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGHUP, lambda *_: threading.Thread(
+        target=lambda: [service.restart(i) for i in range(service.n)]).start()) # 逐一重啟 (例如更新程式後)
+    try:
+        while not stop.wait(1.0):
+            service.check() # 意外結束的 worker 從最後保存的狀態重啟
+    except KeyboardInterrupt:
+        pass
+    listener.shutdown()
+    service.close() # 佇列裡的資料處理完才結束
+    print(f"ingest: stopped | {service.totals()} | rejected {listener.rejected}", file=sys.stderr)
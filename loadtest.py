@@ -0,0 +1,198 @@
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import metrics
+from fast_json import dumps
+from fhir_client import FHIRClient
+from fhir_outbox import DurableOutbox
+from fhir_validator import validate_bundle
+from fhir_gateway import ChangeDetector, create_raw_data_bundle, register_patient_response
+from ai_engine import analyze_and_create_report
+
+# 端到端壓力測試：模擬 N 支手錶以固定頻率走完整個流程
+#   create_raw_data_bundle -> send_bundle -> analyze_and_create_report -> send_bundle
+# send_bundle 與 app.py 走同一條路徑：變化偵測 -> 預檢 (fhir_validator) -> 離線暫存區 (fhir_outbox) -> drainer 送出，
+# 所以 upload 階段包含寫入日誌、排隊與合併送出的時間
+# 每個階段分別統計 p50 / p95 / p99 延遲與吞吐量，並記下目前的 git commit，
+# 方便把效能退步對應到特定的 commit。
+#
+# 用法:
+#   python loadtest.py --watches 50 --rate 1 --duration 30              # 自動啟動本地 Stub 伺服器
+#   python loadtest.py --server http://127.0.0.1:8080 --out perf.ndjson  # 指定伺服器並把結果附加到檔案
+#   python loadtest.py --outbox ./outbox-loadtest                        # 指定暫存區目錄 (預設用暫存目錄)
+
+STAGES = ("queue", "build", "validate", "upload", "analyze", "report_upload", "total")
+
+# send_bundle 等待送達的上限 (與 app.py 相同)
+SEND_TIMEOUT = 20
+
+class StageTimer:
+    """收集各階段的延遲樣本 (秒) 與錯誤種類"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {stage: [] for stage in STAGES}
+        self.errors = 0
+        self.error_types = Counter() # "HTTP 500" / "validation" / 例外類別名稱 -> 次數
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.samples[stage].append(seconds)
+
+    def error(self, kind):
+        with self._lock:
+            self.errors += 1
+            self.error_types[kind] += 1
+
+    def summary(self, elapsed):
+        out = {}
+        for stage, values in self.samples.items():
+            if not values:
+                continue
+            arr = np.array(values) * 1000
+            p50, p95, p99 = np.percentile(arr, [50, 95, 99])
+            out[stage] = {"count": len(values), "per_s": len(values) / elapsed,
+                          "p50_ms": p50, "p95_ms": p95, "p99_ms": p99}
+        return out
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def send_bundle(outbox, timer, bundle, stage):
+    """
+    app.send_bundle 去掉畫面的版本：預檢 -> 寫入暫存區 -> 等 drainer 送達
+    成功回傳回應，失敗記錄錯誤種類並回傳 None (逾時等例外交給呼叫端記錄)
+    """
+    bundle["type"] = "transaction"
+    t0 = time.perf_counter()
+    with metrics.timer("app.validate"):
+        issues = validate_bundle(bundle)
+    t1 = time.perf_counter()
+    timer.add("validate", t1 - t0)
+    if issues:
+        timer.error("validation")
+        return None
+    with metrics.timer("app.send_bundle"):
+        response = outbox.submit(bundle).result(timeout=SEND_TIMEOUT)
+    timer.add(stage, time.perf_counter() - t1)
+    if response.status_code not in (200, 201):
+        timer.error(f"HTTP {response.status_code}")
+        return None
+    return response
+
+def simulate_watch(outbox, detector, timer, watch_id, scheduled):
+    """一支手錶的一次上傳 + AI 評估"""
+    t0 = time.perf_counter()
+    timer.add("queue", max(0.0, t0 - scheduled))
+    user_id = f"W{watch_id:05d}"
+    vitals = {"hr": random.randint(45, 180), "spo2": random.randint(82, 100), "hrv": random.randint(15, 90),
+              "stress": random.randint(0, 100), "sys_bp": 110, "dia_bp": 70, "resp": 16, "sleep": 7}
+    try:
+        bundle, pid, _ = create_raw_data_bundle(
+            user_id, "Load Test", vitals["hr"], vitals["spo2"], vitals["sys_bp"], vitals["dia_bp"],
+            vitals["resp"], vitals["hrv"], vitals["stress"], vitals["sleep"], 25.033, 121.565,
+            detector=detector)
+        t1 = time.perf_counter()
+        timer.add("build", t1 - t0)
+
+        if bundle["entry"]: # 全部沒變就不必送 (與 app.py 相同)
+            res = send_bundle(outbox, timer, bundle, "upload")
+            if res is None:
+                detector.forget(user_id)
+                return
+            pid = register_patient_response(user_id, res.json()) or pid
+        t2 = time.perf_counter()
+
+        report, status, _, _ = analyze_and_create_report(vitals, pid)
+        t3 = time.perf_counter()
+        timer.add("analyze", t3 - t2)
+
+        if send_bundle(outbox, timer, report, "report_upload") is None:
+            return
+        timer.add("total", time.perf_counter() - t0)
+    except Exception as e:
+        timer.error(type(e).__name__)
+
+def run(server, watches, rate, duration, workers, outbox_dir=None):
+    """以 watches * rate 次/秒 的總頻率送出，回傳統計結果"""
+    client = FHIRClient(server, pool_size=workers, max_in_flight=workers)
+    scratch = None
+    if outbox_dir is None:
+        scratch = tempfile.TemporaryDirectory(prefix="loadtest-outbox-")
+        outbox_dir = scratch.name
+    outbox = DurableOutbox(outbox_dir, client).start()
+    detector = ChangeDetector()
+    timer = StageTimer()
+    interval = 1.0 / (watches * rate)
+    pool = ThreadPoolExecutor(max_workers=workers)
+    start = time.perf_counter()
+    n = 0
+    while True:
+        scheduled = start + n * interval
+        if scheduled - start >= duration:
+            break
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        pool.submit(simulate_watch, outbox, detector, timer, n % watches, scheduled)
+        n += 1
+    pool.shutdown(wait=True)
+    elapsed = time.perf_counter() - start
+    outbox.close()
+    client.close()
+    if scratch is not None:
+        scratch.cleanup()
+    return {"commit": git_commit(), "server": server, "watches": watches, "rate_hz": rate,
+            "duration_s": duration, "offered": n, "errors": timer.errors,
+            "error_types": dict(timer.error_types), "elapsed_s": elapsed, "stages": timer.summary(elapsed)}
+
+def print_report(result):
+    print(f"commit {result['commit']} | {result['watches']} watches x {result['rate_hz']} Hz "
+          f"for {result['duration_s']} s | offered {result['offered']} | errors {result['errors']}")
+    if result["error_types"]:
+        print("errors by type: " + ", ".join(f"{kind} x{count}" for kind, count in result["error_types"].items()))
+    print(f"{'stage':15s}{'count':>8s}{'per_s':>10s}{'p50 ms':>10s}{'p95 ms':>10s}{'p99 ms':>10s}")
+    for stage, s in result["stages"].items():
+        print(f"{stage:15s}{s['count']:8d}{s['per_s']:10.1f}{s['p50_ms']:10.2f}{s['p95_ms']:10.2f}{s['p99_ms']:10.2f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end load test: gateway -> upload -> AI -> upload")
+    parser.add_argument("--server", help="FHIR 伺服器 URL (預設啟動本地 Stub)")
+    parser.add_argument("--watches", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=1.0, help="每支手錶每秒上傳次數")
+    parser.add_argument("--duration", type=float, default=10.0, help="秒")
+    parser.add_argument("--workers", type=int, default=32, help="同時在途的模擬手錶數")
+    parser.add_argument("--latency", type=float, default=0.005, help="Stub 延遲 (秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Stub 注入錯誤機率")
+    parser.add_argument("--out", help="把結果以 NDJSON 附加到這個檔案")
+    parser.add_argument("--outbox", help="離線暫存區目錄 (預設用暫存目錄，結束後刪除)")
+    args = parser.parse_args()
+
+    stub = None
+    server = args.server
+    if server is None:
+        from fhir_stub import StubServer
+        stub = StubServer(latency=args.latency, error_rate=args.error_rate).start()
+        server = stub.url
+
+    result = run(server, args.watches, args.rate, args.duration, args.workers, args.outbox)
+    print_report(result)
+    if args.out:
+        with open(args.out, "ab") as f:
+            f.write(dumps(result) + b"\n")
+    if stub is not None:
+        stub.stop()
+    sys.exit(1 if result["errors"] else 0)
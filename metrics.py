@@ -0,0 +1,322 @@
+import os
+import io
+import time
+import pstats
+import cProfile
+import functools
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from fast_json import dumps, loads
+
+# 輕量效能監控 (Instrumentation)：
+# - timer(stage)：各階段延遲 (Prometheus histogram + 最近 1024 筆樣本算 p50/p95/p99)
+# - incr(name, value, **labels)：計數器，例如每種資源送出的 bytes
+# - 關閉時 timer() 直接回傳共用的空物件、incr() 立即返回，幾乎零成本
+# - render_prometheus() / start_http_server(port)：輸出 Prometheus 文字格式 (GET /metrics)
+# - dumps_bundle(bundle)：序列化 Bundle，同時依資源類型記錄 bytes (大小直接取自送出的內容)
+# - arm_profile(request_id) + profiled(request_id, ...)：只對指定的請求做 cProfile
+#
+# 預設關閉；設定環境變數 FHIR_METRICS=1 或呼叫 enable() 開啟
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RESERVOIR_SIZE = 1024
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles")
+
+_enabled = os.environ.get("FHIR_METRICS", "").lower() in ("1", "true", "yes")
+_lock = threading.Lock()
+_stages = {} # stage -> _Histogram
+_counters = {} # (name, ((label, value), ...)) -> 數值
+
+def enable():
+    global _enabled
+    _enabled = True
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def is_enabled():
+    return _enabled
+
+class _Histogram:
+    __slots__ = ("buckets", "total", "count", "recent")
+
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.total = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=RESERVOIR_SIZE)
+
+    def observe(self, seconds):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        self.total += seconds
+        self.count += 1
+        self.recent.append(seconds)
+
+def observe(stage, seconds):
+    """記錄一個階段的耗時 (秒)"""
+    if not _enabled:
+        return
+    with _lock:
+        hist = _stages.get(stage)
+        if hist is None:
+            hist = _stages[stage] = _Histogram()
+        hist.observe(seconds)
+
+def incr(name, value=1, **labels):
+    """計數器累加，例如 incr("bytes_sent", 512, resource_type="Observation")"""
+    if not _enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+class _Timer:
+    __slots__ = ("stage", "t0")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.stage, time.perf_counter() - self.t0)
+        return False
+
+def timer(stage):
+    """with metrics.timer("gateway.build"): ..."""
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(stage)
+
+def timed(stage):
+    """裝飾器版本的 timer"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                observe(stage, time.perf_counter() - t0)
+        return wrapper
+    return decorator
+
+# --- 讀取 ---
+def snapshot():
+    """
+    各階段的統計：[{stage, count, mean_ms, p50_ms, p95_ms, p99_ms}]
+    (百分位數以最近 RESERVOIR_SIZE 筆樣本計算)
+    """
+    with _lock:
+        items = [(stage, hist.count, hist.total, sorted(hist.recent)) for stage, hist in _stages.items()]
+    rows = []
+    for stage, count, total, recent in sorted(items):
+        def pct(p):
+            return recent[min(len(recent) - 1, int(p * len(recent)))] * 1000 if recent else 0.0
+        rows.append({"stage": stage, "count": count, "mean_ms": total / count * 1000 if count else 0.0,
+                     "p50_ms": pct(0.50), "p95_ms": pct(0.95), "p99_ms": pct(0.99)})
+    return rows
+
+def dumps_bundle(bundle):
+    """
+    序列化 Bundle (回傳 bytes)，並把大小依資源類型記入 bytes_sent 計數器
+    開啟時每個 entry 各自序列化後直接接成整份 JSON，大小取自這些 bytes，不必再序列化一次；
+    entry (含 fullUrl / request 欄位) 記在它的資源類型，Bundle 外殼記在 "Bundle"
+    """
+    entries = bundle.get("entry") if isinstance(bundle, dict) else None
+    if not _enabled or not entries:
+        data = dumps(bundle)
+        incr("bytes_sent", len(data), resource_type="Bundle")
+        return data
+    parts = [dumps(entry) for entry in entries]
+    head = dumps({k: v for k, v in bundle.items() if k != "entry"})
+    data = head[:-1] + (b',"entry":[' if len(head) > 2 else b'"entry":[') + b",".join(parts) + b"]}"
+    per_type = {}
+    for entry, part in zip(entries, parts):
+        rtype = (entry.get("resource") or {}).get("resourceType", "Unknown")
+        per_type[rtype] = per_type.get(rtype, 0) + len(part)
+    per_type["Bundle"] = len(data) - sum(per_type.values())
+    for rtype, size in per_type.items():
+        incr("bytes_sent", size, resource_type=rtype)
+    return data
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+def reset():
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+
+def _escape(value):
+    """Prometheus 標籤值需跳脫反斜線、雙引號與換行"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(pairs):
+    return ",".join(f'{k}="{_escape(v)}"' for k, v in pairs)
+
+def render_prometheus():
+    """Prometheus text exposition format (0.0.4)"""
+    lines = ["# HELP fhir_stage_seconds Latency of each pipeline stage.",
+             "# TYPE fhir_stage_seconds histogram"]
+    with _lock:
+        stages = [(stage, list(h.buckets), h.total, h.count) for stage, h in sorted(_stages.items())]
+        counter_items = sorted(_counters.items())
+    for stage, buckets, total, count in stages:
+        stage = _escape(stage)
+        cumulative = 0
+        for bound, n in zip(LATENCY_BUCKETS, buckets):
+            cumulative += n
+            lines.append(f'fhir_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        lines.append(f'fhir_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+        lines.append(f'fhir_stage_seconds_sum{{stage="{stage}"}} {total}')
+        lines.append(f'fhir_stage_seconds_count{{stage="{stage}"}} {count}')
+
+    seen = set()
+    for (name, labels), value in counter_items:
+        metric = f"fhir_{name}_total"
+        if metric not in seen:
+            seen.add(metric)
+            lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric}{{{_labels(labels)}}} {value}" if labels else f"{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+_server = None
+
+def start_http_server(port=9108, host="127.0.0.1"):
+    """在背景啟動 /metrics 端點 (重複呼叫只會啟動一次)"""
+    global _server
+    with _lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name="metrics-http", daemon=True).start()
+        return _server
+
+# --- 針對單一請求的 cProfile ---
+_armed = set()
+profiles = {} # request_id -> 文字報表 (前 25 個函式，依累計時間排序)
+
+def arm_profile(request_id=None):
+    """下一次包含這個 request_id 的 profiled() 區塊會被 cProfile 記錄 (None = 下一個請求，不論 ID)"""
+    with _lock:
+        _armed.add(request_id or "*")
+
+class profiled:
+    """
+    with metrics.profiled(request_id, ...): ...
+    請求 ID 之一有被 arm_profile() 標記才會開 cProfile，結果寫入 profiles/{request_id}.prof
+    (在實際做事的執行緒上使用，例如 outbox 的 drainer；cProfile 只看得到目前執行緒)
+    """
+    def __init__(self, *request_ids):
+        self.request_ids = [rid for rid in request_ids if rid]
+        self.request_id = None
+        self.profiler = None
+
+    def __enter__(self):
+        if not _armed:
+            return self
+        with _lock:
+            matched = [rid for rid in self.request_ids if rid in _armed]
+            if matched:
+                key = self.request_id = matched[0]
+            elif "*" in _armed:
+                key, self.request_id = "*", (self.request_ids[0] if self.request_ids else "request")
+            else:
+                return self
+            _armed.discard(key)
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profiler is None:
+            return False
+        self.profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        self.profiler.dump_stats(os.path.join(PROFILE_DIR, f"{self.request_id}.prof"))
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats("cumulative").print_stats(25)
+        profiles[self.request_id] = out.getvalue()
+        return False
+
+# 測試區
+if __name__ == "__main__":
+    # 關閉時的額外成本 vs 完全不量測
+    def work():
+        return sum(range(10))
+
+    n = 200_000
+    t0 = time.perf_counter()
+    for _ in range(n):
+        work()
+    base = time.perf_counter() - t0
+
+    disable()
+    t0 = time.perf_counter()
+    for _ in range(n):
+        with timer("noop"):
+            work()
+    off = time.perf_counter() - t0
+
+    enable()
+    t0 = time.perf_counter()
+    for _ in range(n):
+        with timer("noop"):
+            work()
+    on = time.perf_counter() - t0
+    print(f"Overhead per call: disabled {(off - base) / n * 1e9:.0f} ns, enabled {(on - base) / n * 1e9:.0f} ns")
+
+    incr("bytes_sent", 1234, resource_type="Observation")
+    incr("weird", 1, label='a"b\\c\nd')
+    assert 'fhir_weird_total{label="a\\"b\\\\c\\nd"} 1' in render_prometheus()
+    bundle = {"resourceType": "Bundle", "type": "transaction", "entry": [
+        {"resource": {"resourceType": "Observation", "valueQuantity": {"value": 72}}, "request": {"method": "POST"}},
+        {"resource": {"resourceType": "Patient", "name": [{"text": "王"}]}}]}
+    data = dumps_bundle(bundle)
+    assert loads(data) == bundle
+    sent = {dict(labels)["resource_type"]: v for (name, labels), v in counters().items() if name == "bytes_sent"}
+    assert sent["Patient"] + sent["Bundle"] + sent["Observation"] - 1234 == len(data), sent
+    arm_profile("demo-request")
+    with profiled("demo-request"):
+        sorted(range(100000), key=lambda x: -x)
+    assert "demo-request" in profiles
+    print(render_prometheus().splitlines()[-2:])
+    print(snapshot())
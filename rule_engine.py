@@ -0,0 +1,290 @@
+import os
+import json
+import time
+import threading
+
+import numpy as np
+
+# 宣告式規則引擎：門檻寫在 rules.json，載入時編譯一次
+# - 單筆：產生 Python 原始碼並 compile 成函式 (每一級先用一個 or 運算式快速判斷，命中才組原因清單)
+# - 批次：預先整理成述詞表 (欄位, 運算子, 門檻)，用 NumPy 一次算完 N 位病人
+# - 依嚴重度由高到低判斷，命中即停止 (short-circuit)
+# - 檔案修改後自動重新載入 (hot reload)，不需重啟
+
+DEFAULT_RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules.json")
+
+_OPS = {">": np.greater, ">=": np.greater_equal, "<": np.less, "<=": np.less_equal,
+        "==": np.equal, "!=": np.not_equal}
+
+class RuleError(ValueError):
+    """規則檔格式錯誤"""
+
+def _check_rule(rule):
+    if not isinstance(rule, dict):
+        raise RuleError(f"Rule must be an object: {rule!r}")
+    if rule.get("op") not in _OPS:
+        raise RuleError(f"Unsupported operator: {rule.get('op')!r}")
+    for key in ("value", "default"):
+        if key in rule and (isinstance(rule[key], bool) or not isinstance(rule[key], (int, float))):
+            raise RuleError(f"Rule {rule.get('reason')!r}: {key} must be a number")
+    if not isinstance(rule.get("field"), str) or not isinstance(rule.get("reason"), str):
+        raise RuleError(f"Rule needs string 'field' and 'reason': {rule!r}")
+
+def _getter(rule):
+    """有 default 的欄位是可選的 (例如趨勢)，沒有的話與原本一樣直接取值"""
+    if "default" in rule:
+        return f"v.get({rule['field']!r}, {rule['default']!r})"
+    return f"v[{rule['field']!r}]"
+
+class RuleSet:
+    """編譯後的規則 (不可變)；換規則時整個換掉"""
+    def __init__(self, spec):
+        self.levels = spec["levels"]
+        self.default = spec["default"]
+        for level in self.levels:
+            for rule in level["rules"]:
+                _check_rule(rule)
+            # 描述範本在這裡先試套一次，錯的佔位符 (例如 {reason}) 不會等到評估時才出錯
+            try:
+                level["description"].format(reasons="")
+            except (AttributeError, IndexError, KeyError, ValueError) as e:
+                raise RuleError(f"Level {level.get('status')!r}: bad description {level['description']!r}") from e
+
+        # 狀態 -> (風險等級, 機率)
+        self.meta = {level["status"]: (level["risk_level"], level["probability"]) for level in self.levels}
+        self.meta[self.default["status"]] = (self.default["risk_level"], self.default["probability"])
+
+        self.source = self._generate()
+        namespace = {}
+        exec(compile(self.source, "<rules>", "exec"), namespace)
+        self._evaluate = namespace["evaluate"]
+
+    def _generate(self):
+        lines = ["def evaluate(v):"]
+        for i, level in enumerate(self.levels):
+            conds = [f"{_getter(r)} {r['op']} {r['value']!r}" for r in level["rules"]]
+            if not conds:
+                continue
+            lines.append(f"    if {' or '.join(conds)}:")
+            lines.append("        r = []")
+            for rule, cond in zip(level["rules"], conds):
+                lines.append(f"        if {cond}: r.append({rule['reason']!r})")
+            lines.append(f"        return {i}, r")
+        lines.append("    return -1, None")
+        return "\n".join(lines) + "\n"
+
+    def _describe(self, i, reasons):
+        if i < 0:
+            return self.default["status"], self.default["description"]
+        level = self.levels[i]
+        return level["status"], level["description"].format(reasons=", ".join(reasons))
+
+    def evaluate(self, vitals):
+        """單筆評估，回傳 (狀態, 描述)"""
+        return self._describe(*self._evaluate(vitals))
+
+    def evaluate_batch(self, vitals):
+        """
+        批次評估；vitals 為 pandas DataFrame 或 {欄位: 陣列}
+        回傳 (狀態陣列, 描述陣列, 機率陣列)
+        """
+        n = None
+        columns = {}
+        for level in self.levels:
+            for rule in level["rules"]:
+                field = rule["field"]
+                if field in columns:
+                    continue
+                if field in vitals:
+                    columns[field] = np.asarray(vitals[field], dtype=float)
+                    n = len(columns[field])
+                elif "default" not in rule:
+                    raise KeyError(field)
+        if n is None:
+            n = len(next(iter(vitals.values()))) if isinstance(vitals, dict) else len(vitals)
+
+        status = np.full(n, self.default["status"], dtype=object)
+        description = np.full(n, self.default["description"], dtype=object)
+        probability = np.full(n, float(self.default["probability"]))
+        undecided = np.ones(n, dtype=bool)
+
+        for i, level in enumerate(self.levels):
+            rules = level["rules"]
+            if not rules or not undecided.any():
+                continue
+            hits = np.empty((len(rules), n), dtype=bool)
+            for j, rule in enumerate(rules):
+                col = columns.get(rule["field"])
+                if col is None:
+                    col = np.full(n, float(rule["default"]))
+                _OPS[rule["op"]](col, rule["value"], out=hits[j])
+            rows = np.flatnonzero(undecided & hits.any(axis=0))
+            if not len(rows):
+                continue
+            undecided[rows] = False
+
+            # 相同原因組合只組一次字串 (規則數不多時把命中組合壓成一個整數，否則用 packbits)
+            if len(rules) < 63:
+                keys = np.zeros(len(rows), dtype=np.int64)
+                for j in range(len(rules)):
+                    keys |= hits[j, rows].astype(np.int64) << j
+                uniq, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+            else:
+                keys = np.packbits(hits[:, rows].T, axis=1)
+                uniq, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+            texts = np.empty(len(uniq), dtype=object)
+            for k, col_idx in enumerate(first):
+                reasons = [rules[j]["reason"] for j in np.flatnonzero(hits[:, rows[col_idx]])]
+                texts[k] = self._describe(i, reasons)[1]
+            status[rows] = level["status"]
+            description[rows] = texts[inverse.reshape(-1)]
+            probability[rows] = level["probability"]
+
+        return status, description, probability
+
+def load_rules(path=DEFAULT_RULES_PATH):
+    with open(path, encoding="utf-8") as f:
+        return RuleSet(json.load(f))
+
+class RuleEngine:
+    """
+    包住 RuleSet 並支援熱更新：每隔 check_interval 秒檢查一次檔案修改時間，
+    有變更就重新編譯後整個替換；新規則有錯時保留舊規則並記錄錯誤
+    """
+    def __init__(self, path=DEFAULT_RULES_PATH, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._mtime = os.stat(path).st_mtime_ns
+        self._next_check = time.monotonic() + check_interval
+        self.rules = load_rules(path)
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        with self._lock:
+            if now < self._next_check:
+                return
+            self._next_check = now + self.check_interval
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                if mtime != self._mtime:
+                    self.rules = load_rules(self.path)
+                    self._mtime = mtime
+                    self.last_error = None
+            except (OSError, ValueError, KeyError, TypeError) as e: # TypeError：欄位型別錯 (例如 levels 不是 list)
+                self.last_error = e
+
+    def evaluate(self, vitals):
+        self._maybe_reload()
+        return self.rules.evaluate(vitals)
+
+    def evaluate_batch(self, vitals):
+        self._maybe_reload()
+        return self.rules.evaluate_batch(vitals)
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """預設規則引擎 (rules.json)"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = RuleEngine()
+        return _engine
+
+# 測試區
+if __name__ == "__main__":
+    import sys
+    import shutil
+    import tempfile
+
+    # 原本寫死在 analyze_and_create_report 的判斷邏輯，作為比對基準
+    def reference(vitals):
+        if (vitals['hr'] > 170 or vitals['hr'] < 40) or (vitals['spo2'] < 85) or (vitals['sys_bp'] > 180):
+            reasons = []
+            if vitals['hr'] > 170: reasons.append("Severe Tachycardia")
+            if vitals['hr'] < 40: reasons.append("Severe Bradycardia")
+            if vitals['spo2'] < 85: reasons.append("Hypoxia")
+            if vitals['sys_bp'] > 180: reasons.append("Hypertensive Crisis")
+            return "emergency", f"CRITICAL: {', '.join(reasons)}. Immediate medical intervention required."
+        if (vitals['stress'] > 80) or (vitals['sleep'] < 5) or (vitals['hrv'] < 30) or \
+           (vitals.get('hrv_trend', 0) < -30):
+            reasons = []
+            if vitals['stress'] > 80: reasons.append("High Stress Level")
+            if vitals['sleep'] < 5: reasons.append("Sleep Deprivation")
+            if vitals['hrv'] < 30: reasons.append("Low HRV (Fatigue)")
+            if vitals.get('hrv_trend', 0) < -30: reasons.append("HRV Declining (>30% in 1h)")
+            return "preventive", f"WARNING: {', '.join(reasons)}. Rest recommended to prevent burnout."
+        return "normal", "All vital signs are within normal limits."
+
+    # 用法: python rule_engine.py [規則檔 ...]；預設檢查 rules.json
+    paths = sys.argv[1:] or [DEFAULT_RULES_PATH]
+    rng = np.random.default_rng(0)
+    n = 20000
+    cols = {
+        "hr": rng.integers(30, 200, n), "spo2": rng.integers(75, 101, n),
+        "sys_bp": rng.integers(90, 200, n), "stress": rng.integers(0, 101, n),
+        "sleep": rng.integers(2, 10, n), "hrv": rng.integers(10, 100, n),
+        "hrv_trend": rng.integers(-50, 20, n),
+    }
+    rows = [{k: int(v[i]) for k, v in cols.items()} for i in range(n)]
+    for i in range(0, n, 5):
+        del rows[i]["hrv_trend"] # 沒有趨勢資料
+
+    for path in paths:
+        rules = load_rules(path)
+        status, desc, prob = rules.evaluate_batch({**cols, "hrv_trend": [r.get("hrv_trend", 0) for r in rows]})
+        for i, r in enumerate(rows):
+            expected = reference(r)
+            assert rules.evaluate(r) == expected, (path, r)
+            assert (status[i], desc[i]) == expected, (path, r)
+        t0 = time.perf_counter()
+        for r in rows:
+            rules.evaluate(r)
+        per_call = (time.perf_counter() - t0) / n * 1e6
+        t0 = time.perf_counter()
+        rules.evaluate_batch(cols)
+        batch = (time.perf_counter() - t0) / n * 1e6
+        print(f"{os.path.basename(path)}: parity OK | {per_call:.2f} us/eval scalar, {batch:.3f} us/row batch")
+
+    # 規模測試：300 條規則 (三個等級各 100 條，門檻設成幾乎不會觸發 = 最壞情況要全部判斷)
+    big = {"levels": [], "default": {"status": "normal", "risk_level": "low", "probability": 0.1,
+                                      "description": "ok"}}
+    for status in ("emergency", "urgent", "preventive"):
+        big["levels"].append({"status": status, "risk_level": status, "probability": 0.5,
+                              "description": status + ": {reasons}",
+                              "rules": [{"field": f"f{k % 20}", "op": ">", "value": 1000 + k,
+                                         "reason": f"{status}-{k}"} for k in range(100)]})
+    big_rules = RuleSet(big)
+    sample = {f"f{k}": 50 for k in range(20)}
+    t0 = time.perf_counter()
+    for _ in range(20000):
+        big_rules.evaluate(sample)
+    print(f"300 rules: {(time.perf_counter() - t0) / 20000 * 1e6:.2f} us/eval")
+
+    # 熱更新：修改規則檔後不必重啟
+    tmp = os.path.join(tempfile.mkdtemp(), "rules.json")
+    shutil.copy(DEFAULT_RULES_PATH, tmp)
+    engine = RuleEngine(tmp, check_interval=0)
+    calm = {"hr": 160, "spo2": 98, "sys_bp": 120, "stress": 20, "sleep": 7, "hrv": 60}
+    assert engine.evaluate(calm)[0] == "normal"
+    with open(tmp, encoding="utf-8") as f:
+        spec = json.load(f)
+    spec["levels"][0]["rules"][0]["value"] = 150
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(spec, f)
+    os.utime(tmp, ns=(time.time_ns(), time.time_ns() + 1_000_000))
+    assert engine.evaluate(calm)[0] == "emergency"
+    # 新規則有錯 (描述佔位符寫錯、欄位型別錯) 時保留舊規則，不影響評估
+    for broken in ({**spec, "levels": [{**spec["levels"][0], "description": "{reason}"}] + spec["levels"][1:]},
+                   {**spec, "levels": 5}):
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(broken, f)
+        os.utime(tmp, ns=(time.time_ns(), time.time_ns() + 1_000_000))
+        assert engine.evaluate(calm)[0] == "emergency"
+        assert engine.last_error is not None
+    print("Hot reload OK")
@@ -0,0 +1,284 @@
+import time
+import threading
+
+import numpy as np
+
+# 每位病人的串流統計狀態 (Streaming State Store)
+# 不必每次都向 Server 撈 Observation 歷史，就能讓規則看到趨勢。
+#
+# 資料結構 (全部是欄位式 NumPy 陣列，一列 = 一位病人)：
+# - EWMA：每個指標一個值，每個樣本 O(1) 更新
+# - 時間桶環狀緩衝 (ring buffer)：n_buckets 個桶、每桶 bucket_seconds 秒，
+#   每桶存 sum / sumsq / min / max / count；另外維護整個視窗的 sum / sumsq / count 累計值，
+#   桶輪替時 (每 bucket_seconds 秒一次) 由各桶重新加總，所以 rolling mean / stddev 每個樣本 O(1)，
+#   長時間執行也不會累積浮點誤差
+# - rolling min / max 查詢時才在 n_buckets 個桶上取極值 (O(n_buckets)，與樣本數無關)
+#
+# 每位病人記憶體 (固定，不隨時間成長)：
+#   n_metrics * (n_buckets * 28 + 8 * 4) + 16 bytes
+#   桶：sum/sumsq 各 float64 (16，與視窗累計值同精度) + min/max 各 float32 (8) + count uint32 (4，高頻取樣也不會溢位)
+#   其他：ewma / 視窗 sum / sumsq (float64) + count (int64)，以及最後時間與目前桶編號
+#   預設 6 個指標、12 桶 x 5 分鐘 (= 1 小時) -> 約 2.2 KB / 人，10 萬人約 220 MB
+#   (bytes_per_patient() 會回傳實際值)
+
+METRICS = ("hr", "hrv", "spo2", "stress", "sys_bp", "dia_bp")
+
+class RollingVitalsStore:
+    def __init__(self, metrics=METRICS, bucket_seconds=300, n_buckets=12, alpha=0.05, capacity=1024):
+        self.metrics = tuple(metrics)
+        self.bucket_seconds = bucket_seconds
+        self.n_buckets = n_buckets
+        self.alpha = alpha # EWMA 平滑係數 (每個樣本)
+
+        self._lock = threading.Lock()
+        self.index = {} # patient_id -> 列索引
+        self._free = [] # 移除病人後可重複使用的列
+        self._capacity = 0
+        self._alloc(capacity)
+
+    # --- pickle (交接給另一個 process)：lock 不能序列化，另外重建 ---
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    # --- 陣列配置 ---
+    def _alloc(self, capacity):
+        m, b = len(self.metrics), self.n_buckets
+        shapes = {
+            "ewma": ((capacity, m), np.float64, np.nan),
+            "win_sum": ((capacity, m), np.float64, 0),
+            "win_sq": ((capacity, m), np.float64, 0),
+            "win_cnt": ((capacity, m), np.int64, 0),
+            "b_sum": ((capacity, m, b), np.float64, 0),
+            "b_sq": ((capacity, m, b), np.float64, 0),
+            "b_min": ((capacity, m, b), np.float32, np.inf),
+            "b_max": ((capacity, m, b), np.float32, -np.inf),
+            "b_cnt": ((capacity, m, b), np.uint32, 0),
+            "bucket_id": ((capacity,), np.int64, -1),
+            "last_t": ((capacity,), np.float64, np.nan),
+        }
+        for name, (shape, dtype, fill) in shapes.items():
+            new = np.full(shape, fill, dtype=dtype)
+            if self._capacity:
+                new[:self._capacity] = getattr(self, name)
+            setattr(self, name, new)
+        self._capacity = capacity
+
+    def bytes_per_patient(self):
+        names = ("ewma", "win_sum", "win_sq", "win_cnt", "b_sum", "b_sq", "b_min", "b_max",
+                 "b_cnt", "bucket_id", "last_t")
+        return sum(getattr(self, n).nbytes for n in names) // self._capacity
+
+    def _rows(self, patient_ids):
+        """patient_id -> 列索引 (新病人自動配置一列，容量不足時倍增)"""
+        rows = np.empty(len(patient_ids), dtype=np.int64)
+        for i, pid in enumerate(patient_ids):
+            row = self.index.get(pid)
+            if row is None:
+                row = self._free.pop() if self._free else len(self.index)
+                if row >= self._capacity:
+                    self._alloc(self._capacity * 2)
+                self.index[pid] = row
+            rows[i] = row
+        return rows
+
+    def remove(self, patient_id):
+        """移除病人並清空該列 (該列之後給新病人重用)"""
+        with self._lock:
+            row = self.index.pop(patient_id, None)
+            if row is None:
+                return
+            self._reset(np.array([row]))
+            self._free.append(row)
+
+    def _reset(self, rows):
+        self.ewma[rows] = np.nan
+        for name in ("win_sum", "win_sq", "win_cnt", "b_sum", "b_sq", "b_cnt"):
+            getattr(self, name)[rows] = 0
+        self.b_min[rows] = np.inf
+        self.b_max[rows] = -np.inf
+        self.bucket_id[rows] = -1
+        self.last_t[rows] = np.nan
+
+    # --- 時間桶輪替 ---
+    def _advance(self, rows, new_bucket):
+        """把 rows 推進到 new_bucket；清空被覆蓋的舊桶，並由剩下的桶重新加總視窗累計值"""
+        old = self.bucket_id[rows]
+        steps = np.where(old < 0, 0, np.minimum(new_bucket - old, self.n_buckets))
+        for k in range(1, int(steps.max(initial=0)) + 1):
+            r = rows[steps >= k]
+            slot = (old[steps >= k] + k) % self.n_buckets
+            self.b_sum[r, :, slot] = 0
+            self.b_sq[r, :, slot] = 0
+            self.b_cnt[r, :, slot] = 0
+            self.b_min[r, :, slot] = np.inf
+            self.b_max[r, :, slot] = -np.inf
+        # 重新加總而不是扣掉舊桶：加加減減的浮點誤差不會一直累積下去
+        self.win_sum[rows] = self.b_sum[rows].sum(axis=2)
+        self.win_sq[rows] = self.b_sq[rows].sum(axis=2)
+        self.win_cnt[rows] = self.b_cnt[rows].sum(axis=2)
+        self.bucket_id[rows] = new_bucket
+
+    # --- 寫入樣本 ---
+    def update_many(self, patient_ids, t, values):
+        """
+        一次寫入多位病人在同一時間點 t (epoch 秒) 的樣本
+        values: {指標: 長度 N 的陣列}，NaN 或缺少的指標視為沒有讀數
+        patient_ids 在同一次呼叫中不可重複
+        晚到的樣本 (t 屬於比目前更早的桶)：桶編號不會倒退；該桶還在視窗內就放回它自己的桶，
+        但不更新 EWMA (EWMA 只跟著時間往前)；已經被覆蓋的桶直接丟棄
+        """
+        with self._lock:
+            rows = self._rows(patient_ids)
+            bucket = int(t // self.bucket_seconds)
+            old = self.bucket_id[rows]
+            newer = rows[old < bucket]
+            if len(newer):
+                self._advance(newer, bucket)
+            on_time = old <= bucket
+            keep = on_time | (old - bucket < self.n_buckets)
+            slot = bucket % self.n_buckets
+
+            for m, metric in enumerate(self.metrics):
+                if metric not in values:
+                    continue
+                v = np.asarray(values[metric], dtype=np.float64)
+                ok = ~np.isnan(v) & keep
+                live = ok & on_time
+                r, prev = rows[live], self.ewma[rows[live], m]
+                self.ewma[r, m] = np.where(np.isnan(prev), v[live], prev + self.alpha * (v[live] - prev))
+                r, v = rows[ok], v[ok]
+                self.win_sum[r, m] += v
+                self.win_sq[r, m] += v * v
+                self.win_cnt[r, m] += 1
+                self.b_sum[r, m, slot] += v
+                self.b_sq[r, m, slot] += v * v
+                self.b_cnt[r, m, slot] += 1
+                self.b_min[r, m, slot] = np.minimum(self.b_min[r, m, slot], v)
+                self.b_max[r, m, slot] = np.maximum(self.b_max[r, m, slot], v)
+            self.last_t[rows] = np.fmax(self.last_t[rows], t)
+
+    def update(self, patient_id, t=None, **values):
+        """單一病人寫入，例如 update(pid, hr=75, hrv=50)"""
+        t = time.time() if t is None else t
+        self.update_many([patient_id], t, {k: [v] for k, v in values.items()})
+
+    # --- 讀取特徵 ---
+    def _features(self, rows):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            cnt = self.win_cnt[rows]
+            mean = self.win_sum[rows] / cnt
+            std = np.sqrt(np.maximum(self.win_sq[rows] / cnt - mean * mean, 0))
+            lo = self.b_min[rows].min(axis=2)
+            hi = self.b_max[rows].max(axis=2)
+
+            # 趨勢：目前 EWMA 相對於視窗內「最舊且有資料的桶」平均的變化百分比
+            # (預設 1 小時視窗時，即「過去 1 小時變化了多少 %」)
+            b_cnt = self.b_cnt[rows]
+            order = (self.bucket_id[rows][:, None] + 1 + np.arange(self.n_buckets)) % self.n_buckets # 舊 -> 新
+            cnt_sorted = np.take_along_axis(b_cnt, order[:, None, :].repeat(b_cnt.shape[1], axis=1), axis=2)
+            first = np.argmax(cnt_sorted > 0, axis=2)
+            oldest_slot = np.take_along_axis(order, first.reshape(len(rows), -1), axis=1)
+            oldest_sum = np.take_along_axis(self.b_sum[rows], oldest_slot[:, :, None], axis=2)[:, :, 0]
+            oldest_cnt = np.take_along_axis(b_cnt, oldest_slot[:, :, None], axis=2)[:, :, 0]
+            oldest_mean = oldest_sum / oldest_cnt
+            trend = (self.ewma[rows] - oldest_mean) / oldest_mean * 100
+
+        lo[np.isinf(lo)] = np.nan
+        hi[np.isinf(hi)] = np.nan
+        return {"ewma": self.ewma[rows], "mean": mean, "std": std, "min": lo, "max": hi, "trend": trend}
+
+    def features(self, patient_id):
+        """
+        單一病人的特徵字典，key 形如 hr_ewma / hr_mean / hr_std / hr_min / hr_max / hrv_trend
+        (*_trend 單位為 %，負值代表下降)；未知病人回傳空字典
+        """
+        with self._lock:
+            row = self.index.get(patient_id)
+            if row is None:
+                return {}
+            feats = self._features(np.array([row]))
+        return {f"{metric}_{name}": float(arr[0, m])
+                for name, arr in feats.items() for m, metric in enumerate(self.metrics)}
+
+    def features_frame(self):
+        """所有病人的特徵 (pandas DataFrame，index 為 patient_id)，可直接併入 analyze_batch 的輸入"""
+        import pandas as pd
+        with self._lock:
+            pids = list(self.index)
+            rows = np.fromiter(self.index.values(), dtype=np.int64, count=len(pids))
+            feats = self._features(rows)
+        columns = {f"{metric}_{name}": arr[:, m] for name, arr in feats.items() for m, metric in enumerate(self.metrics)}
+        return pd.DataFrame(columns, index=pids)
+
+# 測試區
+if __name__ == "__main__":
+    import sys
+
+    # --- 正確性：與直接用 NumPy 算整段歷史的結果比對 ---
+    store = RollingVitalsStore(bucket_seconds=60, n_buckets=60)
+    rng = np.random.default_rng(0)
+    t0 = 1_700_000_000 - 1_700_000_000 % 60
+    hrv = np.linspace(60, 35, 7200) + rng.normal(0, 1, 7200) # 2 小時內 HRV 逐漸下降
+    hr = rng.normal(75, 5, 7200)
+    for i in range(7200):
+        store.update("p1", t0 + i, hr=hr[i], hrv=hrv[i])
+    f = store.features("p1")
+    window = slice(7200 - 3600, 7200) # 最近 60 個完整的桶
+    assert abs(f["hr_mean"] - hr[window].mean()) < 1e-3
+    assert abs(f["hr_std"] - hr[window].std()) < 1e-2
+    assert abs(f["hrv_min"] - hrv[window].min()) < 1e-3 and abs(f["hrv_max"] - hrv[window].max()) < 1e-3
+    print(f"HRV trend over 1h: {f['hrv_trend']:.1f}% | HR mean {f['hr_mean']:.1f} ± {f['hr_std']:.1f}")
+
+    # --- 高頻取樣：單一桶超過 65535 筆也不溢位；桶輪替後視窗統計與剩下的樣本一致 ---
+    store = RollingVitalsStore(metrics=("hr",), bucket_seconds=3600, n_buckets=2)
+    t1 = t0 - t0 % 3600
+    burst = rng.normal(75, 5, 70_000)
+    for i in range(len(burst)):
+        store.update("hf", t1 + i * 0.01, hr=burst[i]) # 700 秒、全部落在同一桶
+    f = store.features("hf")
+    assert abs(f["hr_mean"] - burst.mean()) < 1e-9
+    later = rng.normal(90, 5, 100)
+    for i in range(len(later)):
+        store.update("hf", t1 + 7200 + i, hr=later[i]) # 前進兩桶：舊桶全部被覆蓋
+    assert abs(store.features("hf")["hr_mean"] - later.mean()) < 1e-9
+    print("Counts and sums OK: 70,000 samples in one bucket, exact window mean after rollover")
+
+    # --- 晚到的樣本：放回自己的桶，不讓目前的桶被當成新桶清空；太舊 (桶已被覆蓋) 就丟棄 ---
+    store = RollingVitalsStore(metrics=("hr",), bucket_seconds=60, n_buckets=12)
+    b = t0 + 3600
+    for i in range(10):
+        store.update("late", b + i, hr=100)
+    store.update("late", b - 30, hr=60) # 前一個桶
+    ewma = store.features("late")["hr_ewma"]
+    store.update("late", b + 10, hr=100)
+    f = store.features("late")
+    assert f["hr_ewma"] == ewma + store.alpha * (100 - ewma) # 晚到的樣本不影響 EWMA
+    assert abs(f["hr_mean"] - (11 * 100 + 60) / 12) < 1e-9 and f["hr_min"] == 60
+    store.update("late", b - 3600, hr=0) # 1 小時前：桶早已被覆蓋
+    assert abs(store.features("late")["hr_mean"] - (11 * 100 + 60) / 12) < 1e-9
+    print("Late samples OK: kept in their own bucket, dropped once the bucket has rolled off")
+
+    # --- 基準：10 萬位病人、1 Hz ---
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    seconds = 30
+    store = RollingVitalsStore(capacity=n)
+    pids = [f"p{i}" for i in range(n)]
+    samples = {m: rng.normal(80, 10, n) for m in METRICS}
+    store.update_many(pids, t0, samples) # 先配置好每一列
+    t_start = time.perf_counter()
+    for s in range(1, seconds + 1):
+        store.update_many(pids, t0 + s, samples)
+    elapsed = (time.perf_counter() - t_start) / seconds
+    per_patient = store.bytes_per_patient()
+    print(f"{n:,} patients @ 1 Hz: {elapsed * 1000:.0f} ms per tick "
+          f"({n * len(METRICS) / elapsed:,.0f} samples/s, {elapsed * 100:.0f}% of one core)")
+    print(f"Memory: {per_patient:,} bytes/patient, {per_patient * n / 2**20:,.0f} MiB total")
+    t_start = time.perf_counter()
+    frame = store.features_frame()
+    print(f"features_frame for {len(frame):,} patients: {(time.perf_counter() - t_start) * 1000:.0f} ms")
@@ -0,0 +1,383 @@
+import os
+import hmac
+import time
+import queue
+import socket
+import secrets
+import threading
+from collections import deque
+from urllib.parse import urlsplit, parse_qs, urlencode
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from fast_json import dumps, loads
+
+# 醫療中心 -> 手錶 的即時推播 (Server-Sent Events)
+# - 每位病人一個頻道：GET /events/{patient_id} (text/event-stream)，瀏覽器用 EventSource 訂閱
+# - 伺服器接受 ServiceRequest / CommunicationRequest 後立刻 publish，不必等手錶端重跑頁面
+# - 每個頻道保留最近 REPLAY_SIZE 筆事件：斷線重連時帶 Last-Event-ID 就能補收漏掉的事件
+# - 同一個 process 內 (Streamlit 手錶面板) 可直接用 hub.since() 取事件，不必走 HTTP
+# - POST /ack/{patient_id} 讓手錶回報「收到 -> 畫面更新」的延遲，GET /stats 查看
+# - GET /watch 提供手錶模擬器頁面 (healthwatch.html)，與事件串流同源，不需要 CORS
+# - 安全性：事件串流含病人資料 (PHI)，除了 /watch 以外都要帶共用 token
+#   (EventSource 不能自訂標頭，所以接受 ?token=，或 Authorization: Bearer)；
+#   帶 Origin 的請求只接受白名單內的來源，POST 只接受 application/json (跨來源時一定要先 preflight)
+#
+# 選 SSE 而不是 WebSocket：只需要單向推播，標準函式庫就做得到，瀏覽器斷線會自動重連
+
+REPLAY_SIZE = 64
+KEEPALIVE_SECONDS = 15
+DEFAULT_PORT = 8765
+WATCH_PAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "healthwatch.html")
+
+class PushHub:
+    """依病人分頻道的發佈 / 訂閱"""
+    def __init__(self, replay_size=REPLAY_SIZE, max_queue=256):
+        self.replay_size = replay_size
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._next_id = 1
+        self._history = {} # patient_id -> deque[(id, event, data)]
+        self._subscribers = {} # patient_id -> set[Queue]
+        self.published = 0
+        self.dropped = 0
+        self.render_ms = deque(maxlen=1024) # 手錶回報的延遲 (發佈 -> 畫面更新)
+
+    def publish(self, patient_id, event, data):
+        """發佈事件給這位病人的所有訂閱者，回傳事件 ID；data 會加上 sent_at (epoch 毫秒)"""
+        data = dict(data, sent_at=time.time() * 1000)
+        with self._lock:
+            event_id = self._next_id
+            self._next_id += 1
+            item = (event_id, event, data)
+            history = self._history.get(patient_id)
+            if history is None:
+                history = self._history[patient_id] = deque(maxlen=self.replay_size)
+            history.append(item)
+            subscribers = list(self._subscribers.get(patient_id, ()))
+            self.published += 1
+        for q in subscribers:
+            if q.qsize() >= self.max_queue:
+                # 消化太慢的訂閱者直接斷開，重連後用 Last-Event-ID 補收
+                self.dropped += 1
+                self.unsubscribe(patient_id, q)
+                q.put(None)
+            else:
+                q.put(item)
+        return event_id
+
+    def last_id(self):
+        """目前最新的事件 ID (0 = 還沒有任何事件)"""
+        with self._lock:
+            return self._next_id - 1
+
+    def since(self, patient_id, last_id=0):
+        """這位病人 ID 大於 last_id 的事件 (最多 replay_size 筆)"""
+        with self._lock:
+            return [item for item in self._history.get(patient_id, ()) if item[0] > last_id]
+
+    def subscribe(self, patient_id, last_id=None):
+        """回傳 Queue；有 last_id 時先放入漏掉的事件 (None 代表連線該結束了)"""
+        q = queue.Queue()
+        with self._lock:
+            self._subscribers.setdefault(patient_id, set()).add(q)
+            if last_id is not None:
+                for item in self._history.get(patient_id, ()):
+                    if item[0] > last_id:
+                        q.put(item)
+        return q
+
+    def unsubscribe(self, patient_id, q):
+        with self._lock:
+            subscribers = self._subscribers.get(patient_id)
+            if subscribers is not None:
+                subscribers.discard(q)
+                if not subscribers:
+                    del self._subscribers[patient_id]
+
+    def record_render(self, latency_ms):
+        with self._lock:
+            self.render_ms.append(float(latency_ms))
+
+    def close(self):
+        with self._lock:
+            queues = [q for subscribers in self._subscribers.values() for q in subscribers]
+            self._subscribers.clear()
+        for q in queues:
+            q.put(None)
+
+    def stats(self):
+        with self._lock:
+            samples = sorted(self.render_ms)
+            subscribers = sum(len(s) for s in self._subscribers.values())
+        pct = lambda p: round(samples[min(len(samples) - 1, int(p * len(samples)))], 2) if samples else None
+        return {"published": self.published, "dropped": self.dropped, "subscribers": subscribers,
+                "render_p50_ms": pct(0.50), "render_p95_ms": pct(0.95), "render_p99_ms": pct(0.99)}
+
+def format_event(item):
+    event_id, event, data = item
+    return f"id: {event_id}\nevent: {event}\ndata: ".encode() + dumps(data) + b"\n\n"
+
+class PushHandler(BaseHTTPRequestHandler):
+    def setup(self):
+        super().setup()
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def _cors(self):
+        """白名單內的 Origin 才回 CORS 標頭 (不用萬用字元 *)"""
+        origin = self.headers.get("Origin")
+        if origin and origin in self.server.origins:
+            self.send_header("Access-Control-Allow-Origin", origin)
+            self.send_header("Vary", "Origin")
+
+    def _reply(self, status, body, content_type="application/json"):
+        data = body if isinstance(body, bytes) else dumps(body)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self._cors()
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _allowed(self, query=None):
+        """檢查來源與 token；不通過時直接回錯誤並回傳 False"""
+        origin = self.headers.get("Origin")
+        if origin and origin not in self.server.origins:
+            self._reply(403, {"error": "origin not allowed"})
+            return False
+        auth = self.headers.get("Authorization", "")
+        token = auth[7:] if auth.startswith("Bearer ") else (query or {}).get("token", [""])[0]
+        if not hmac.compare_digest(token.encode(), self.server.token.encode()):
+            self._reply(401, {"error": "invalid token"})
+            return False
+        return True
+
+    def do_OPTIONS(self):
+        # CORS preflight：只回應白名單內的來源
+        if self.headers.get("Origin") not in self.server.origins:
+            self._reply(403, {"error": "origin not allowed"})
+            return
+        self.send_response(204)
+        self._cors()
+        self.send_header("Access-Control-Allow-Methods", "GET, POST")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type, Authorization, Last-Event-ID")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        hub = self.server.hub
+        url = urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        if parts == ["watch"]:
+            with open(WATCH_PAGE, "rb") as f:
+                self._reply(200, f.read(), "text/html; charset=utf-8")
+            return
+        if not self._allowed(parse_qs(url.query)):
+            return
+        if parts == ["stats"]:
+            self._reply(200, hub.stats())
+            return
+        if len(parts) != 2 or parts[0] != "events":
+            self._reply(404, {"error": "not found"})
+            return
+
+        patient_id = parts[1]
+        last_id = self.headers.get("Last-Event-ID") or parse_qs(url.query).get("last_id", [None])[0]
+        q = hub.subscribe(patient_id, int(last_id) if last_id and last_id.isdigit() else None)
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self._cors()
+            self.end_headers()
+            self.wfile.write(b"retry: 1000\n\n") # 斷線後 1 秒重連
+            self.wfile.flush()
+            while True:
+                try:
+                    item = q.get(timeout=KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    self.wfile.write(b": keepalive\n\n")
+                    self.wfile.flush()
+                    continue
+                if item is None:
+                    break
+                self.wfile.write(format_event(item))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            hub.unsubscribe(patient_id, q)
+
+    def do_POST(self):
+        hub = self.server.hub
+        url = urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        length = int(self.headers.get("Content-Length", 0))
+        if not self._allowed(parse_qs(url.query)):
+            return
+        if self.headers.get("Content-Type", "").split(";")[0].strip() != "application/json":
+            # text/plain 等「簡單請求」不會觸發 preflight，一律拒絕
+            self._reply(415, {"error": "expected application/json"})
+            return
+        try:
+            body = loads(self.rfile.read(length)) if length else {}
+        except ValueError:
+            self._reply(400, {"error": "invalid JSON"})
+            return
+        if len(parts) == 2 and parts[0] == "publish":
+            # 其他 process (例如另一個 Streamlit 實例) 也能發佈
+            event_id = hub.publish(parts[1], body.get("event", "message"), body.get("data", {}))
+            self._reply(200, {"id": event_id})
+        elif len(parts) == 2 and parts[0] == "ack":
+            if isinstance(body.get("latency_ms"), (int, float)):
+                hub.record_render(body["latency_ms"])
+            self._reply(200, {})
+        else:
+            self._reply(404, {"error": "not found"})
+
+class PushServer:
+    """
+    在背景執行緒啟動推播服務：PushServer(port=8765).start()
+    - token: 共用密鑰 (沒給就隨機產生)，手錶頁面以 ?token= 帶入
+    - origins: 額外允許的頁面來源 (服務本身的 /watch 頁面一律允許)
+    """
+    def __init__(self, host="127.0.0.1", port=DEFAULT_PORT, hub=None, token=None, origins=()):
+        self.hub = hub or PushHub()
+        self.token = token or secrets.token_urlsafe(16)
+        self.httpd = ThreadingHTTPServer((host, port), PushHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.hub = self.hub
+        self.httpd.token = self.token
+        self.url = f"http://{host}:{self.httpd.server_port}"
+        self.httpd.origins = {self.url, f"http://localhost:{self.httpd.server_port}"} | set(origins)
+
+    def watch_url(self, patient_id):
+        """手錶模擬器頁面 (同源訂閱事件串流)"""
+        return f"{self.url}/watch?{urlencode({'patient': patient_id, 'token': self.token})}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name="watch-push", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.hub.close()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+# --- 全程式共用一個 hub (Streamlit 重跑頁面時不會重建) ---
+_hub = PushHub()
+_server = None
+_server_lock = threading.Lock()
+
+def get_hub():
+    return _hub
+
+def start_server(port=DEFAULT_PORT, host="127.0.0.1", token=None, origins=()):
+    """啟動一次 SSE 端點 (port 被占用時丟 OSError；in-process 的 hub 仍可使用)"""
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = PushServer(host, port, hub=_hub, token=token, origins=origins).start()
+        return _server
+
+def iter_events(url, token, timeout=30):
+    """簡易 SSE 客戶端 (測試 / 命令列用)：逐一產生 (id, event, data)"""
+    import requests
+    headers = {"Accept": "text/event-stream", "Authorization": f"Bearer {token}"}
+    with requests.get(url, stream=True, timeout=timeout, headers=headers) as response:
+        response.raise_for_status()
+        event_id, event, data = None, "message", []
+        for line in response.iter_lines(chunk_size=1, decode_unicode=True):
+            if line == "":
+                if data:
+                    yield event_id, event, loads("\n".join(data))
+                event_id, event, data = None, "message", []
+            elif line.startswith("id:"):
+                event_id = int(line[3:].strip())
+            elif line.startswith("event:"):
+                event = line[6:].strip()
+            elif line.startswith("data:"):
+                data.append(line[5:].strip())
+
+# 測試區
+if __name__ == "__main__":
+    import sys
+    import numpy as np
+    from fhir_client import FHIRClient
+    from fhir_stub import StubServer
+
+    # 延遲量測：醫生按下按鈕 -> ServiceRequest 寫入伺服器 -> 推播 -> 手錶收到並解析
+    # 用法: python watch_push.py [手錶數] [每支手錶的事件數]
+    watches = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    per_watch = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    stub = StubServer(latency=0.005).start()
+    fhir = FHIRClient(stub.url)
+    push = PushServer(port=0).start()
+
+    received = {}
+
+    def watch(patient_id):
+        events = iter_events(f"{push.url}/events/{patient_id}", push.token)
+        for _ in range(per_watch):
+            _, event, data = next(events)
+            received.setdefault(patient_id, []).append((time.time() * 1000 - data["clicked_at"],
+                                                          time.time() * 1000 - data["sent_at"]))
+
+    threads = [threading.Thread(target=watch, args=(f"P{i}",), daemon=True) for i in range(watches)]
+    for t in threads:
+        t.start()
+    deadline = time.monotonic() + 10
+    while push.hub.stats()["subscribers"] < watches and time.monotonic() < deadline:
+        time.sleep(0.01) # 等所有 SSE 連線建立
+
+    for round_no in range(per_watch):
+        for i in range(watches):
+            clicked = time.time() * 1000
+            sr = {"resourceType": "ServiceRequest", "status": "active", "intent": "order", "priority": "stat",
+                  "subject": {"reference": f"Patient/P{i}"}}
+            res = fhir.post_bundle({"resourceType": "Bundle", "type": "transaction",
+                                    "entry": [{"resource": sr, "request": {"method": "POST", "url": "ServiceRequest"}}]})
+            assert res.status_code == 200
+            push.hub.publish(f"P{i}", "cpr", {"clicked_at": clicked, "round": round_no})
+    deadline = time.monotonic() + 10
+    for t in threads:
+        t.join(timeout=max(0, deadline - time.monotonic()))
+
+    # 斷線重連：帶 Last-Event-ID 補收
+    first = push.hub.publish("R1", "message", {"text": "a", "clicked_at": 0})
+    push.hub.publish("R1", "message", {"text": "b", "clicked_at": 0})
+    replay = iter_events(f"{push.url}/events/R1?last_id={first}", push.token)
+    assert next(replay)[2]["text"] == "b"
+
+    # 存取控制：沒有 token、不在白名單的來源、text/plain 簡單請求 (CSRF) 都要擋下
+    import requests
+    auth = {"Authorization": f"Bearer {push.token}"}
+    assert requests.get(f"{push.url}/events/R1", timeout=5).status_code == 401
+    assert requests.get(f"{push.url}/stats", headers=dict(auth, Origin="https://evil.example"),
+                        timeout=5).status_code == 403
+    assert requests.options(f"{push.url}/publish/R1", headers={"Origin": "https://evil.example"},
+                            timeout=5).status_code == 403
+    assert requests.post(f"{push.url}/publish/R1", data=b'{"event": "cpr"}', timeout=5,
+                         headers=dict(auth, **{"Content-Type": "text/plain"})).status_code == 415
+    ok = requests.post(f"{push.url}/publish/R1", json={"event": "message", "data": {"text": "c"}},
+                       headers=dict(auth, Origin=push.url), timeout=5)
+    assert ok.status_code == 200 and ok.headers["Access-Control-Allow-Origin"] == push.url
+    assert "Access-Control-Allow-Origin" not in requests.get(f"{push.url}/stats", timeout=5,
+        headers=dict(auth)).headers
+    assert requests.get(push.watch_url("R1"), timeout=5).text.startswith("<!DOCTYPE html>")
+
+    click = np.array([c for v in received.values() for c, _ in v])
+    fanout = np.array([s for v in received.values() for _, s in v])
+    assert len(click) == watches * per_watch, len(click)
+    print(f"{watches} watches x {per_watch} events")
+    print(f"click -> watch (incl. FHIR write): p50 {np.percentile(click, 50):.2f} ms, "
+          f"p95 {np.percentile(click, 95):.2f} ms, p99 {np.percentile(click, 99):.2f} ms")
+    print(f"publish -> watch:                  p50 {np.percentile(fanout, 50):.2f} ms, "
+          f"p95 {np.percentile(fanout, 95):.2f} ms, p99 {np.percentile(fanout, 99):.2f} ms")
+    print("polling baseline (Streamlit rerun every 1 s): ~500 ms average, up to 1000 ms")
+    push.stop()
+    fhir.close()
+    stub.stop()